@@ -0,0 +1,152 @@
+"""Utilities for reading BGZF (blocked gzip) files, as written by bgzip. Unlike regular gzip files, BGZF files consist
+of independently compressed blocks of up to 64Kb, so they can be read starting from any block. Positions in these
+files are represented as "virtual offsets": (compressed offset of the block << 16) | (offset within the uncompressed
+block), the same as in tabix and Nirvana .jsi indexes.
+"""
+
+import struct
+import zlib
+
+BGZF_HEADER_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+def _read_block_header(f):
+    """Reads the gzip header of a BGZF block from the current position of f.
+
+    Return:
+        int: the total size of the compressed block in bytes (including the header), or None at the end of the file
+    """
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+
+    if header[:4] != BGZF_HEADER_MAGIC:
+        raise ValueError(f"Invalid BGZF block header at offset {f.tell() - len(header)}")
+
+    extra_length = struct.unpack("<H", header[10:12])[0]
+    extra = f.read(extra_length)
+    i = 0
+    while i + 4 <= len(extra):
+        subfield_id, subfield_length = extra[i:i+2], struct.unpack("<H", extra[i+2:i+4])[0]
+        if subfield_id == b"BC" and subfield_length == 2:
+            return struct.unpack("<H", extra[i+4:i+6])[0] + 1
+        i += 4 + subfield_length
+
+    raise ValueError("BGZF block header doesn't contain a BC subfield. Is this a regular gzip file?")
+
+
+def is_bgzf(path):
+    """Returns True if the given file is BGZF-compressed (eg. by bgzip), rather than a regular gzip file"""
+    with open(path, "rb") as f:
+        try:
+            return _read_block_header(f) is not None
+        except ValueError:
+            return False
+
+
+def iter_bgzf_blocks(path):
+    """Iterates over the blocks of a BGZF file.
+
+    Yields:
+        2-tuple: (compressed offset of the block, total compressed size of the block in bytes)
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            block_size = _read_block_header(f)
+            if block_size is None:
+                break
+            yield offset, block_size
+            offset += block_size
+            f.seek(offset)
+
+
+class BgzfReader:
+    """Binary file-like object for reading a BGZF file, which supports seek(..) and tell(..) using virtual offsets.
+    Also works as a context manager.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        self._block_offset = 0
+        self._next_block_offset = 0
+        self._block_data = b""
+        self._position_in_block = 0
+        self._load_block(0)
+
+    def _load_block(self, block_offset):
+        self._f.seek(block_offset)
+        block_size = _read_block_header(self._f)
+        self._block_offset = block_offset
+        if block_size is None:
+            self._next_block_offset = block_offset
+            self._block_data = b""
+        else:
+            self._next_block_offset = block_offset + block_size
+            # the compressed data is followed by an 8-byte footer with the CRC32 and uncompressed size
+            compressed_data = self._f.read(block_size - self._f.tell() + block_offset - 8)
+            self._block_data = zlib.decompress(compressed_data, -15)
+        self._position_in_block = 0
+
+    def _load_next_nonempty_block(self):
+        """Loads blocks until one with data is found. Returns False at the end of the file."""
+        while self._position_in_block >= len(self._block_data):
+            if self._next_block_offset == self._block_offset:
+                return False  # end of file
+            self._load_block(self._next_block_offset)
+        return True
+
+    def seek(self, virtual_offset):
+        block_offset, position_in_block = virtual_offset >> 16, virtual_offset & 0xFFFF
+        if block_offset != self._block_offset or not self._block_data:
+            self._load_block(block_offset)
+        self._position_in_block = position_in_block
+
+    def tell(self):
+        """Returns the virtual offset of the current position"""
+        if self._block_data and self._position_in_block >= len(self._block_data):
+            return self._next_block_offset << 16
+        return (self._block_offset << 16) | self._position_in_block
+
+    def readline(self):
+        """Returns the next line (including the trailing newline) as bytes, or b"" at the end of the file"""
+        parts = []
+        while self._load_next_nonempty_block():
+            newline_position = self._block_data.find(b"\n", self._position_in_block)
+            if newline_position >= 0:
+                parts.append(self._block_data[self._position_in_block:newline_position + 1])
+                self._position_in_block = newline_position + 1
+                break
+            parts.append(self._block_data[self._position_in_block:])
+            self._position_in_block = len(self._block_data)
+
+        return b"".join(parts)
+
+    def read(self, size=-1):
+        """Reads up to size bytes, or until the end of the file if size is negative"""
+        parts = []
+        while size != 0 and self._load_next_nonempty_block():
+            end = len(self._block_data) if size < 0 else min(len(self._block_data), self._position_in_block + size)
+            parts.append(self._block_data[self._position_in_block:end])
+            if size > 0:
+                size -= end - self._position_in_block
+            self._position_in_block = end
+
+        return b"".join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
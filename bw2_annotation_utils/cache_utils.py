@@ -1,80 +1,1035 @@
+import argparse
+import collections
+import collections.abc
+import contextlib
+import functools
 import gzip
 import hashlib
+import inspect
 import json
 import os
 import pandas as pd
+import pickle
 import re
+import sqlite3
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # file locking isn't available on Windows
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# default cache dir and freshness window. These can be overridden by setting the ANNOTATIONS_CACHE_DIR and
+# ANNOTATIONS_CACHE_TTL (in seconds) environment variables, or by passing cache_dir= or ttl= to the decorators.
 CACHE_DIR = os.path.expanduser("~/.annotations")
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# when stale_while_revalidate is enabled, expired cache files are still returned immediately (while being refreshed in
+# the background) for up to this many seconds past their ttl. After that, callers wait for the refresh.
+DEFAULT_MAX_STALENESS = 7 * 24 * 60 * 60
+
+# file formats that cache_data_table can use to store tables. "parquet" and "feather" preserve column dtypes and
+# support reading a subset of columns, but require pyarrow. "tsv" is the original gzipped text format.
+TABLE_FORMATS = {
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "tsv": ".tsv.gz",
+}
+DEFAULT_TABLE_FORMAT = "parquet"
+
+# serializers that cache_json can use. "orjson" and "json" both write compact json (so files written by one can be
+# read by the other), while "msgpack" writes a binary format that's faster to load. If the orjson or msgpack
+# packages aren't installed, the stdlib json module is used instead.
+JSON_SERIALIZERS = {
+    "orjson": ".json.gz",
+    "json": ".json.gz",
+    "msgpack": ".msgpack.gz",
+}
+DEFAULT_JSON_SERIALIZER = "orjson"
+
+# limits for the in-memory cache that sits in front of the on-disk cache
+MEMORY_CACHE_MAX_ENTRIES = 32
+MEMORY_CACHE_MAX_BYTES = 2 * 1024**3
+
+# how long (in seconds) to wait for another process that is already retrieving the same data before giving up and
+# retrieving it in this process as well
+DEFAULT_LOCK_TIMEOUT = 30 * 60
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class _MemoryCache:
+    """Thread-safe LRU cache that keeps recently used results in memory, so that repeated calls to a cached
+    function don't have to re-read and re-parse the cache file. Entries are evicted in least-recently-used order
+    once either the number of entries or their total size exceeds the given limits.
+    """
+
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, max_bytes=MEMORY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # maps (function_name, cache_key) => (value, size in bytes)
+        self._total_bytes = 0
+        self._hits = collections.Counter()
+        self._misses = collections.Counter()
+        self._lock = threading.RLock()
+
+    def get(self, function_name, cache_key):
+        """Returns the stored value, or None if it's not in the cache"""
+        key = (function_name, cache_key)
+        with self._lock:
+            if key not in self._entries:
+                self._misses[function_name] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits[function_name] += 1
+            return self._entries[key][0]
+
+    def put(self, function_name, cache_key, value, size):
+        key = (function_name, cache_key)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+
+            if size > self.max_bytes or self.max_entries <= 0:
+                return
+
+            self._entries[key] = (value, size)
+            self._total_bytes += size
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+    def clear(self, function_name=None):
+        """Removes all entries (or only entries for the given function) and resets the hit/miss counters"""
+        with self._lock:
+            for key in list(self._entries):
+                if function_name is None or key[0] == function_name:
+                    self._total_bytes -= self._entries.pop(key)[1]
+
+            if function_name is None:
+                self._hits.clear()
+                self._misses.clear()
+            else:
+                self._hits.pop(function_name, None)
+                self._misses.pop(function_name, None)
+
+    def info(self, function_name=None):
+        with self._lock:
+            if function_name is None:
+                return CacheInfo(
+                    sum(self._hits.values()), sum(self._misses.values()), self.max_entries, len(self._entries))
+
+            return CacheInfo(
+                self._hits[function_name],
+                self._misses[function_name],
+                self.max_entries,
+                sum(1 for key in self._entries if key[0] == function_name))
+
+
+_memory_cache = _MemoryCache()
+
+
+def cache_clear():
+    """Clear the in-memory cache for all decorated functions. This doesn't delete any files from the cache dir."""
+    _memory_cache.clear()
+
+
+def cache_info():
+    """Return a CacheInfo(hits, misses, maxsize, currsize) tuple for the in-memory cache of all decorated functions"""
+    return _memory_cache.info()
+
+
+def get_cache_dir():
+    """Returns the cache dir path, which is ~/.annotations unless the ANNOTATIONS_CACHE_DIR env. variable is set"""
+    return os.path.expanduser(os.environ.get("ANNOTATIONS_CACHE_DIR") or CACHE_DIR)
+
+
+def get_default_ttl():
+    """Returns how many seconds cache files stay fresh, which is 1 week unless the ANNOTATIONS_CACHE_TTL env.
+    variable is set
+    """
+    ttl = os.environ.get("ANNOTATIONS_CACHE_TTL")
+    if not ttl:
+        return DEFAULT_TTL
+
+    try:
+        return float(ttl)
+    except ValueError:
+        raise ValueError(f"Invalid ANNOTATIONS_CACHE_TTL value: '{ttl}'. Expecting a number of seconds.")
+
+
+def _bind_arguments(func, args, kwargs):
+    """Returns a dictionary that maps each parameter name of func to its value in this call, including parameters that
+    weren't passed explicitly and so have their default values. This way, calls like get_x(), get_x(1) and get_x(a=1)
+    all produce the same dictionary when a defaults to 1.
+    """
+    bound_arguments = inspect.signature(func).bind(*args, **kwargs)
+    bound_arguments.apply_defaults()
+    return dict(bound_arguments.arguments)
+
+
+def _canonicalize(value):
+    """Converts the given value to a json-serializable form that doesn't depend on dict or set ordering"""
+    if isinstance(value, dict):
+        items = [(_canonicalize(k), _canonicalize(v)) for k, v in value.items()]
+        return sorted(items, key=lambda item: json.dumps(item[0], sort_keys=True))
+    elif isinstance(value, (set, frozenset)):
+        return sorted((_canonicalize(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    elif isinstance(value, (list, tuple)):
+        return [_canonicalize(v) for v in value]
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    else:
+        return repr(value)
+
+
+def _get_cache_key(func, args, kwargs, version=None):
+    """Returns the 10-character hash that identifies the cache file for this function call. It's computed from the
+    function name, the version tag (if any), and the values of all function parameters, so it's the same regardless of
+    whether args are passed positionally, by keyword, or left at their default values.
+    """
+    key = {"function": func.__name__, "args": _canonicalize(_bind_arguments(func, args, kwargs))}
+    if version is not None:
+        key["version"] = _canonicalize(version)
+
+    h = hashlib.sha256(json.dumps(key, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+    return h[:10]
+
+
+def _get_cache_file_prefix(cache_dir, function_name, cache_key):
+    """Returns the path of the cache file for this function call, without the file extension"""
+    filename = re.sub("^get_", "", function_name) + f".{cache_key}"
+    return os.path.join(cache_dir, filename)
+
+
+def _is_fresh(cache_file_path, ttl):
+    """Returns True if the given cache file exists and is less than ttl seconds old"""
+    return cache_file_path is not None and os.path.isfile(cache_file_path) and \
+        os.path.getmtime(cache_file_path) > time.time() - ttl
+
+
+@contextlib.contextmanager
+def _file_lock(lock_file_path, timeout=DEFAULT_LOCK_TIMEOUT):
+    """Context manager that holds an exclusive lock on the given lock file, so that only one process (or thread) at a
+    time can retrieve and save the data for a given cache entry. It yields True if the lock was acquired, or False if
+    it couldn't be acquired within the timeout, in which case callers can proceed without the lock since cache files
+    are written atomically.
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    start_time = time.time()
+    while True:
+        fd = os.open(lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            is_locked = True
+        except BlockingIOError:
+            is_locked = False
+
+        if is_locked and not _is_same_file(fd, lock_file_path):
+            # evict_cache_entries(..) deleted the lock file while this process was waiting for it, so another process
+            # may already hold a lock on a new file at this path
+            os.close(fd)
+            continue
+        if is_locked or (timeout is not None and time.time() - start_time >= timeout):
+            break
+        os.close(fd)
+        time.sleep(0.5)
+
+    try:
+        yield is_locked
+    finally:
+        os.close(fd)  # closing the file descriptor also releases the lock
+
+
+def _is_same_file(fd, path):
+    """Returns True if the open file descriptor refers to the file that's currently at the given path"""
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+
+    fd_stat = os.fstat(fd)
+    return (fd_stat.st_dev, fd_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino)
+
+
+@contextlib.contextmanager
+def _atomic_write(cache_file_path):
+    """Context manager that yields a temporary file path in the cache dir, and then renames the temporary file to
+    cache_file_path once it has been written successfully. This way, other processes never see a partially written
+    cache file.
+    """
+    fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(cache_file_path), prefix=".tmp.")
+    os.close(fd)
+    try:
+        yield temp_file_path
+        os.chmod(temp_file_path, 0o644)
+        os.replace(temp_file_path, cache_file_path)
+    finally:
+        if os.path.isfile(temp_file_path):
+            os.remove(temp_file_path)
+
+
+def _read_metadata(cache_file_prefix):
+    """Returns the dictionary stored in the metadata file next to the cache file, or {} if it doesn't exist"""
+    metadata_path = f"{cache_file_prefix}.meta.json"
+    try:
+        with open(metadata_path, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(cache_file_prefix, metadata):
+    with _atomic_write(f"{cache_file_prefix}.meta.json") as temp_file_path:
+        with open(temp_file_path, "wt") as f:
+            json.dump(metadata, f)
+
+
+def _record_cache_hit(cache_file_prefix):
+    """Updates the hit count and last access time in the metadata file of a cache entry that was read from disk"""
+    metadata = _read_metadata(cache_file_prefix)
+    metadata["hits"] = metadata.get("hits", 0) + 1
+    metadata["last_access"] = time.time()
+    try:
+        _write_metadata(cache_file_prefix, metadata)
+    except OSError as e:
+        # the cache dir may be shared and read-only for this user
+        print(f"WARNING: unable to update {cache_file_prefix}.meta.json: {e}")
+
+
+def _format_args(func, args, kwargs):
+    """Returns a string representation of the function call args that's stored in the metadata file"""
+    return ", ".join(f"{key}={value!r}" for key, value in _bind_arguments(func, args, kwargs).items())
+
+
+def _check_source_url(url, metadata):
+    """Sends a conditional GET request for the given url using the ETag and Last-Modified values stored in the
+    metadata (if any), and closes the connection without downloading the response body.
+
+    Args:
+        url (str): the url of the source file that the cached data was derived from
+        metadata (dict): metadata of the existing cache file
+
+    Return:
+        2-tuple: (is_unchanged, validators) where is_unchanged is True if the server indicated that the source hasn't
+            changed since the cache file was created, and validators is a dictionary with the current "etag" and
+            "last_modified" values for the url.
+    """
+    import requests
+
+    headers = {}
+    if metadata.get("etag"):
+        headers["If-None-Match"] = metadata["etag"]
+    if metadata.get("last_modified"):
+        headers["If-Modified-Since"] = metadata["last_modified"]
+
+    try:
+        with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+            validators = {
+                "etag": r.headers.get("ETag") or (metadata.get("etag") if r.status_code == 304 else None),
+                "last_modified": r.headers.get("Last-Modified") or (
+                    metadata.get("last_modified") if r.status_code == 304 else None),
+            }
+
+            if not headers or not r.ok:
+                return False, validators
+
+            # some servers ignore conditional headers, so also compare the validators directly
+            if validators["etag"]:
+                is_unchanged = r.status_code == 304 or validators["etag"] == metadata.get("etag")
+            else:
+                is_unchanged = r.status_code == 304 or (
+                    validators["last_modified"] is not None and validators["last_modified"] == metadata.get("last_modified"))
+
+            return is_unchanged, validators
+    except requests.RequestException as e:
+        print(f"WARNING: unable to check whether {url} has changed: {e}")
+        return False, {}
+
+
+class _TableStorage:
+    """Reads and writes cache files for cache_data_table"""
+
+    def __init__(self, table_format):
+        if table_format not in TABLE_FORMATS:
+            raise ValueError(f"Invalid table format: {table_format}. Expecting one of: {', '.join(TABLE_FORMATS)}")
+
+        self.table_format = table_format if table_format == "tsv" or pyarrow is not None else "tsv"
+
+    def find_cache_file(self, cache_file_prefix):
+        """Returns the path of an existing cache file, or None. Tables that were previously saved as tsv (either
+        because pyarrow wasn't available, or because a table couldn't be converted) are used as a fallback.
+        """
+        for table_format in dict.fromkeys([self.table_format, "tsv"]):
+            cache_file_path = cache_file_prefix + TABLE_FORMATS[table_format]
+            if os.path.isfile(cache_file_path):
+                return cache_file_path
+
+        return None
+
+    def read(self, cache_file_path, columns=None):
+        if cache_file_path.endswith(TABLE_FORMATS["parquet"]):
+            return pd.read_parquet(cache_file_path, columns=columns)
+        elif cache_file_path.endswith(TABLE_FORMATS["feather"]):
+            return pd.read_feather(cache_file_path, columns=columns)
+        else:
+            return pd.read_table(cache_file_path, usecols=columns)
+
+    def write(self, df, cache_file_prefix):
+        """Saves the table to the cache, and returns the object that should be returned to callers"""
+        try:
+            self._write(df, cache_file_prefix, self.table_format)
+        except Exception as e:
+            # columns with mixed python types can't be converted to an arrow schema
+            print(f"WARNING: unable to save {os.path.basename(cache_file_prefix)} as {self.table_format}. "
+                  f"Saving as tsv instead: {e}")
+            self._write(df, cache_file_prefix, "tsv")
+
+        return df
+
+    def _write(self, df, cache_file_prefix, table_format):
+        with _atomic_write(cache_file_prefix + TABLE_FORMATS[table_format]) as temp_file_path:
+            if table_format == "parquet":
+                df.to_parquet(temp_file_path, index=False)
+            elif table_format == "feather":
+                df.reset_index(drop=True).to_feather(temp_file_path)
+            else:
+                df.to_csv(temp_file_path, header=True, index=False, sep="\t", compression="gzip")
+
+    def select(self, df, columns=None):
+        return df[columns] if columns is not None else df
+
+    def to_memory(self, df):
+        """Returns a (value, size in bytes) tuple to store in the in-memory cache"""
+        return df.copy(), df.memory_usage(deep=True).sum()
+
+    def from_memory(self, df, columns=None):
+        """Return a copy of a table held in the in-memory cache, so that callers can modify it without affecting
+        the cached version. Copying the column arrays is much faster than re-reading the table from disk.
+        """
+        return self.select(df, columns=columns).copy()
+
+
+def _resolve_json_serializer(serializer):
+    if serializer not in JSON_SERIALIZERS:
+        raise ValueError(f"Invalid serializer: {serializer}. Expecting one of: {', '.join(JSON_SERIALIZERS)}")
+
+    if (serializer == "orjson" and orjson is None) or (serializer == "msgpack" and msgpack is None):
+        return "json"
+
+    return serializer
+
+
+def _dumps(json_data, serializer):
+    """Serializes the given json data to bytes"""
+    if serializer == "msgpack":
+        return msgpack.packb(json_data, use_bin_type=True)
+
+    if serializer == "orjson":
+        try:
+            return orjson.dumps(json_data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # fall back on the json module which supports more types (eg. dict keys that are tuples)
+
+    return json.dumps(json_data, separators=(",", ":")).encode()
+
+
+def _loads(data, serializer):
+    """Deserializes json data that was serialized by _dumps"""
+    if serializer == "msgpack":
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    elif serializer == "orjson":
+        return orjson.loads(data)
+    else:
+        return json.loads(data)
+
+
+class LazyJsonMapping(collections.abc.Mapping):
+    """Read-only dictionary backed by an sqlite file in the cache dir. Values are deserialized on each lookup, so
+    looking up one key doesn't require loading the whole dictionary into memory. Returned by functions decorated with
+    @cache_json(lazy=True).
+    """
 
+    def __init__(self, sqlite_path):
+        self._sqlite_path = sqlite_path
+        self._conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._serializer = _resolve_json_serializer(self._query_one("SELECT value FROM metadata WHERE key='serializer'"))
 
-def cache_data_table(get_table_func):
+    def _query_one(self, query, params=()):
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+    def __getitem__(self, key):
+        value = self._query_one("SELECT value FROM entries WHERE key=?", (str(key),))
+        if value is None:
+            raise KeyError(key)
+        return _loads(value, self._serializer)
+
+    def __contains__(self, key):
+        return self._query_one("SELECT 1 FROM entries WHERE key=?", (str(key),)) is not None
+
+    def __iter__(self):
+        with self._lock:
+            keys = [row[0] for row in self._conn.execute("SELECT key FROM entries ORDER BY rowid")]
+        return iter(keys)
+
+    def __len__(self):
+        return self._query_one("SELECT COUNT(*) FROM entries")
+
+    def __repr__(self):
+        return f"LazyJsonMapping({self._sqlite_path!r})"
+
+
+class _JsonStorage:
+    """Reads and writes cache files for cache_json"""
+
+    def __init__(self, serializer, lazy):
+        self.serializer = _resolve_json_serializer(serializer)
+        self.lazy = lazy
+        self.file_extension = ".sqlite" if lazy else JSON_SERIALIZERS[self.serializer]
+
+    def find_cache_file(self, cache_file_prefix):
+        """Returns the path of an existing cache file, or None. Cache files that were previously saved as json are
+        used as a fallback.
+        """
+        file_extensions = [self.file_extension] if self.lazy else dict.fromkeys([self.file_extension, ".json.gz"])
+        for file_extension in file_extensions:
+            cache_file_path = f"{cache_file_prefix}{file_extension}"
+            if os.path.isfile(cache_file_path):
+                return cache_file_path
+
+        return None
+
+    def read(self, cache_file_path):
+        if self.lazy:
+            return LazyJsonMapping(cache_file_path)
+
+        if cache_file_path.endswith(JSON_SERIALIZERS["msgpack"]):
+            serializer = "msgpack"
+        elif self.serializer == "orjson":
+            serializer = "orjson"
+        else:
+            # json.load(..) can decode the text stream without first reading the whole file into a bytes object
+            with gzip.open(cache_file_path, "rt") as f:
+                return json.load(f)
+
+        with gzip.open(cache_file_path, "rb") as f:
+            return _loads(f.read(), serializer)
+
+    def write(self, json_data, cache_file_prefix):
+        """Saves json_data to the cache, and returns the object that should be returned to callers"""
+        cache_file_path = f"{cache_file_prefix}{self.file_extension}"
+        if not self.lazy:
+            with _atomic_write(cache_file_path) as temp_file_path:
+                with gzip.open(temp_file_path, "wb") as f:
+                    f.write(_dumps(json_data, self.serializer))
+            return json_data
+
+        if not isinstance(json_data, dict):
+            raise ValueError(f"cache_json(lazy=True) requires a dict, but got a {type(json_data).__name__}")
+
+        with _atomic_write(cache_file_path) as temp_file_path:
+            with contextlib.closing(sqlite3.connect(temp_file_path)) as conn:
+                conn.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value BLOB)")
+                conn.execute("INSERT INTO metadata VALUES ('serializer', ?)", (self.serializer,))
+                conn.executemany("INSERT INTO entries VALUES (?, ?)", (
+                    (str(key), _dumps(value, self.serializer)) for key, value in json_data.items()))
+                conn.commit()
+
+        return LazyJsonMapping(cache_file_path)
+
+    def select(self, json_data):
+        return json_data
+
+    def to_memory(self, json_data):
+        """Returns a (value, size in bytes) tuple to store in the in-memory cache. The value is pickled so that
+        callers can't modify the cached object. LazyJsonMappings are read-only, so they are stored as is.
+        """
+        if isinstance(json_data, LazyJsonMapping):
+            return json_data, 0
+
+        pickled_json_data = pickle.dumps(json_data, protocol=pickle.HIGHEST_PROTOCOL)
+        return pickled_json_data, len(pickled_json_data)
+
+    def from_memory(self, value):
+        if isinstance(value, LazyJsonMapping):
+            return value
+
+        return pickle.loads(value)
+
+
+def _refresh_cache_entry(get_data_func, args, kwargs, storage, cache_file_prefix, ttl, lock_timeout, source_url):
+    """Calls the underlying function and saves its result to the cache, unless another process already refreshed the
+    cache entry while this process was waiting for the lock, or the source url hasn't changed since the cache file was
+    created.
+
+    Return:
+        2-tuple: (data, cache_file_path) where data is the new result, or None if the existing cache file is still valid
+    """
+
+    # only one process at a time retrieves the data. Others wait, and then read the file it saved.
+    with _file_lock(f"{cache_file_prefix}.lock", timeout=lock_timeout) as is_locked:
+        if not is_locked:
+            print(f"WARNING: timed out after {lock_timeout} seconds while waiting for {cache_file_prefix}.lock. "
+                  f"Proceeding without the lock.")
+
+        cache_file_path = storage.find_cache_file(cache_file_prefix)
+        if _is_fresh(cache_file_path, ttl):
+            return None, cache_file_path
+
+        # if the data came from a url that hasn't changed since the cache file was created, just mark the
+        # existing cache file as fresh
+        metadata = _read_metadata(cache_file_prefix)
+        url = source_url(*args, **kwargs) if callable(source_url) else source_url
+        is_unchanged, validators = _check_source_url(url, metadata if cache_file_path else {}) if url else (False, {})
+        if cache_file_path is not None and is_unchanged:
+            os.utime(cache_file_path)
+            return None, cache_file_path
+
+        # call the underlying function and save the result to the cache
+        data = get_data_func(*args, **kwargs)
+        data = storage.write(data, cache_file_prefix)
+        metadata.update(validators)
+        metadata.update({
+            "function": get_data_func.__name__,
+            "args": _format_args(get_data_func, args, kwargs),
+            "created": time.time(),
+            "last_access": time.time(),
+            "hits": 0,
+        })
+        _write_metadata(cache_file_prefix, metadata)
+
+        return data, storage.find_cache_file(cache_file_prefix)
+
+
+_background_refresh_lock = threading.Lock()
+_background_refresh_keys = set()
+
+
+def _start_background_refresh(get_data_func, args, kwargs, storage, cache_file_prefix, ttl, lock_timeout, source_url,
+                              memory_cache, cache_key):
+    """Refreshes the cache entry in a background thread, unless it's already being refreshed by this process"""
+
+    function_name = get_data_func.__name__
+    with _background_refresh_lock:
+        if (function_name, cache_key) in _background_refresh_keys:
+            return
+        _background_refresh_keys.add((function_name, cache_key))
+
+    def refresh():
+        try:
+            data, cache_file_path = _refresh_cache_entry(
+                get_data_func, args, kwargs, storage, cache_file_prefix, ttl, lock_timeout, source_url)
+            if memory_cache:
+                if data is None:
+                    data = storage.read(cache_file_path)
+                _memory_cache.put(function_name, cache_key, *_to_memory(storage, data, cache_file_path))
+        except Exception as e:
+            print(f"WARNING: unable to refresh {os.path.basename(cache_file_prefix)} in the background: {e}")
+        finally:
+            with _background_refresh_lock:
+                _background_refresh_keys.discard((function_name, cache_key))
+
+    # this isn't a daemon thread, so that short-lived scripts still finish the refresh before exiting
+    threading.Thread(target=refresh, name=f"refresh {function_name}").start()
+
+
+def _to_memory(storage, data, cache_file_path):
+    """Returns a ((timestamp, value), size) tuple to store in the in-memory cache, where timestamp is the time when
+    the cache file was created or last refreshed
+    """
+    value, size = storage.to_memory(data)
+    return (os.path.getmtime(cache_file_path), value), size
+
+
+def _call_with_cache(get_data_func, args, kwargs, storage, read_kwargs, memory_cache, ttl, cache_dir, lock_timeout,
+                     source_url, stale_while_revalidate, max_staleness, version):
+    """Implements the caching logic shared by cache_data_table and cache_json"""
+
+    # create cache dir
+    cache_dir = cache_dir or get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    ttl = ttl if ttl is not None else get_default_ttl()
+    max_staleness = max_staleness if max_staleness is not None else DEFAULT_MAX_STALENESS
+
+    function_name = get_data_func.__name__
+    cache_key = _get_cache_key(get_data_func, args, kwargs, version=version)
+    cache_file_prefix = _get_cache_file_prefix(cache_dir, function_name, cache_key)
+    refresh_args = (get_data_func, args, kwargs, storage, cache_file_prefix, ttl, lock_timeout, source_url)
+
+    # check if the result is already in memory
+    if memory_cache:
+        entry = _memory_cache.get(function_name, cache_key)
+        if entry is not None:
+            timestamp, value = entry
+            age = time.time() - timestamp
+            if age < ttl:
+                return storage.from_memory(value, **read_kwargs)
+            if stale_while_revalidate and age < ttl + max_staleness:
+                _start_background_refresh(*refresh_args, memory_cache, cache_key)
+                return storage.from_memory(value, **read_kwargs)
+
+    # check if the result is in the cache dir
+    cache_file_path = storage.find_cache_file(cache_file_prefix)
+    if not _is_fresh(cache_file_path, ttl):
+        if stale_while_revalidate and _is_fresh(cache_file_path, ttl + max_staleness):
+            # return the expired cache file and refresh it in the background
+            _start_background_refresh(*refresh_args, memory_cache, cache_key)
+        else:
+            data, cache_file_path = _refresh_cache_entry(*refresh_args)
+            if data is not None:
+                if memory_cache:
+                    _memory_cache.put(function_name, cache_key, *_to_memory(storage, data, cache_file_path))
+
+                return storage.select(data, **read_kwargs)
+
+    data = storage.read(cache_file_path, **read_kwargs)
+    _record_cache_hit(cache_file_prefix)
+    if memory_cache and not read_kwargs:
+        _memory_cache.put(function_name, cache_key, *_to_memory(storage, data, cache_file_path))
+
+    return data
+
+
+def _add_cache_management_functions(wrapper, function_name):
+    """Attach functools-style cache_clear() and cache_info() methods to the given wrapper function"""
+    wrapper.cache_clear = lambda: _memory_cache.clear(function_name)
+    wrapper.cache_info = lambda: _memory_cache.info(function_name)
+
+
+def cache_data_table(get_table_func=None, format=DEFAULT_TABLE_FORMAT, memory_cache=True,
+                     lock_timeout=DEFAULT_LOCK_TIMEOUT, ttl=None, cache_dir=None, source_url=None,
+                     stale_while_revalidate=False, max_staleness=None, version=None):
     """Decorator that caches the pandas DataFrame returned by the decorated function.
     It's intended for functions that take a relatively long time to retrieve some table over the network.
     Before calling the decorated function, the decorator checks whether result already exists in the
     cache dir (~/.annotations). If yes, it just reads the table from disk and returns it.
     If no, it calls the function and then saves the result table to ~/.annotations before returning it.
-    """
 
-    def wrapper(*args, **kwargs):
-        # create cache dir
-        if not os.path.isdir(CACHE_DIR):
-            os.mkdir(CACHE_DIR)
+    It can be used either as @cache_data_table or as @cache_data_table(format="tsv").
 
-        # check if cached file already exists
-        function_name = get_table_func.__name__
-        h = hashlib.sha256(f"{function_name} {args} {frozenset(sorted(kwargs.items()))}".encode()).hexdigest()
-        h = h[:10]
-        filename = re.sub("^get_", "", function_name) + f".{h}.tsv.gz"
-        cache_file_path = os.path.join(CACHE_DIR, filename)
+    Args:
+        format (str): storage format for the cached table - one of "parquet", "feather", or "tsv". Parquet and feather
+            preserve column dtypes exactly. If pyarrow isn't installed, the table is stored as a gzipped tsv instead.
+        memory_cache (bool): if True, also keep recently used tables in memory, so that repeated calls return
+            a copy of the in-memory table instead of re-reading it from disk. Use the cache_clear() and cache_info()
+            methods of the decorated function to manage this in-memory cache.
+        lock_timeout (float): when several processes call the decorated function with the same args at the same time,
+            only one of them calls the underlying function while the others wait up to this many seconds for it to
+            finish, and then read the table it saved.
+        ttl (float): number of seconds that a cache file stays fresh. Defaults to the ANNOTATIONS_CACHE_TTL env.
+            variable, or 1 week.
+        cache_dir (str): directory for cache files. Defaults to the ANNOTATIONS_CACHE_DIR env. variable,
+            or ~/.annotations.
+        source_url (str or function): url of the file that the table is derived from, or a function that takes the
+            same args as the decorated function and returns this url. If specified, the ETag and Last-Modified headers
+            of the url are stored next to the cache file, and when the cache file expires, it's only re-created if the
+            server indicates that the url contents have changed.
+        stale_while_revalidate (bool): if True, a cache file that expired less than max_staleness seconds ago is
+            returned immediately, and refreshed in a background thread for subsequent calls.
+        max_staleness (float): how many seconds past its ttl an expired cache file can still be returned when
+            stale_while_revalidate is enabled. After that, callers wait for the refresh. Defaults to 1 week.
+        version (str): optional version tag that's included in the cache key. Changing it (eg. after changing how the
+            decorated function parses its source data) makes the decorator ignore cache files created by older versions.
 
-        # use the cached file if it's less than 1 week old
-        if os.path.isfile(cache_file_path) and os.path.getmtime(cache_file_path) > time.time() - 7 * 24 * 60 * 60:
-            return pd.read_table(cache_file_path)
+    The decorated function also accepts an optional columns=[...] keyword arg which isn't passed to the underlying
+    function, but instead limits which columns are read from the cache and returned.
+    """
 
-        # call the underlying function
-        df = get_table_func(*args, **kwargs)
+    def decorator(get_table_func):
+        storage = _TableStorage(format)
 
-        # save result to cache
-        df.to_csv(cache_file_path, header=True, index=False, sep="\t")
+        @functools.wraps(get_table_func)
+        def wrapper(*args, columns=None, **kwargs):
+            read_kwargs = {"columns": columns} if columns is not None else {}
+            return _call_with_cache(
+                get_table_func, args, kwargs, storage, read_kwargs, memory_cache=memory_cache, ttl=ttl,
+                cache_dir=cache_dir, lock_timeout=lock_timeout, source_url=source_url,
+                stale_while_revalidate=stale_while_revalidate, max_staleness=max_staleness, version=version)
 
-        return df
+        _add_cache_management_functions(wrapper, get_table_func.__name__)
+        return wrapper
+
+    if get_table_func is not None:
+        return decorator(get_table_func)
 
-    return wrapper
+    return decorator
 
 
-def cache_json(get_json_func):
+def cache_json(get_json_func=None, memory_cache=True, lock_timeout=DEFAULT_LOCK_TIMEOUT, ttl=None, cache_dir=None,
+               source_url=None, stale_while_revalidate=False, max_staleness=None, serializer=DEFAULT_JSON_SERIALIZER,
+               lazy=False, version=None):
     """Decorator that caches the json returned by the decorated function.
     It's intended for functions that take a relatively long time to retrieve some json over the network.
     Before calling the decorated function, the decorator checks whether result already exists in the
     cache dir (~/.annotations). If yes, it just reads the json from disk and returns it.
     If no, it calls the function and then saves the result json to ~/.annotations before returning it.
+
+    It can be used either as @cache_json or as @cache_json(memory_cache=False).
+
+    Args:
+        serializer (str): "orjson", "json", or "msgpack". The json is stored without indentation, and is serialized
+            with the orjson or msgpack package if it's installed, or the stdlib json module otherwise.
+        lazy (bool): if True, the decorated function must return a dict, and the decorator returns a read-only
+            LazyJsonMapping backed by an sqlite file in the cache dir. Values are loaded on lookup, so looking up a few
+            keys (eg. one MONDO id) doesn't require loading the whole dictionary into memory. Since each lookup
+            returns a new object, changes to looked-up values are not saved.
+        memory_cache (bool): if True, also keep recently used results in memory (in pickled form), so that repeated
+            calls return a fresh copy without re-reading and re-parsing the json file. Use the cache_clear() and
+            cache_info() methods of the decorated function to manage this in-memory cache.
+        lock_timeout (float): when several processes call the decorated function with the same args at the same time,
+            only one of them calls the underlying function while the others wait up to this many seconds for it to
+            finish, and then read the json it saved.
+        ttl (float): number of seconds that a cache file stays fresh. Defaults to the ANNOTATIONS_CACHE_TTL env.
+            variable, or 1 week.
+        cache_dir (str): directory for cache files. Defaults to the ANNOTATIONS_CACHE_DIR env. variable,
+            or ~/.annotations.
+        source_url (str or function): url of the file that the json is derived from, or a function that takes the
+            same args as the decorated function and returns this url. If specified, the ETag and Last-Modified headers
+            of the url are stored next to the cache file, and when the cache file expires, it's only re-created if the
+            server indicates that the url contents have changed.
+        stale_while_revalidate (bool): if True, a cache file that expired less than max_staleness seconds ago is
+            returned immediately, and refreshed in a background thread for subsequent calls.
+        max_staleness (float): how many seconds past its ttl an expired cache file can still be returned when
+            stale_while_revalidate is enabled. After that, callers wait for the refresh. Defaults to 1 week.
+        version (str): optional version tag that's included in the cache key. Changing it (eg. after changing how the
+            decorated function parses its source data) makes the decorator ignore cache files created by older versions.
     """
-    
-    def wrapper(*args, **kwargs):
-        # create cache dir
-        if not os.path.isdir(CACHE_DIR):
-            os.mkdir(CACHE_DIR)
-
-        # check if cached file already exists
-        function_name = get_json_func.__name__
-        h = hashlib.sha256(f"{function_name} {args} {frozenset(sorted(kwargs.items()))}".encode()).hexdigest()
-        h = h[:10]
-        filename = re.sub("^get_", "", function_name) + f".{h}.json.gz"
-        cache_file_path = os.path.join(CACHE_DIR, filename)
-
-        # use the cached file if it's less than 1 week old
-        if os.path.isfile(cache_file_path) and os.path.getmtime(cache_file_path) > time.time() - 7 * 24 * 60 * 60:
-            return json.load(gzip.open(cache_file_path, "rt"))
-
-        # call the underlying function
-        json_data = get_json_func(*args, **kwargs)
-
-        # save result to cache
-        with gzip.open(cache_file_path, "wt") as f:
-            json.dump(json_data, f, indent=2)
 
-        return json_data
+    def decorator(get_json_func):
+        storage = _JsonStorage(serializer, lazy)
+
+        @functools.wraps(get_json_func)
+        def wrapper(*args, **kwargs):
+            return _call_with_cache(
+                get_json_func, args, kwargs, storage, {}, memory_cache=memory_cache, ttl=ttl,
+                cache_dir=cache_dir, lock_timeout=lock_timeout, source_url=source_url,
+                stale_while_revalidate=stale_while_revalidate, max_staleness=max_staleness, version=version)
+
+        _add_cache_management_functions(wrapper, get_json_func.__name__)
+        return wrapper
+
+    if get_json_func is not None:
+        return decorator(get_json_func)
+
+    return decorator
+
+
+def _parse_size(size):
+    """Converts a size string like "500M" or "10G" to a number of bytes"""
+    match = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)B?", size.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: '{size}'. Expecting a number followed by an optional K, M, G, or T suffix.")
+
+    number, suffix = match.groups()
+    return int(float(number) * 1024**("KMGT".index(suffix) + 1 if suffix else 0))
+
+
+def list_cache_entries(cache_dir=None):
+    """Returns a list of all entries in the cache dir.
+
+    Args:
+        cache_dir (str): cache directory. Defaults to the ANNOTATIONS_CACHE_DIR env. variable, or ~/.annotations.
+
+    Return:
+        list: one dictionary per cache entry, with the following keys:
+            - name: the cache file name without the file extension (eg. "hgnc_table.a1b2c3d4e5")
+            - function: the name of the function that produced the entry (if recorded)
+            - args: the args of the function call (if recorded)
+            - paths: the paths of all files that belong to this entry, including the metadata file
+            - size: the total size of these files in bytes
+            - created: the timestamp when the data was last refreshed
+            - last_access: the timestamp when the entry was last read from disk
+            - hits: how many times the entry was read from disk since it was created
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return []
+
+    paths_by_name = collections.defaultdict(list)
+    for filename in os.listdir(cache_dir):
+        match = re.fullmatch(r"(.+\.[0-9a-f]{10})\.(.+)", filename)
+        # lock files aren't part of an entry, and can be left behind without an entry if a process was interrupted
+        if not match or match.group(2) == "lock" or filename.startswith(".tmp."):
+            continue
+        paths_by_name[match.group(1)].append(os.path.join(cache_dir, filename))
+
+    entries = []
+    for name, paths in sorted(paths_by_name.items()):
+        metadata = _read_metadata(os.path.join(cache_dir, name))
+        data_file_mtimes = [os.path.getmtime(path) for path in paths if not path.endswith(".meta.json")]
+        if not data_file_mtimes:
+            # only a metadata file is left over
+            data_file_mtimes = [os.path.getmtime(path) for path in paths]
+
+        entries.append({
+            "name": name,
+            "function": metadata.get("function", ""),
+            "args": metadata.get("args", ""),
+            "paths": sorted(paths),
+            "size": sum(os.path.getsize(path) for path in paths),
+            "created": max(data_file_mtimes),
+            "last_access": metadata.get("last_access", max(data_file_mtimes)),
+            "hits": metadata.get("hits", 0),
+        })
+
+    return entries
+
+
+def evict_cache_entries(cache_dir=None, max_total_bytes=None, max_versions_per_function=None, max_age=None,
+                        dry_run=False):
+    """Deletes cache entries according to the given policies. Entries are always evicted in least-recently-used order.
+    Entries that are currently being refreshed by another process are skipped.
+
+    Args:
+        cache_dir (str): cache directory. Defaults to the ANNOTATIONS_CACHE_DIR env. variable, or ~/.annotations.
+        max_total_bytes (int): if specified, evict entries until the total size of the cache dir is below this limit.
+        max_versions_per_function (int): if specified, keep at most this many entries (eg. for different args) for
+            each function.
+        max_age (float): if specified, evict entries that haven't been accessed for this many seconds.
+        dry_run (bool): if True, return the entries that would be evicted without deleting anything.
+
+    Return:
+        list: the evicted entries, in the same format as returned by list_cache_entries(..)
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    entries = sorted(list_cache_entries(cache_dir), key=lambda entry: entry["last_access"], reverse=True)
+
+    evicted_names = set()
+    if max_age is not None:
+        evicted_names.update(entry["name"] for entry in entries if entry["last_access"] < time.time() - max_age)
+
+    if max_versions_per_function is not None:
+        version_counter = collections.Counter()
+        for entry in entries:
+            function_name = entry["function"] or entry["name"].rsplit(".", 1)[0]
+            version_counter[function_name] += 1
+            if version_counter[function_name] > max_versions_per_function:
+                evicted_names.add(entry["name"])
+
+    if max_total_bytes is not None:
+        total_bytes = sum(entry["size"] for entry in entries if entry["name"] not in evicted_names)
+        for entry in reversed(entries):
+            if total_bytes <= max_total_bytes:
+                break
+            if entry["name"] not in evicted_names:
+                evicted_names.add(entry["name"])
+                total_bytes -= entry["size"]
+
+    evicted_entries = []
+    for entry in reversed(entries):
+        if entry["name"] not in evicted_names:
+            continue
+
+        if not dry_run:
+            # hold the entry's lock while deleting its files so that this doesn't interfere with a refresh. The lock file
+            # itself can be deleted too, since _file_lock(..) checks that the file it locked is still at its path.
+            lock_file_path = os.path.join(cache_dir, f"{entry['name']}.lock")
+            with _file_lock(lock_file_path, timeout=0) as is_locked:
+                if not is_locked:
+                    print(f"WARNING: skipping {entry['name']} since it's being refreshed by another process")
+                    continue
+
+                for path in entry["paths"] + [lock_file_path]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+        evicted_entries.append(entry)
+
+    if dry_run:
+        return evicted_entries
+
+    # also delete temporary files that were left behind by processes that were interrupted while writing, and lock
+    # files of entries that no longer exist, unless another process is holding the lock
+    entry_names = {entry["name"] for entry in list_cache_entries(cache_dir)}
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        if filename.startswith(".tmp."):
+            if os.path.getmtime(path) < time.time() - 24 * 60 * 60:
+                os.remove(path)
+        elif filename.endswith(".lock") and filename[:-len(".lock")] not in entry_names:
+            with _file_lock(path, timeout=0) as is_locked:
+                if is_locked and os.path.isfile(path):
+                    os.remove(path)
+
+    return evicted_entries
+
+
+def _format_size(size):
+    for suffix in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {suffix}" if suffix != "B" else f"{size} B"
+        size /= 1024
+
+    return f"{size:.1f} TB"
+
+
+def _print_cache_entries(entries):
+    now = time.time()
+    for entry in entries:
+        age_in_days = (now - entry["created"]) / (24 * 60 * 60)
+        last_access_in_days = (now - entry["last_access"]) / (24 * 60 * 60)
+        print(f"{entry['name']:45s} {_format_size(entry['size']):>10s}   age: {age_in_days:5.1f} days   "
+              f"last used: {last_access_in_days:5.1f} days ago   hits: {entry['hits']:5,d}   "
+              f"{entry['function']}({entry['args']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or evict entries in the annotations cache dir")
+    parser.add_argument("--cache-dir", help="Defaults to the ANNOTATIONS_CACHE_DIR env. variable, or ~/.annotations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List cache entries")
+    evict_parser = subparsers.add_parser("evict", help="Delete cache entries in least-recently-used order")
+    evict_parser.add_argument("--max-size", help="Evict entries until the cache dir is smaller than this (eg. 10G)")
+    evict_parser.add_argument("--max-versions", type=int, help="Keep at most this many entries per function")
+    evict_parser.add_argument("--max-age-days", type=float, help="Evict entries not used for this many days")
+    evict_parser.add_argument("-n", "--dry-run", action="store_true", help="Only print what would be evicted")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        entries = list_cache_entries(args.cache_dir)
+        _print_cache_entries(entries)
+        print(f"{len(entries):,d} cache entries using {_format_size(sum(e['size'] for e in entries))} in "
+              f"{args.cache_dir or get_cache_dir()}")
+    elif args.command == "evict":
+        if args.max_size is None and args.max_versions is None and args.max_age_days is None:
+            evict_parser.error("At least one of --max-size, --max-versions, or --max-age-days must be specified")
+
+        evicted_entries = evict_cache_entries(
+            args.cache_dir,
+            max_total_bytes=_parse_size(args.max_size) if args.max_size else None,
+            max_versions_per_function=args.max_versions,
+            max_age=args.max_age_days * 24 * 60 * 60 if args.max_age_days is not None else None,
+            dry_run=args.dry_run)
+
+        _print_cache_entries(evicted_entries)
+        print(("Would evict" if args.dry_run else "Evicted") + f" {len(evicted_entries):,d} cache entries, freeing "
+              f"{_format_size(sum(e['size'] for e in evicted_entries))}")
+
 
-    return wrapper
\ No newline at end of file
+if __name__ == "__main__":
+    main()
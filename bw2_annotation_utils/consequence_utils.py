@@ -0,0 +1,161 @@
+"""Utilities for classifying Sequence Ontology consequence terms (eg. from Nirvana or VEP) using integer bitmasks.
+
+Each consequence term is assigned a small integer code, with codes ordered from most to least severe, so a set of
+consequences (eg. across all transcripts of a variant) can be represented as an int with one bit per term. Checking
+whether a variant has any consequence in a category (eg. loss-of-function) then becomes a bitwise AND, the most severe
+consequence is the lowest set bit, and functions that convert masks back to terms can be memoized since the number of
+distinct masks is small.
+
+Example:
+    LOF_MASK = get_consequence_mask(["stop_gained", "frameshift_variant", "splice_donor_variant"])
+    mask = get_consequence_mask(["missense_variant", "stop_gained"])
+    is_lof = bool(mask & LOF_MASK)
+"""
+
+import functools
+import threading
+
+import numpy as np
+
+# Consequence terms ordered from most to least severe, based on the Ensembl VEP ordering plus the additional terms
+# that Nirvana outputs for structural variants and repeat expansions.
+SO_CONSEQUENCE_TERMS = [
+    "transcript_ablation",
+    "splice_acceptor_variant",
+    "splice_donor_variant",
+    "stop_gained",
+    "frameshift_variant",
+    "stop_lost",
+    "start_lost",
+    "initiator_codon_variant",
+    "transcript_amplification",
+    "feature_elongation",
+    "feature_truncation",
+    "exon_loss_variant",
+    "inframe_insertion",
+    "inframe_deletion",
+    "missense_variant",
+    "protein_altering_variant",
+    "splice_donor_5th_base_variant",
+    "splice_region_variant",
+    "splice_donor_region_variant",
+    "splice_polypyrimidine_tract_variant",
+    "incomplete_terminal_codon_variant",
+    "start_retained_variant",
+    "stop_retained_variant",
+    "synonymous_variant",
+    "coding_sequence_variant",
+    "mature_miRNA_variant",
+    "5_prime_UTR_variant",
+    "3_prime_UTR_variant",
+    "non_coding_transcript_exon_variant",
+    "intron_variant",
+    "NMD_transcript_variant",
+    "non_coding_transcript_variant",
+    "coding_transcript_variant",
+    "upstream_gene_variant",
+    "downstream_gene_variant",
+    "TFBS_ablation",
+    "TFBS_amplification",
+    "TF_binding_site_variant",
+    "regulatory_region_ablation",
+    "regulatory_region_amplification",
+    "regulatory_region_variant",
+    "unidirectional_gene_fusion",
+    "bidirectional_gene_fusion",
+    "copy_number_increase",
+    "copy_number_decrease",
+    "copy_number_change",
+    "short_tandem_repeat_change",
+    "short_tandem_repeat_expansion",
+    "short_tandem_repeat_contraction",
+    "five_prime_duplicated_transcript",
+    "three_prime_duplicated_transcript",
+    "transcript_variant",
+    "intergenic_variant",
+    "sequence_variant",
+]
+
+_consequence_term_to_code = {term: i for i, term in enumerate(SO_CONSEQUENCE_TERMS)}
+_consequence_terms = list(SO_CONSEQUENCE_TERMS)
+_lock = threading.Lock()
+
+
+def get_consequence_code(term):
+    """Returns the integer code of the given consequence term. Terms that aren't in SO_CONSEQUENCE_TERMS are assigned
+    new codes (ranked as less severe than all known terms) the first time they're seen.
+    """
+    code = _consequence_term_to_code.get(term)
+    if code is None:
+        with _lock:
+            code = _consequence_term_to_code.get(term)
+            if code is None:
+                code = _consequence_term_to_code[term] = len(_consequence_terms)
+                _consequence_terms.append(term)
+
+    return code
+
+
+def get_consequence_term(code):
+    return _consequence_terms[code]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_consequence_mask(terms):
+    mask = 0
+    for term in terms:
+        mask |= 1 << get_consequence_code(term)
+    return mask
+
+
+def get_consequence_mask(terms):
+    """Returns the bitmask for the given iterable of consequence terms"""
+    return _get_consequence_mask(tuple(terms))
+
+
+@functools.lru_cache(maxsize=None)
+def get_consequence_codes(mask):
+    """Returns the tuple of consequence codes in the given mask, from most to least severe"""
+    codes = []
+    code = 0
+    while mask:
+        if mask & 1:
+            codes.append(code)
+        mask >>= 1
+        code += 1
+
+    return tuple(codes)
+
+
+@functools.lru_cache(maxsize=None)
+def get_consequence_terms(mask):
+    """Returns the tuple of consequence terms in the given mask, from most to least severe"""
+    return tuple(_consequence_terms[code] for code in get_consequence_codes(mask))
+
+
+def get_most_severe_consequence(mask):
+    """Returns the most severe consequence term in the given mask, or None if the mask is 0"""
+    if not mask:
+        return None
+
+    return _consequence_terms[(mask & -mask).bit_length() - 1]
+
+
+def to_mask_array(masks):
+    """Converts a list of masks to a numpy array. The array has dtype uint64 unless some consequence terms have codes
+    >= 64, in which case it has dtype object so that masks are kept as python ints.
+    """
+    if len(_consequence_terms) <= 64:
+        return np.array(masks, dtype=np.uint64)
+
+    return np.array(masks, dtype=object)
+
+
+def has_any_consequence(mask_array, category_mask):
+    """Returns a numpy bool array that's True for each mask in mask_array that has any of the consequences in
+    category_mask
+    """
+    if mask_array.dtype == object:
+        return np.array([bool(mask & category_mask) for mask in mask_array], dtype=bool)
+
+    return (mask_array & np.uint64(category_mask)) != 0
@@ -1,4 +1,4 @@
-from cache_utils import cache_json
+from bw2_annotation_utils.cache_utils import cache_json
 import collections
 import pymysql
 
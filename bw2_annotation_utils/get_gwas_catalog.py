@@ -9,7 +9,7 @@ from bw2_annotation_utils.get_mondo_ontology import get_mondo_ontology
 
 GWAS_CATALOG_URL = "https://www.ebi.ac.uk/gwas/api/search/downloads/alternative"
 
-@cache_data_table
+@cache_data_table(source_url=GWAS_CATALOG_URL)
 def _download_gwas_catalog():
     """
     Download the GWAS catalog and return it as a pandas DataFrame
@@ -1,8 +1,9 @@
-from cache_utils import cache_json
 import lxml.etree
 import os
 import requests
 
+from bw2_annotation_utils.cache_utils import cache_json
+
 MONDO_RARE_OWL_URL = "https://purl.obolibrary.org/obo/mondo/subsets/mondo-rare.owl"
 MONDO_OBO_URL = "https://purl.obolibrary.org/obo/mondo.obo"
 
@@ -32,7 +33,7 @@ def get_mondo_rare_disease_terms(mondo_rare_owl_file_path):
     
     return mondo_rare_disease_terms  # Example: MONDO:0958331
 
-@cache_json
+@cache_json(source_url=MONDO_OBO_URL)
 def download_mondo_obo_file():
     """    
     Parse the mondo.obo file and return a dictionary that maps mondo ids to a record containing the following fields:
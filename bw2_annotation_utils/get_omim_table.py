@@ -1,5 +1,5 @@
 import base64
-from cache_utils import cache_data_table
+from bw2_annotation_utils.cache_utils import cache_data_table
 import datetime
 import json
 import pandas as pd
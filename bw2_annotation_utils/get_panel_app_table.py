@@ -6,7 +6,7 @@ from bw2_annotation_utils.cache_utils import cache_data_table
 URL_UK_PANEL_APP = "https://panelapp.genomicsengland.co.uk/api/v1/genes/"
 URL_AUSTRALIA_PANEL_APP = "https://panelapp-aus.org/api/v1/genes/"
 
-@cache_data_table
+@cache_data_table(stale_while_revalidate=True)
 def get_panel_app_table():
     """Download the PANEL app table from https://www.genenames.org/download/custom/ and return it as a pandas DataFrame"""
     rows = []
@@ -0,0 +1,241 @@
+"""Precomputed gene, transcript and exon summary tables derived from a gtf file (eg. a GENCODE release).
+
+build_gtf_summary_tables(..) parses the gtf once and writes a bundle of 3 parquet files into a directory keyed on the
+gtf file's checksum and on whether MANE columns are included, so the bundle is rebuilt automatically if the gtf
+changes. load_gtf_summary_tables(..) returns the
+tables, building the bundle first if needed.
+
+Example:
+    tables = load_gtf_summary_tables("gencode.v46.annotation.gtf.gz")
+    mane_select_exons = tables.exons[tables.exons["transcript_id"].isin(
+        tables.transcripts.loc[tables.transcripts["is_mane_select"], "transcript_id"])]
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import pandas as pd
+
+from bw2_annotation_utils.cache_utils import get_cache_dir
+from bw2_annotation_utils.get_MANE_table import get_MANE_ensembl_transcript_table
+from bw2_annotation_utils.gtf_utils import read_gtf_table
+
+GTF_SUMMARY_TABLES_VERSION = 1
+
+GTF_SUMMARY_TABLE_NAMES = ("genes", "transcripts", "exons")
+
+GTF_CHECKSUMS_FILENAME = "gtf_checksums.json"
+
+GTF_SUMMARY_ATTRIBUTES = ["gene_id", "gene_name", "gene_type", "transcript_id", "transcript_type", "exon_number", "tag"]
+
+GtfSummaryTables = collections.namedtuple("GtfSummaryTables", GTF_SUMMARY_TABLE_NAMES)
+
+
+def _get_file_checksum(path, chunk_size=2**20):
+    """Returns the first 16 characters of the file's sha256 hex digest"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    return h.hexdigest()[:16]
+
+
+def _get_gtf_checksum(gtf_path, output_dir):
+    """Returns _get_file_checksum(gtf_path). Checksums are saved in output_dir along with the gtf file's size and
+    modification time, so that the gtf file is only read again if it changed.
+    """
+    gtf_stat = os.stat(gtf_path)
+    gtf_key = os.path.abspath(gtf_path)
+    checksums_path = os.path.join(output_dir, GTF_CHECKSUMS_FILENAME)
+    checksums = {}
+    if os.path.isfile(checksums_path):
+        try:
+            with open(checksums_path, "rt") as f:
+                checksums = json.load(f)
+        except ValueError:
+            checksums = {}
+
+    size, mtime_ns, checksum = checksums.get(gtf_key, (None, None, None))
+    if (size, mtime_ns) == (gtf_stat.st_size, gtf_stat.st_mtime_ns):
+        return checksum
+
+    checksum = _get_file_checksum(gtf_path)
+    checksums[gtf_key] = (gtf_stat.st_size, gtf_stat.st_mtime_ns, checksum)
+
+    # write to a temp file and then rename it, so that other processes never read a partially-written file
+    os.makedirs(output_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp.", dir=output_dir)
+    try:
+        with os.fdopen(fd, "wt") as f:
+            json.dump(checksums, f)
+        os.replace(temp_path, checksums_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+    return checksum
+
+
+def _get_bundle_dir(gtf_path, output_dir=None, include_MANE=True):
+    output_dir = output_dir or os.path.join(get_cache_dir(), "gtf_summary_tables")
+    gtf_filename = re.sub(r"(\.gtf)?(\.b?gz)?$", "", os.path.basename(gtf_path))
+    checksum = _get_gtf_checksum(gtf_path, output_dir)
+    mane_suffix = "" if include_MANE else ".noMANE"
+    return os.path.join(output_dir, f"{gtf_filename}.{checksum}{mane_suffix}.v{GTF_SUMMARY_TABLES_VERSION}")
+
+
+def _strip_version(ids):
+    """Removes the version suffix from Ensembl ids (eg. ENST00000263100.8 => ENST00000263100)"""
+    return ids.astype(str).str.replace(r"\.\d+(_PAR_Y)?$", r"\1", regex=True)
+
+
+def _compute_summary_tables(gtf_path, include_MANE=True, num_workers=1):
+    df = read_gtf_table(gtf_path, attributes=GTF_SUMMARY_ATTRIBUTES, num_workers=num_workers)
+
+    # exons
+    exons = df[df["feature"] == "exon"]
+    exons = pd.DataFrame({
+        "chrom": exons["chrom"],
+        "start": exons["start"],
+        "end": exons["end"],
+        "strand": exons["strand"],
+        "gene_id": exons["gene_id"],
+        "transcript_id": exons["transcript_id"],
+        "exon_number": pd.to_numeric(exons["exon_number"].astype(str), errors="coerce").astype("Int16"),
+    }).reset_index(drop=True)
+
+    exon_stats = exons.assign(length=exons["end"] - exons["start"] + 1).groupby(
+        "transcript_id", observed=True).agg(num_exons=("length", "size"), exon_length=("length", "sum"))
+
+    cds = df[df["feature"] == "CDS"]
+    cds_stats = cds.assign(length=cds["end"] - cds["start"] + 1).groupby(
+        "transcript_id", observed=True).agg(cds_length=("length", "sum"), cds_start=("start", "min"),
+                                            cds_end=("end", "max"))
+
+    # transcripts
+    transcripts = df[df["feature"] == "transcript"]
+    transcript_ids = transcripts["transcript_id"].astype(str)
+    tags = transcripts["tag"].astype(str)
+    transcripts = pd.DataFrame({
+        "transcript_id": transcripts["transcript_id"],
+        "gene_id": transcripts["gene_id"],
+        "gene_name": transcripts["gene_name"],
+        "gene_type": transcripts["gene_type"],
+        "transcript_type": transcripts["transcript_type"],
+        "chrom": transcripts["chrom"],
+        "start": transcripts["start"],
+        "end": transcripts["end"],
+        "strand": transcripts["strand"],
+        "tags": transcripts["tag"],
+        "is_ensembl_canonical": tags.str.contains("Ensembl_canonical", regex=False),
+        "num_exons": transcript_ids.map(exon_stats["num_exons"]).fillna(0).astype("int32"),
+        "exon_length": transcript_ids.map(exon_stats["exon_length"]).fillna(0).astype("int32"),
+        "cds_length": transcript_ids.map(cds_stats["cds_length"]).fillna(0).astype("int32"),
+        "cds_start": transcript_ids.map(cds_stats["cds_start"]).astype("Int32"),
+        "cds_end": transcript_ids.map(cds_stats["cds_end"]).astype("Int32"),
+    }).reset_index(drop=True)
+
+    if include_MANE:
+        mane_df = get_MANE_ensembl_transcript_table()
+        mane_status = dict(zip(_strip_version(mane_df["Ensembl_nuc"]), mane_df["MANE_status"]))
+        transcripts["mane_status"] = _strip_version(transcripts["transcript_id"]).map(mane_status).astype("category")
+    else:
+        transcripts["mane_status"] = pd.Series(pd.NA, index=transcripts.index, dtype="category")
+
+    transcripts["is_mane_select"] = (transcripts["mane_status"] == "MANE Select").fillna(False).astype(bool)
+
+    # genes
+    genes = df[df["feature"] == "gene"]
+    gene_ids = genes["gene_id"].astype(str)
+    num_transcripts = transcripts.groupby("gene_id", observed=True).size()
+    mane_select_transcript_ids = transcripts[transcripts["is_mane_select"]].drop_duplicates("gene_id").set_index(
+        "gene_id")["transcript_id"].astype(str)
+    genes = pd.DataFrame({
+        "gene_id": genes["gene_id"],
+        "gene_name": genes["gene_name"],
+        "gene_type": genes["gene_type"],
+        "chrom": genes["chrom"],
+        "start": genes["start"],
+        "end": genes["end"],
+        "strand": genes["strand"],
+        "num_transcripts": gene_ids.map(num_transcripts).fillna(0).astype("int32"),
+        "mane_select_transcript_id": gene_ids.map(mane_select_transcript_ids).astype("category"),
+    }).reset_index(drop=True)
+
+    tables = {}
+    for name, table in zip(GTF_SUMMARY_TABLE_NAMES, (genes, transcripts, exons)):
+        for column in table.columns:
+            if isinstance(table[column].dtype, pd.CategoricalDtype):
+                table[column] = table[column].cat.remove_unused_categories()
+        tables[name] = table
+
+    return GtfSummaryTables(**tables)
+
+
+def build_gtf_summary_tables(gtf_path, output_dir=None, include_MANE=True, num_workers=1):
+    """Parse the gtf file and write the gene, transcript and exon summary tables to parquet files. The tables have
+    int32 coordinates and categorical string columns:
+
+        genes: gene_id, gene_name, gene_type, chrom, start, end, strand, num_transcripts, mane_select_transcript_id
+        transcripts: transcript_id, gene_id, gene_name, gene_type, transcript_type, chrom, start, end, strand, tags,
+            is_ensembl_canonical, num_exons, exon_length, cds_length, cds_start, cds_end, mane_status, is_mane_select
+        exons: chrom, start, end, strand, gene_id, transcript_id, exon_number
+
+    Args:
+        gtf_path (str): path of the gtf file
+        output_dir (str): directory where bundles are stored. Defaults to a "gtf_summary_tables" subdirectory of the
+            annotations cache directory. Each bundle is written to a subdirectory named after the gtf file's checksum,
+            with a .noMANE suffix if include_MANE is False.
+        include_MANE (bool): whether to add MANE status columns from get_MANE_ensembl_transcript_table(..)
+        num_workers (int): number of processes to use for parsing the gtf file (see read_gtf_table(..))
+
+    Return:
+        str: path of the bundle directory
+    """
+    bundle_dir = _get_bundle_dir(gtf_path, output_dir, include_MANE=include_MANE)
+    tables = _compute_summary_tables(gtf_path, include_MANE=include_MANE, num_workers=num_workers)
+
+    # write to a temp directory and then rename it, so that other processes never see a partially-written bundle
+    os.makedirs(os.path.dirname(bundle_dir), exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".tmp.", dir=os.path.dirname(bundle_dir))
+    try:
+        for name, table in zip(GTF_SUMMARY_TABLE_NAMES, tables):
+            table.to_parquet(os.path.join(temp_dir, f"{name}.parquet"), index=False)
+        if os.path.isdir(bundle_dir):
+            shutil.rmtree(bundle_dir)
+        os.rename(temp_dir, bundle_dir)
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+    return bundle_dir
+
+
+def load_gtf_summary_tables(gtf_path, output_dir=None, include_MANE=True, num_workers=1, columns=None):
+    """Load the gene, transcript and exon summary tables for the given gtf file, building them first if they don't
+    exist yet (see build_gtf_summary_tables(..) for arguments and table columns). The parquet files are memory-mapped
+    rather than copied into memory before decoding.
+
+    Args:
+        columns (dict): optionally, maps table name (eg. "exons") to the list of columns to load from that table
+
+    Return:
+        GtfSummaryTables: named tuple of pandas DataFrames with fields: genes, transcripts, exons
+    """
+    bundle_dir = _get_bundle_dir(gtf_path, output_dir, include_MANE=include_MANE)
+    if not all(os.path.isfile(os.path.join(bundle_dir, f"{name}.parquet")) for name in GTF_SUMMARY_TABLE_NAMES):
+        print(f"Building gtf summary tables for {gtf_path} in {bundle_dir}")
+        build_gtf_summary_tables(gtf_path, output_dir=output_dir, include_MANE=include_MANE, num_workers=num_workers)
+
+    columns = columns or {}
+    return GtfSummaryTables(**{
+        name: pd.read_parquet(
+            os.path.join(bundle_dir, f"{name}.parquet"), engine="pyarrow", memory_map=True, columns=columns.get(name))
+        for name in GTF_SUMMARY_TABLE_NAMES
+    })
@@ -1,44 +1,606 @@
+import bisect
+import collections
+import collections.abc
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import gzip
+import io
+import json
+import os
+import pandas as pd
+from pandas.api.types import union_categoricals
+import re
+import tempfile
+
+from bw2_annotation_utils.bgzf_utils import BgzfReader, is_bgzf, iter_bgzf_blocks
 
 VALID_FEATURE_TYPES = {"gene", "transcript", "CDS", "UTR", "exon", "start_codon", "stop_codon"}
 
+# when parse_gtf(..) uses several processes, each process parses chunks of about this many (uncompressed) bytes, so
+# that records are sent back in batches of a few thousand and only a few batches are held in memory at a time
+PARSE_GTF_CHUNK_SIZE = 2**22
+
 
-def parse_gtf(gtf_path, feature_type=None):
+def parse_gtf(gtf_path, feature_type=None, num_workers=1, lazy=False):
     """Parse a gtf file and return a generator of records
 
     Args:
         gtf_path (str): path of the gtf file
         feature_type (str): if not None, only keep features of this type. Allowed values are:
             'gene', 'transcript', 'CDS', 'UTR', 'exon', 'start_codon', 'stop_codon'
+        num_workers (int): if > 1, parse the file in this many processes. Records are still generated in file order.
+            This only works for uncompressed or bgzipped gtf files. If None, use all available CPUs.
+        lazy (bool): if True, generate GtfRecord objects instead of dictionaries. These use much less memory, and
+            only parse the 9th column when an attribute like "gene_id" is first accessed.
     """
 
     if feature_type and feature_type not in VALID_FEATURE_TYPES:
         raise ValueError(f"Invalid feature_type: {feature_type}. Expecting one of: {VALID_FEATURE_TYPES}")
 
+    gtf_chunks = _split_gtf_for_parallel_parsing(gtf_path, num_workers, max_chunk_size=PARSE_GTF_CHUNK_SIZE)
+    if gtf_chunks is not None:
+        num_workers = _get_num_workers(num_workers)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for records in _iter_results_in_order(executor, _parse_gtf_chunk, [
+                (gtf_path, gtf_chunk, feature_type, lazy) for gtf_chunk in gtf_chunks
+            ], max_in_flight=num_workers + 1):
+                yield from records
+        return
+
+    fopen = gzip.open if gtf_path.endswith("gz") else open
+    with fopen(gtf_path, "rt") as f:
+        for line in f:
+            record = _parse_gtf_line(line, feature_type=feature_type, lazy=lazy)
+            if record is not None:
+                yield record
+
+
+def _parse_gtf_line(line, feature_type=None, lazy=False):
+    """Parse one line of a gtf file into a record dictionary (or a GtfRecord if lazy is True). Returns None for
+    comment lines, lines that can't be parsed, and lines whose feature type is different from feature_type (if
+    specified).
+    """
+    if line.startswith("#"):
+        return None
+
+    fields = line.strip().split("\t")
+    if len(fields) < 9:
+        print(f"WARNING: unable to parse line: {line}")
+        return None
+
+    if feature_type is not None and fields[2] != feature_type:
+        return None
+
+    if lazy:
+        return GtfRecord(fields[0], fields[1], fields[2], int(fields[3]), int(fields[4]), fields[6], fields[8])
+
+    record = {
+        "chrom": fields[0],
+        "source": fields[1],
+        "feature": fields[2],
+        "start": int(fields[3]),
+        "end": int(fields[4]),
+        "strand": fields[6],
+    }
+
+    record.update({k: ",".join(values) for k, values in _parse_attributes(fields[8]).items()})
+
+    return record
+
+
+def _parse_attributes(info):
+    """Parse the 9th column of a gtf line.
+
+    Return:
+        dict: maps each attribute name to the list of its values. Most attributes have one value, but some, like "tag",
+            can be repeated.
+    """
+    attributes = {}
+    for x in info.split("; "):
+        key, _, value = x.partition(" ")
+        if key:
+            attributes.setdefault(key, []).append(value.strip(';" '))
+
+    return attributes
+
+
+class GtfRecord(collections.abc.Mapping):
+    """Read-only, dictionary-like gtf record that stores the 9th column as a string and only parses it when an
+    attribute is first accessed. record["tag"] returns the values of repeated attributes joined by commas (the same as
+    the dictionaries returned by parse_gtf), while record.get_all("tag") returns them as a list.
+    """
+
+    CORE_FIELDS = ("chrom", "source", "feature", "start", "end", "strand")
+
+    __slots__ = CORE_FIELDS + ("_info", "_attributes")
+
+    def __init__(self, chrom, source, feature, start, end, strand, info):
+        self.chrom = chrom
+        self.source = source
+        self.feature = feature
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self._info = info
+        self._attributes = None
+
+    def _get_attributes(self):
+        if self._attributes is None:
+            self._attributes = _parse_attributes(self._info)
+        return self._attributes
+
+    def __getitem__(self, key):
+        if key in GtfRecord.CORE_FIELDS:
+            return getattr(self, key)
+
+        return ",".join(self._get_attributes()[key])
+
+    def get_all(self, key):
+        """Returns the list of values of the given attribute, or an empty list if the record doesn't have it"""
+        if key in GtfRecord.CORE_FIELDS:
+            return [getattr(self, key)]
+
+        return list(self._get_attributes().get(key, []))
+
+    def __contains__(self, key):
+        return key in GtfRecord.CORE_FIELDS or key in self._get_attributes()
+
+    def __iter__(self):
+        yield from GtfRecord.CORE_FIELDS
+        yield from self._get_attributes()
+
+    def __len__(self):
+        return len(GtfRecord.CORE_FIELDS) + len(self._get_attributes())
+
+    def to_dict(self):
+        """Returns the record as a dictionary, in the same format as the records returned by parse_gtf"""
+        return dict(self.items())
+
+    def __getstate__(self):
+        return (self.chrom, self.source, self.feature, self.start, self.end, self.strand, self._info)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return f"GtfRecord({self.to_dict()})"
+
+
+GTF_COLUMNS = ["chrom", "source", "feature", "start", "end", "score", "strand", "frame", "attributes"]
+
+# attributes that can appear more than once in the same record (eg. tag "basic"; tag "CCDS";). Their values are
+# combined into one comma-separated string.
+MULTI_VALUED_ATTRIBUTES = {"tag", "ont"}
+
+DEFAULT_GTF_TABLE_ATTRIBUTES = ("gene_id", "transcript_id", "gene_name")
+
+
+def _count_header_lines(gtf_path):
+    """Returns the number of comment lines at the beginning of the gtf file"""
     fopen = gzip.open if gtf_path.endswith("gz") else open
     with fopen(gtf_path, "rt") as f:
+        num_header_lines = 0
         for line in f:
-            if line.startswith("#"):
+            if not line.startswith("#"):
+                break
+            num_header_lines += 1
+
+    return num_header_lines
+
+
+def _extract_attribute(attributes_column, attribute_name):
+    """Extracts the values of the given attribute from a pandas Series of gtf attribute strings"""
+    pattern = f'(?:^|;)\\s*{re.escape(attribute_name)} "?([^";]*)"?'
+    if attribute_name in MULTI_VALUED_ATTRIBUTES:
+        values = attributes_column.str.findall(pattern).str.join(",")
+        return values.where(values != "")
+
+    return attributes_column.str.extract(pattern, expand=False)
+
+
+def read_gtf_table(gtf_path, feature_type=None, attributes=DEFAULT_GTF_TABLE_ATTRIBUTES, chunk_size=500_000,
+                   num_workers=1):
+    """Parse a gtf file into a pandas DataFrame. This is much faster and uses much less memory than parse_gtf
+    for large files like the full GENCODE gtf, since lines are parsed in chunks by pandas, and only the requested
+    attributes are extracted from the 9th column.
+
+    Args:
+        gtf_path (str): path of the gtf file
+        feature_type (str): if not None, only keep features of this type. Allowed values are:
+            'gene', 'transcript', 'CDS', 'UTR', 'exon', 'start_codon', 'stop_codon'
+        attributes (list): names of attributes to extract from the 9th column (eg. "gene_id", "gene_type").
+            Each one becomes a column in the output table, with NaN for records that don't have it.
+        chunk_size (int): number of lines to parse at a time
+        num_workers (int): if > 1, parse the file in this many processes. This only works for uncompressed or
+            bgzipped gtf files. If None, use all available CPUs.
+
+    Return:
+        pandas.DataFrame: table with columns chrom, source, feature, start, end, strand, followed by one column per
+            attribute. start and end are int32, and the other columns are categorical.
+    """
+
+    if feature_type and feature_type not in VALID_FEATURE_TYPES:
+        raise ValueError(f"Invalid feature_type: {feature_type}. Expecting one of: {VALID_FEATURE_TYPES}")
+
+    attributes = list(attributes)
+    gtf_chunks = _split_gtf_for_parallel_parsing(gtf_path, num_workers)
+    if gtf_chunks is not None:
+        with ProcessPoolExecutor(max_workers=_get_num_workers(num_workers)) as executor:
+            chunks = list(executor.map(_read_gtf_table_chunk, *zip(*[
+                (gtf_path, gtf_chunk, feature_type, attributes) for gtf_chunk in gtf_chunks
+            ])))
+        return _concat_gtf_table_chunks(chunks, attributes)
+
+    reader = _read_csv_gtf(
+        gtf_path,
+        skiprows=_count_header_lines(gtf_path),
+        compression="gzip" if gtf_path.endswith("gz") else None,
+        chunksize=chunk_size)
+
+    chunks = [_process_gtf_table_chunk(chunk, feature_type, attributes) for chunk in reader]
+
+    return _concat_gtf_table_chunks(chunks, attributes)
+
+
+def _read_csv_gtf(f, **kwargs):
+    """Calls pd.read_csv(..) with the settings for parsing gtf lines"""
+    return pd.read_csv(
+        f,
+        sep="\t",
+        header=None,
+        names=GTF_COLUMNS,
+        usecols=["chrom", "source", "feature", "start", "end", "strand", "attributes"],
+        dtype={"chrom": str, "source": str, "feature": str, "start": "int32", "end": "int32", "strand": str,
+               "attributes": str},
+        quoting=csv.QUOTE_NONE,
+        **kwargs)
+
+
+def _process_gtf_table_chunk(chunk, feature_type, attributes):
+    """Filters a chunk of gtf lines parsed by _read_csv_gtf(..) and extracts the given attributes"""
+    if feature_type is not None:
+        chunk = chunk[chunk["feature"] == feature_type]
+
+    chunk = chunk.assign(**{
+        attribute_name: _extract_attribute(chunk["attributes"], attribute_name) for attribute_name in attributes
+    }).drop(columns=["attributes"])
+
+    # convert to categorical per chunk to reduce peak memory usage. _concat_gtf_table_chunks(..) merges the
+    # categories of all chunks.
+    return chunk.astype({c: "category" for c in chunk.columns if c not in ("start", "end")})
+
+
+def _concat_gtf_table_chunks(chunks, attributes):
+    chunks = [chunk for chunk in chunks if chunk is not None]
+    if not chunks:
+        return pd.DataFrame(columns=["chrom", "source", "feature", "start", "end", "strand"] + list(attributes))
+
+    return pd.DataFrame({
+        column: pd.concat([chunk[column] for chunk in chunks], ignore_index=True) if column in ("start", "end")
+        else union_categoricals([chunk[column] for chunk in chunks], ignore_order=True)
+        for column in chunks[0].columns
+    })
+
+
+def _get_num_workers(num_workers):
+    return num_workers if num_workers is not None else os.cpu_count()
+
+
+def _iter_results_in_order(executor, func, args_list, max_in_flight):
+    """Submits func(*args) for each args tuple and yields the results in the same order, while keeping at most
+    max_in_flight tasks submitted but not yet yielded, so that results don't pile up in memory when they're consumed
+    more slowly than they're computed.
+    """
+    futures = collections.deque()
+    try:
+        for args in args_list:
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+            futures.append(executor.submit(func, *args))
+
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _split_gtf_for_parallel_parsing(gtf_path, num_workers, chunks_per_worker=4, max_chunk_size=None):
+    """Splits the gtf file into chunks that can be parsed independently by _iter_gtf_chunk_lines(..).
+
+    Args:
+        gtf_path (str): path of the gtf file
+        num_workers (int): number of processes that will parse the chunks
+        chunks_per_worker (int): minimum number of chunks per process
+        max_chunk_size (int): if specified, the file is split into more chunks if needed so that each chunk has
+            at most about this many uncompressed bytes
+
+    Return:
+        list: list of (seek offset, offset where the chunk's first line starts, offset where the next chunk starts)
+            tuples, or None if the file should be parsed in a single process. For bgzipped files, offsets are virtual
+            offsets. The last chunk's end offset is None.
+    """
+    num_workers = _get_num_workers(num_workers)
+    if num_workers <= 1:
+        return None
+
+    num_chunks = num_workers * chunks_per_worker
+    if not gtf_path.endswith("gz"):
+        file_size = os.path.getsize(gtf_path)
+        if max_chunk_size:
+            num_chunks = max(num_chunks, -(-file_size // max_chunk_size))
+        boundaries = [file_size * i // num_chunks for i in range(num_chunks)]
+        boundaries = sorted(set(boundaries))
+        # each chunk, except the first, starts by reading the rest of the line that contains the byte before it
+        return [
+            (max(start - 1, 0), start, boundaries[i + 1] if i + 1 < len(boundaries) else None)
+            for i, start in enumerate(boundaries)
+        ]
+
+    if not is_bgzf(gtf_path):
+        print(f"WARNING: {gtf_path} is compressed with gzip rather than bgzip, so it can't be split for parallel "
+              f"parsing. Parsing it in a single process instead.")
+        return None
+
+    block_offsets = [offset for offset, _ in iter_bgzf_blocks(gtf_path)]
+    if max_chunk_size:
+        # bgzip blocks hold up to 64kb of uncompressed data
+        num_chunks = max(num_chunks, -(-len(block_offsets) // max(max_chunk_size // 2**16, 1)))
+    first_block_indices = sorted(set(len(block_offsets) * i // num_chunks for i in range(num_chunks)))
+    # each chunk, except the first, starts by reading the lines that start in the previous block, since the last of
+    # those may continue into the chunk's first block
+    return [
+        (
+            block_offsets[max(block_index - 1, 0)] << 16,
+            block_offsets[block_index] << 16,
+            block_offsets[first_block_indices[i + 1]] << 16 if i + 1 < len(first_block_indices) else None,
+        ) for i, block_index in enumerate(first_block_indices)
+    ]
+
+
+def _iter_gtf_chunk_lines(gtf_path, gtf_chunk):
+    """Yields the non-comment lines (as bytes) that start within the given chunk of the gtf file"""
+    seek_offset, start_offset, end_offset = gtf_chunk
+    with _open_gtf_for_random_access(gtf_path) as f:
+        f.seek(seek_offset)
+        while f.tell() < start_offset:
+            if not f.readline():
+                return
+
+        while end_offset is None or f.tell() < end_offset:
+            line = f.readline()
+            if not line:
+                break
+            if not line.startswith(b"#"):
+                yield line
+
+
+def _parse_gtf_chunk(gtf_path, gtf_chunk, feature_type, lazy):
+    return [
+        record for record in (
+            _parse_gtf_line(line.decode(), feature_type=feature_type, lazy=lazy)
+            for line in _iter_gtf_chunk_lines(gtf_path, gtf_chunk)
+        ) if record is not None
+    ]
+
+
+def _read_gtf_table_chunk(gtf_path, gtf_chunk, feature_type, attributes):
+    data = b"".join(_iter_gtf_chunk_lines(gtf_path, gtf_chunk))
+    if not data:
+        return None
+
+    return _process_gtf_table_chunk(_read_csv_gtf(io.BytesIO(data)), feature_type, attributes)
+
+
+GTF_INDEX_SUFFIX = ".gtfidx.json.gz"
+GTF_INDEX_VERSION = 1
+
+
+def _get_attribute(info, attribute_name):
+    """Returns the value of the given attribute from the 9th column of a gtf line, or None if it's not there"""
+    match = re.search(f'(?:^|;)\\s*{re.escape(attribute_name)} "?([^";]*)"?', info)
+    return match.group(1) if match else None
+
+
+def _open_gtf_for_random_access(gtf_path):
+    """Opens the gtf file in binary mode, and returns a file object that supports seek(..) and tell(..)"""
+    if not gtf_path.endswith("gz"):
+        return open(gtf_path, "rb")
+
+    if not is_bgzf(gtf_path):
+        raise ValueError(f"{gtf_path} is compressed with gzip rather than bgzip, so it doesn't support random access. "
+                         f"Recompress it by running: gunzip -c {gtf_path} | bgzip > {re.sub('.gz$', '', gtf_path)}.bgz")
+
+    return BgzfReader(gtf_path)
+
+
+def build_gtf_index(gtf_path, index_path=None):
+    """Scan the gtf file once and write a sidecar index file that allows GtfIndex to look up records by gene id,
+    transcript id, or genomic region without re-reading the whole file. The index stores the file offset of each run of
+    consecutive lines that belong to the same gene, along with the run's genomic interval. The gtf file must be either
+    uncompressed or compressed with bgzip.
+
+    Args:
+        gtf_path (str): path of the gtf file
+        index_path (str): output path. Defaults to gtf_path + ".gtfidx.json.gz"
+
+    Return:
+        str: the index path
+    """
+    index_path = index_path or f"{gtf_path}{GTF_INDEX_SUFFIX}"
+
+    runs = []  # list of [chrom, start, end, gene_id, file offset of the run's first line, number of lines in the run]
+    transcript_id_to_gene_id = {}
+    with _open_gtf_for_random_access(gtf_path) as f:
+        current_run = None
+        line_number = 0
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            line_number += 1
+            if line.startswith(b"#"):
                 continue
 
-            fields = line.strip().split("\t")
+            fields = line.decode().rstrip("\n").split("\t")
             if len(fields) < 9:
-                print(f"WARNING: unable to parse line: {line}")
                 continue
 
-            if feature_type is not None and fields[2] != feature_type:
+            chrom, start, end = fields[0], int(fields[3]), int(fields[4])
+            gene_id = _get_attribute(fields[8], "gene_id")
+            transcript_id = _get_attribute(fields[8], "transcript_id")
+            if transcript_id is not None:
+                transcript_id_to_gene_id[transcript_id] = gene_id
+
+            if current_run is not None and current_run[3] == gene_id and current_run[0] == chrom:
+                current_run[1] = min(current_run[1], start)
+                current_run[2] = max(current_run[2], end)
+                current_run[5] = line_number - current_run[6] + 1
+            else:
+                current_run = [chrom, start, end, gene_id, offset, 1, line_number]
+                runs.append(current_run)
+
+    # write to a temp file and then rename it, so that an interrupted build, or several processes building the index
+    # at the same time, never leave behind a truncated index
+    gtf_stat = os.stat(gtf_path)
+    fd, temp_index_path = tempfile.mkstemp(prefix=".tmp.", dir=os.path.dirname(os.path.abspath(index_path)))
+    os.close(fd)
+    try:
+        with gzip.open(temp_index_path, "wt") as f:
+            json.dump({
+                "version": GTF_INDEX_VERSION,
+                "gtf_size": gtf_stat.st_size,
+                "gtf_mtime": gtf_stat.st_mtime,
+                "runs": [run[:6] for run in runs],
+                "transcripts": transcript_id_to_gene_id,
+            }, f)
+        os.chmod(temp_index_path, 0o644)
+        os.replace(temp_index_path, index_path)
+    finally:
+        if os.path.isfile(temp_index_path):
+            os.remove(temp_index_path)
+
+    return index_path
+
+
+class GtfIndex:
+    """Random access to the records of a gtf file by gene id, transcript id, or genomic region. On first use, it scans
+    the gtf file and saves an index next to it (see build_gtf_index), and subsequent lookups only read the parts of the
+    file that contain the requested genes. The gtf file must be either uncompressed or compressed with bgzip.
+
+    Example:
+        with GtfIndex("gencode.v46.annotation.gtf.bgz") as gtf_index:
+            exons = gtf_index.get_gene("ENSG00000049246.15", feature_type="exon")
+            records = gtf_index.query_region("chr1", 7784284, 7845180, feature_type="transcript")
+    """
+
+    def __init__(self, gtf_path, index_path=None):
+        self.gtf_path = gtf_path
+        index_path = index_path or f"{gtf_path}{GTF_INDEX_SUFFIX}"
+
+        index = self._load_index(index_path)
+        if index is None:
+            print(f"Building index for {gtf_path}")
+            build_gtf_index(gtf_path, index_path)
+            index = self._load_index(index_path)
+
+        self._runs = index["runs"]
+        self._transcript_id_to_gene_id = index["transcripts"]
+        self._gene_id_to_run_indices = collections.defaultdict(list)
+        self._chrom_to_run_indices = collections.defaultdict(list)
+        self._max_run_length = 0
+        for i, (chrom, start, end, gene_id, _, _) in enumerate(self._runs):
+            self._gene_id_to_run_indices[gene_id].append(i)
+            self._chrom_to_run_indices[chrom].append(i)
+            self._max_run_length = max(self._max_run_length, end - start + 1)
+
+        # sort runs by start position so that query_region(..) can use binary search
+        self._chrom_to_run_starts = {}
+        for chrom, run_indices in self._chrom_to_run_indices.items():
+            run_indices.sort(key=lambda i: self._runs[i][1])
+            self._chrom_to_run_starts[chrom] = [self._runs[i][1] for i in run_indices]
+
+        self._f = _open_gtf_for_random_access(gtf_path)
+
+    def _load_index(self, index_path):
+        """Returns the index if it exists and is up-to-date, or None otherwise"""
+        if not os.path.isfile(index_path):
+            return None
+
+        try:
+            with gzip.open(index_path, "rt") as f:
+                index = json.load(f)
+        except (OSError, EOFError, ValueError) as e:
+            print(f"WARNING: unable to read {index_path}: {e}. Rebuilding it...")
+            return None
+
+        gtf_stat = os.stat(self.gtf_path)
+        if index.get("version") != GTF_INDEX_VERSION or index.get("gtf_size") != gtf_stat.st_size or \
+                index.get("gtf_mtime") != gtf_stat.st_mtime:
+            return None
+
+        return index
+
+    def _read_run(self, run_index, feature_type=None):
+        _, _, _, _, offset, num_lines = self._runs[run_index]
+        self._f.seek(offset)
+        for _ in range(num_lines):
+            record = _parse_gtf_line(self._f.readline().decode(), feature_type=feature_type)
+            if record is not None:
+                yield record
+
+    def get_gene(self, gene_id, feature_type=None):
+        """Returns the list of records for the given gene id, optionally filtered to the given feature type"""
+        if feature_type and feature_type not in VALID_FEATURE_TYPES:
+            raise ValueError(f"Invalid feature_type: {feature_type}. Expecting one of: {VALID_FEATURE_TYPES}")
+
+        return [
+            record for run_index in self._gene_id_to_run_indices.get(gene_id, [])
+            for record in self._read_run(run_index, feature_type=feature_type)
+        ]
+
+    def get_transcript(self, transcript_id, feature_type=None):
+        """Returns the list of records for the given transcript id, optionally filtered to the given feature type"""
+        gene_id = self._transcript_id_to_gene_id.get(transcript_id)
+        if gene_id is None:
+            return []
+
+        return [
+            record for record in self.get_gene(gene_id, feature_type=feature_type)
+            if record.get("transcript_id") == transcript_id
+        ]
+
+    def query_region(self, chrom, start, end, feature_type=None):
+        """Returns the list of records that overlap the given 1-based, inclusive interval, optionally filtered to the
+        given feature type
+        """
+        if feature_type and feature_type not in VALID_FEATURE_TYPES:
+            raise ValueError(f"Invalid feature_type: {feature_type}. Expecting one of: {VALID_FEATURE_TYPES}")
+
+        run_indices = self._chrom_to_run_indices.get(chrom, [])
+        run_starts = self._chrom_to_run_starts.get(chrom, [])
+
+        # runs that overlap the interval must start before its end, and can't start more than max_run_length
+        # before its start
+        i_start = bisect.bisect_left(run_starts, start - self._max_run_length)
+        i_end = bisect.bisect_right(run_starts, end)
+
+        records = []
+        for run_index in run_indices[i_start:i_end]:
+            if self._runs[run_index][2] < start:
                 continue
+            for record in self._read_run(run_index, feature_type=feature_type):
+                if record["start"] <= end and record["end"] >= start:
+                    records.append(record)
+
+        return records
 
-            record = {
-                "chrom": fields[0],
-                "source": fields[1],
-                "feature": fields[2],
-                "start": int(fields[3]),
-                "end": int(fields[4]),
-                "strand": fields[6],
-            }
+    def close(self):
+        self._f.close()
 
-            info = fields[8]
-            record.update({k: v.strip(';" ') for k, v in [x.split(" ") for x in info.split("; ")]})
+    def __enter__(self):
+        return self
 
-            yield record
+    def __exit__(self, *args):
+        self.close()
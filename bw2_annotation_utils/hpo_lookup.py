@@ -1,13 +1,14 @@
 import argparse
-from cache_utils import cache_json
 import os
 import requests
 from tqdm import tqdm
 
+from bw2_annotation_utils.cache_utils import cache_json
+
 HP_OBO_URL = 'http://purl.obolibrary.org/obo/hp.obo'
 
 
-@cache_json
+@cache_json(source_url=HP_OBO_URL, stale_while_revalidate=True)
 def download_hpo_obo_file():
     """
     Parse an .obo file which contains a record for each term in the Human Phenotype Ontology
@@ -0,0 +1,171 @@
+"""Array-backed index for finding which genomic intervals (eg. exons or transcripts from parse_gtf) overlap large
+batches of positions or ranges.
+
+Intervals are grouped by chromosome and by length class (powers of 2), and each group is stored as numpy arrays sorted
+by start position. For a query range [start, end], the candidates in each group are the intervals whose start lies in
+[start - longest interval in the group, end], which are found with np.searchsorted(..) for all queries at once. Since
+intervals within a length class have similar lengths, few candidates fail the final end >= start check, so a handful
+of very long intervals (eg. long genes) doesn't slow down queries against the many short ones.
+
+Example:
+    exons = list(parse_gtf("gencode.v46.annotation.gtf.gz", feature_type="exon"))
+    exon_index = IntervalIndex.from_records(exons)
+    query_indices, exon_indices = exon_index.query_points(variants_df["chrom"], variants_df["pos"])
+"""
+
+import numpy as np
+
+# maximum number of candidate intervals to compare at once. Larger batches of queries are processed in chunks to
+# limit memory usage.
+MAX_CANDIDATES_PER_BATCH = 10_000_000
+
+
+def _group_indices(values):
+    """Yields (unique value, array of indices where it occurs) for each unique value in the given numpy array"""
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    boundaries = np.cumsum(np.bincount(inverse, minlength=len(unique_values)))[:-1]
+    for value, indices in zip(unique_values, np.split(order, boundaries)):
+        yield value, indices
+
+
+class IntervalIndex:
+    """Index of 1-based, inclusive intervals that supports batched overlap queries. Query results are returned as two
+    parallel arrays of (query index, interval index) pairs, where interval indices refer to the order of the intervals
+    passed to the constructor.
+    """
+
+    def __init__(self, chroms, starts, ends):
+        """Build the index.
+
+        Args:
+            chroms (array-like): chromosome of each interval
+            starts (array-like): 1-based start coordinate of each interval
+            ends (array-like): 1-based, inclusive end coordinate of each interval
+        """
+        chroms = np.asarray(chroms, dtype=str)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if not (len(chroms) == len(starts) == len(ends)):
+            raise ValueError(f"chroms, starts and ends must have the same length. Got {len(chroms)}, {len(starts)}, "
+                             f"{len(ends)}")
+
+        if np.any(ends < starts):
+            raise ValueError("Some intervals have end < start")
+
+        self.num_intervals = len(starts)
+
+        # chrom => list of (sorted starts, ends, original indices, max length) tuples, one per length class
+        self._groups = {}
+        length_classes = np.floor(np.log2(ends - starts + 1)).astype(np.int64) if len(starts) else starts
+        for chrom, indices in _group_indices(chroms):
+            self._groups[chrom] = []
+            for length_class, class_indices in _group_indices(length_classes[indices]):
+                group_indices = indices[class_indices]
+                group_indices = group_indices[np.argsort(starts[group_indices], kind="stable")]
+                group_starts = starts[group_indices]
+                group_ends = ends[group_indices]
+                max_length = int((group_ends - group_starts).max()) + 1
+                self._groups[chrom].append((group_starts, group_ends, group_indices, max_length))
+
+    @classmethod
+    def from_records(cls, records):
+        """Build the index from an iterable of dictionaries with "chrom", "start" and "end" keys, such as the
+        records returned by parse_gtf(..). Interval indices in query results refer to the position of each record.
+        """
+        records = records if isinstance(records, (list, tuple)) else list(records)
+        return cls(
+            [r["chrom"] for r in records],
+            [r["start"] for r in records],
+            [r["end"] for r in records])
+
+    @classmethod
+    def from_dataframe(cls, df, chrom_column="chrom", start_column="start", end_column="end"):
+        """Build the index from a pandas DataFrame, such as the table returned by read_gtf_table(..). Interval indices
+        in query results are row positions (not index labels), so they can be used with df.iloc[..].
+        """
+        return cls(df[chrom_column].astype(str).to_numpy(), df[start_column].to_numpy(), df[end_column].to_numpy())
+
+    def query_points(self, chroms, positions):
+        """Find the intervals that contain each of the given positions.
+
+        Args:
+            chroms (array-like): chromosome of each query position
+            positions (array-like): 1-based query positions
+
+        Return:
+            2-tuple: (query_indices, interval_indices) numpy arrays, sorted by query index and then interval index
+        """
+        return self.query_ranges(chroms, positions, positions)
+
+    def query_ranges(self, chroms, starts, ends):
+        """Find the intervals that overlap each of the given ranges.
+
+        Args:
+            chroms (array-like): chromosome of each query range
+            starts (array-like): 1-based start of each query range
+            ends (array-like): 1-based, inclusive end of each query range
+
+        Return:
+            2-tuple: (query_indices, interval_indices) numpy arrays, sorted by query index and then interval index
+        """
+        chroms = np.asarray(chroms, dtype=str)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        query_indices_list = [np.empty(0, dtype=np.int64)]
+        interval_indices_list = [np.empty(0, dtype=np.int64)]
+        for chrom, chrom_query_indices in _group_indices(chroms):
+            if chrom not in self._groups:
+                continue
+            # searchsorted(..) is much faster when the values being looked up are sorted
+            chrom_query_indices = chrom_query_indices[np.argsort(starts[chrom_query_indices], kind="stable")]
+            for group in self._groups[chrom]:
+                q, i = self._query_group(group, chrom_query_indices, starts[chrom_query_indices],
+                                         ends[chrom_query_indices])
+                query_indices_list.append(q)
+                interval_indices_list.append(i)
+
+        query_indices = np.concatenate(query_indices_list)
+        interval_indices = np.concatenate(interval_indices_list)
+        order = np.lexsort((interval_indices, query_indices))
+        return query_indices[order], interval_indices[order]
+
+    def count_overlaps(self, chroms, starts, ends=None):
+        """Returns a numpy array with the number of intervals that overlap each query position or range"""
+        query_indices, _ = self.query_ranges(chroms, starts, starts if ends is None else ends)
+        return np.bincount(query_indices, minlength=len(starts))
+
+    @staticmethod
+    def _query_group(group, query_indices, query_starts, query_ends):
+        group_starts, group_ends, group_indices, max_length = group
+        lo = np.searchsorted(group_starts, query_starts - max_length + 1, side="left")
+        hi = np.searchsorted(group_starts, query_ends, side="right")
+        counts = hi - lo
+
+        # split the queries into batches so that the arrays of candidates below don't get too large
+        cumulative_counts = np.cumsum(counts)
+        batch_boundaries = np.searchsorted(
+            cumulative_counts, np.arange(MAX_CANDIDATES_PER_BATCH, cumulative_counts[-1] if len(counts) else 0,
+                                         MAX_CANDIDATES_PER_BATCH), side="right")
+
+        results_q, results_i = [], []
+        for batch in np.split(np.arange(len(counts)), batch_boundaries):
+            batch_counts = counts[batch]
+            total = int(batch_counts.sum())
+            if total == 0:
+                continue
+
+            # expand each query into its candidate positions lo, lo+1, ..., hi-1
+            candidate_query = np.repeat(batch, batch_counts)
+            offsets = np.repeat(lo[batch] - (np.cumsum(batch_counts) - batch_counts), batch_counts)
+            candidates = np.arange(total) + offsets
+
+            overlaps = group_ends[candidates] >= query_starts[candidate_query]
+            results_q.append(query_indices[candidate_query[overlaps]])
+            results_i.append(group_indices[candidates[overlaps]])
+
+        if not results_q:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        return np.concatenate(results_q), np.concatenate(results_i)
@@ -1,13 +1,75 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import requests
+from requests.adapters import HTTPAdapter
+import sqlite3
+import threading
+from urllib3.util.retry import Retry
 
-def get_spliceai_scores_from_api(chrom, pos, ref, alt):
-	variant = f"{chrom}-{pos}-{ref}-{alt}"
-	result = requests.get(f"https://spliceai-38-xwkwwwxdwq-uc.a.run.app/spliceai/?hg=38&distance=500&mask=0&variant={variant}&raw={variant}")
-	spliceai_scores = result.json()
+from bw2_annotation_utils.cache_utils import get_cache_dir
+
+SPLICEAI_API_URL = "https://spliceai-{genome}-xwkwwwxdwq-uc.a.run.app/spliceai/"
+DEFAULT_GENOME = "38"
+DEFAULT_DISTANCE = 500
+DEFAULT_MASK = 0
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+DEFAULT_MAX_RETRIES = 5
+
+# (connect, read) timeouts in seconds. The read timeout is long since the API computes scores that aren't precomputed.
+REQUEST_TIMEOUT = (10, 120)
+
+# scores are saved to the database after this many new scores, so that an interrupted run keeps most of its results
+CACHE_COMMIT_INTERVAL = 100
+
+_thread_local = threading.local()
+
+
+def get_spliceai_cache_path():
+	return os.path.join(get_cache_dir(), "spliceai_scores.sqlite")
+
+
+def _get_session(max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS, max_retries=DEFAULT_MAX_RETRIES):
+	"""Returns a requests.Session for the current thread, which reuses connections and retries failed requests with
+	exponential backoff (respecting the Retry-After header when the API is rate-limiting requests)
+	"""
+	session = getattr(_thread_local, "session", None)
+	if session is None:
+		retry = Retry(
+			total=max_retries,
+			backoff_factor=1,
+			status_forcelist=(429, 500, 502, 503, 504),
+			allowed_methods=("GET",),
+			respect_retry_after_header=True)
+		session = requests.Session()
+		adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max_concurrent_requests)
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+		_thread_local.session = session
+
+	return session
+
+
+def _get_variant_key(chrom, pos, ref, alt):
+	return f"{str(chrom).replace('chr', '').upper()}-{pos}-{ref}-{alt}"
+
+
+def _open_cache(cache_path):
+	os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+	conn = sqlite3.connect(cache_path, timeout=60)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute(
+		"CREATE TABLE IF NOT EXISTS scores (variant TEXT, genome TEXT, distance INTEGER, mask INTEGER, "
+		"gain REAL, loss REAL, PRIMARY KEY (variant, genome, distance, mask))")
+	return conn
+
+
+def _parse_spliceai_response(variant, spliceai_scores):
+	"""Returns the (gain, loss) scores from a SpliceAI-lookup API response, or None if the API returned an error"""
 	if spliceai_scores.get("error"):
 		print(f"WARNING: SpliceAI-lookup returned an error for {variant}: {spliceai_scores['error']}")
-		return 0, 0
+		return None
 
 	spliceai_scores = spliceai_scores.get("scores", [])
 
@@ -40,6 +102,100 @@ def get_spliceai_scores_from_api(chrom, pos, ref, alt):
 
 	return spliceai_gain_score, spliceai_loss_score
 
+
+def _query_api(variant, genome, distance, mask, max_concurrent_requests, max_retries):
+	session = _get_session(max_concurrent_requests, max_retries)
+	result = session.get(SPLICEAI_API_URL.format(genome=genome), params={
+		"hg": genome, "distance": distance, "mask": mask, "variant": variant, "raw": variant,
+	}, timeout=REQUEST_TIMEOUT)
+	result.raise_for_status()
+	try:
+		response_json = result.json()
+	except ValueError:
+		raise ValueError(f"response isn't valid JSON: {result.text[:200]}")
+
+	return _parse_spliceai_response(variant, response_json)
+
+
+def get_spliceai_scores_for_variants(variants, genome=DEFAULT_GENOME, distance=DEFAULT_DISTANCE, mask=DEFAULT_MASK,
+									 max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+									 max_retries=DEFAULT_MAX_RETRIES, cache_path=None, verbose=False):
+	"""Get SpliceAI scores for many variants. Scores are looked up in a local SQLite cache first, and the remaining
+	variants are sent to the SpliceAI-lookup API using concurrent requests. New scores are added to the cache so they
+	never need to be requested again.
+
+	Args:
+		variants (iterable): (chrom, pos, ref, alt) tuples. Duplicates are only looked up once.
+		genome (str): "37" or "38"
+		distance (int): SpliceAI max distance parameter
+		mask (int): SpliceAI masking parameter (0 or 1)
+		max_concurrent_requests (int): max number of API requests to run at the same time
+		max_retries (int): max number of times to retry a request that failed or was rate-limited
+		cache_path (str): path of the SQLite cache. Defaults to spliceai_scores.sqlite in the annotations cache directory.
+		verbose (bool): print progress messages
+
+	Return:
+		dict: maps "chrom-pos-ref-alt" variant keys (with "chr" removed from chrom) to (gain score, loss score) tuples.
+			Variants for which the API returned an error or the request failed are left out.
+	"""
+	genome = str(genome)
+	variant_keys = list(dict.fromkeys(_get_variant_key(*v) for v in variants))
+
+	conn = _open_cache(cache_path or get_spliceai_cache_path())
+	try:
+		scores = {}
+		for i in range(0, len(variant_keys), 500):
+			batch = variant_keys[i:i+500]
+			rows = conn.execute(
+				f"SELECT variant, gain, loss FROM scores WHERE genome=? AND distance=? AND mask=? "
+				f"AND variant IN ({','.join('?' * len(batch))})", [genome, distance, mask] + batch)
+			scores.update({variant: (gain, loss) for variant, gain, loss in rows})
+
+		variants_to_query = [v for v in variant_keys if v not in scores]
+		if verbose:
+			print(f"Found {len(scores)} out of {len(variant_keys)} variants in the SpliceAI cache. Querying the API for "
+				  f"the other {len(variants_to_query)}")
+		if not variants_to_query:
+			return scores
+
+		num_inserted = 0
+		with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+			futures = {
+				executor.submit(_query_api, variant, genome, distance, mask, max_concurrent_requests, max_retries): variant
+				for variant in variants_to_query
+			}
+			for i, future in enumerate(as_completed(futures)):
+				variant = futures[future]
+				if verbose and i > 0 and i % 1000 == 0:
+					print(f"Got SpliceAI-lookup responses for {i} out of {len(futures)} variants")
+				try:
+					result = future.result()
+				except Exception as e:
+					print(f"WARNING: SpliceAI-lookup request failed for {variant}: {e}")
+					continue
+
+				if result is None:
+					continue
+
+				scores[variant] = result
+				conn.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+							 (variant, genome, distance, mask, result[0], result[1]))
+				num_inserted += 1
+				if num_inserted % CACHE_COMMIT_INTERVAL == 0:
+					conn.commit()
+
+		conn.commit()
+	finally:
+		conn.close()
+
+	return scores
+
+
+def get_spliceai_scores_from_api(chrom, pos, ref, alt):
+	variant = _get_variant_key(chrom, pos, ref, alt)
+	scores = get_spliceai_scores_for_variants([(chrom, pos, ref, alt)])
+	return scores.get(variant, (0, 0))
+
 #GET https://pangolin-38-xwkwwwxdwq-uc.a.run.app/pangolin/?hg=38&distance=500&mask=0&variant=19-10315746-A-C&raw=chr19:10315746 A>C 200
 
 
@@ -54,4 +210,4 @@ def main():
 	print(f"SpliceAI scores for {chrom}-{pos}-{ref}-{alt}: gain={spliceai_gain_score}, loss={spliceai_loss_score}")
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
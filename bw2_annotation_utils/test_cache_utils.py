@@ -0,0 +1,495 @@
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from bw2_annotation_utils import cache_utils
+from bw2_annotation_utils.cache_utils import LazyJsonMapping, _MemoryCache, _file_lock, _get_cache_key, _parse_size, \
+    cache_clear, cache_data_table, cache_json, evict_cache_entries, get_cache_dir, get_default_ttl, list_cache_entries
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.temp_dir.name
+        cache_clear()
+
+    def tearDown(self):
+        cache_clear()
+        self.temp_dir.cleanup()
+
+    def _cache_files(self, suffix=""):
+        return sorted(filename for filename in os.listdir(self.cache_dir) if filename.endswith(suffix))
+
+
+class CacheKeyTests(unittest.TestCase):
+
+    def test_cache_key_does_not_depend_on_how_args_are_passed(self):
+        def get_data(genome_version, chroms=None, include_mt=False):
+            pass
+
+        key = _get_cache_key(get_data, ("38",), {})
+        self.assertEqual(_get_cache_key(get_data, (), {"genome_version": "38"}), key)
+        self.assertEqual(_get_cache_key(get_data, ("38", None), {"include_mt": False}), key)
+        self.assertNotEqual(_get_cache_key(get_data, ("37",), {}), key)
+        self.assertNotEqual(_get_cache_key(get_data, ("38",), {}, version="2"), key)
+
+        self.assertEqual(_get_cache_key(get_data, ("38", {"1", "2", "X"}), {}),
+                         _get_cache_key(get_data, ("38", {"X", "2", "1"}), {}))
+        self.assertEqual(_get_cache_key(get_data, ("38", {"a": 1, "b": 2}), {}),
+                         _get_cache_key(get_data, ("38", {"b": 2, "a": 1}), {}))
+        self.assertNotEqual(_get_cache_key(get_data, ("38", ["1", "2"]), {}),
+                            _get_cache_key(get_data, ("38", ["2", "1"]), {}))
+
+    def test_decorated_function_uses_one_cache_entry(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            calls = []
+
+            @cache_json(cache_dir=cache_dir, memory_cache=False)
+            def get_data(genome_version, include_mt=False):
+                calls.append(1)
+                return {}
+
+            get_data("38")
+            get_data(genome_version="38")
+            get_data("38", include_mt=False)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(len(list_cache_entries(cache_dir)), 1)
+
+
+class TableFormatTests(CacheTestCase):
+
+    def test_table_formats(self):
+        df = pd.DataFrame({"gene_id": ["ENSG1", "ENSG2", "ENSG3"], "start": [1, 2, 3], "score": [0.5, None, 1.0],
+                           "is_canonical": [True, False, True]})
+        for table_format in ["parquet", "feather", "tsv"]:
+            calls = []
+
+            @cache_data_table(format=table_format, cache_dir=self.cache_dir, memory_cache=False)
+            def get_table(table_format):
+                calls.append(table_format)
+                return df
+
+            pd.testing.assert_frame_equal(get_table(table_format), df)
+            pd.testing.assert_frame_equal(get_table(table_format), df)
+            pd.testing.assert_frame_equal(get_table(table_format, columns=["start", "score"]), df[["start", "score"]])
+            self.assertEqual(calls, [table_format])
+            self.assertEqual(len(self._cache_files(".tsv.gz" if table_format == "tsv" else f".{table_format}")), 1)
+
+    def test_fall_back_on_tsv(self):
+        # columns with mixed python types can't be saved as parquet
+        df = pd.DataFrame({"value": [1, "a", 2.5]})
+
+        @cache_data_table(cache_dir=self.cache_dir, memory_cache=False)
+        def get_table():
+            return df
+
+        self.assertEqual(list(get_table()["value"]), [1, "a", 2.5])
+        self.assertEqual(list(get_table()["value"].astype(str)), ["1", "a", "2.5"])
+        self.assertEqual(len(self._cache_files(".tsv.gz")), 1)
+        self.assertEqual(self._cache_files(".parquet"), [])
+
+
+JSON_DATA = {"ENSG1": {"name": "GENE1", "scores": [1, 2.5, None]}, "ENSG2": {"name": "GENE2", "scores": []}}
+
+
+class SerializerTests(CacheTestCase):
+
+    def test_serializers(self):
+        for serializer in ["orjson", "json", "msgpack"]:
+            calls = []
+
+            @cache_json(cache_dir=os.path.join(self.cache_dir, serializer), serializer=serializer, memory_cache=False)
+            def get_data():
+                calls.append(1)
+                return JSON_DATA
+
+            self.assertEqual(get_data(), JSON_DATA)
+            self.assertEqual(get_data(), JSON_DATA)
+            self.assertEqual(len(calls), 1)
+
+        with self.assertRaises(ValueError):
+            @cache_json(serializer="pickle")
+            def get_other_data():
+                return {}
+
+    def test_json_files_can_be_read_with_either_json_serializer(self):
+        calls = []
+        for serializer in ["orjson", "json", "orjson"]:
+            @cache_json(cache_dir=self.cache_dir, serializer=serializer, memory_cache=False)
+            def get_data():
+                calls.append(1)
+                return JSON_DATA
+
+            self.assertEqual(get_data(), JSON_DATA)
+        self.assertEqual(len(calls), 1)
+
+    @unittest.skipIf(cache_utils.msgpack is None, "msgpack isn't installed")
+    def test_msgpack_falls_back_on_json_files(self):
+        @cache_json(cache_dir=self.cache_dir, serializer="json", memory_cache=False)
+        def get_data():
+            return JSON_DATA
+
+        get_data()
+
+        @cache_json(cache_dir=self.cache_dir, serializer="msgpack", memory_cache=False)
+        def get_data():
+            raise AssertionError("the json cache file should be used")
+
+        self.assertEqual(get_data(), JSON_DATA)
+
+    def test_lazy_mapping(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, lazy=True)
+        def get_data():
+            calls.append(1)
+            return JSON_DATA
+
+        for _ in range(2):
+            data = get_data()
+            self.assertIsInstance(data, LazyJsonMapping)
+            self.assertEqual(len(data), 2)
+            self.assertEqual(list(data), ["ENSG1", "ENSG2"])
+            self.assertEqual(data["ENSG1"], JSON_DATA["ENSG1"])
+            self.assertIn("ENSG2", data)
+            self.assertNotIn("ENSG3", data)
+            self.assertIsNone(data.get("ENSG3"))
+            self.assertEqual(dict(data), JSON_DATA)
+        self.assertEqual(len(calls), 1)
+
+        get_data.cache_clear()
+        self.assertEqual(dict(get_data()), JSON_DATA)
+        self.assertEqual(self._cache_files(".sqlite"), [f"data.{_get_cache_key(get_data, (), {})}.sqlite"])
+
+    def test_lazy_mode_requires_a_dict(self):
+        @cache_json(cache_dir=self.cache_dir, lazy=True)
+        def get_data():
+            return [1, 2, 3]
+
+        with self.assertRaises(ValueError):
+            get_data()
+
+
+class MemoryCacheTests(CacheTestCase):
+
+    def test_results_are_copied_from_memory(self):
+        @cache_json(cache_dir=self.cache_dir)
+        def get_data(x):
+            return {"x": [x]}
+
+        self.assertEqual(get_data(1), {"x": [1]})
+        for path in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, path))
+
+        # the second call is served from memory, and changing the returned object doesn't change the cached one
+        data = get_data(1)
+        data["x"].append(2)
+        self.assertEqual(get_data(1), {"x": [1]})
+        self.assertEqual(get_data.cache_info().hits, 2)
+        self.assertEqual(get_data.cache_info().currsize, 1)
+
+        get_data.cache_clear()
+        self.assertEqual(get_data.cache_info().currsize, 0)
+
+    def test_tables_are_copied_from_memory(self):
+        @cache_data_table(cache_dir=self.cache_dir)
+        def get_table():
+            return pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+
+        df = get_table()
+        df.loc[0, "a"] = 10
+        self.assertEqual(list(get_table()["a"]), [1, 2])
+        self.assertEqual(list(get_table(columns=["b"]).columns), ["b"])
+        self.assertEqual(get_table.cache_info().hits, 2)
+
+    def test_lru_eviction(self):
+        memory_cache = _MemoryCache(max_entries=2, max_bytes=100)
+        memory_cache.put("f", "a", "value_a", 10)
+        memory_cache.put("f", "b", "value_b", 10)
+        self.assertEqual(memory_cache.get("f", "a"), "value_a")
+        memory_cache.put("f", "c", "value_c", 10)
+        self.assertIsNone(memory_cache.get("f", "b"))
+
+        # least recently used entries are evicted until the total size is within the limit
+        memory_cache.put("g", "d", "value_d", 85)
+        self.assertIsNone(memory_cache.get("f", "a"))
+        self.assertEqual(memory_cache.get("f", "c"), "value_c")
+        self.assertEqual(memory_cache.get("g", "d"), "value_d")
+
+        # entries that are larger than the whole cache aren't stored
+        memory_cache.put("g", "e", "value_e", 101)
+        self.assertIsNone(memory_cache.get("g", "e"))
+        self.assertEqual(memory_cache.info("f").currsize, 1)
+        self.assertEqual(memory_cache.info("g").currsize, 1)
+
+
+class ConcurrentCallTests(CacheTestCase):
+
+    def test_concurrent_calls_call_the_function_once(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, memory_cache=False)
+        def get_data(x):
+            calls.append(x)
+            time.sleep(0.5)
+            return {"x": x}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_data(1))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [{"x": 1}] * 4)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f.startswith(".tmp.")], [])
+
+    def test_lock_timeout(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, memory_cache=False, lock_timeout=0)
+        def get_data():
+            calls.append(1)
+            return {}
+
+        # if another process holds the lock for too long, the data is retrieved without the lock
+        lock_file_path = os.path.join(self.cache_dir, f"data.{_get_cache_key(get_data, (), {})}.lock")
+        with _file_lock(lock_file_path):
+            self.assertEqual(get_data(), {})
+        self.assertEqual(calls, [1])
+
+
+class _SourceFileHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a source file whose ETag is set by the test, and records the If-None-Match header of each request"""
+
+    def do_GET(self):
+        self.server.if_none_match_headers.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.server.etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class TtlAndRevalidationTests(CacheTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SourceFileHandler)
+        self.server.etag = '"v1"'
+        self.server.if_none_match_headers = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.source_url = f"http://127.0.0.1:{self.server.server_address[1]}/source.json"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_env_variables(self):
+        with mock.patch.dict(os.environ, {"ANNOTATIONS_CACHE_DIR": self.cache_dir, "ANNOTATIONS_CACHE_TTL": "60"}):
+            self.assertEqual(get_cache_dir(), self.cache_dir)
+            self.assertEqual(get_default_ttl(), 60)
+
+            @cache_json(memory_cache=False)
+            def get_data():
+                return {}
+
+            get_data()
+            self.assertEqual(len(list_cache_entries()), 1)
+
+        with mock.patch.dict(os.environ, {"ANNOTATIONS_CACHE_TTL": "1 week"}):
+            with self.assertRaises(ValueError):
+                get_default_ttl()
+
+    def test_expired_entries_are_refreshed(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, ttl=0.5)
+        def get_data():
+            calls.append(1)
+            return {"call": len(calls)}
+
+        self.assertEqual(get_data(), {"call": 1})
+        self.assertEqual(get_data(), {"call": 1})
+        time.sleep(0.6)
+        self.assertEqual(get_data(), {"call": 2})
+
+    def test_unchanged_source_url_is_not_downloaded_again(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, ttl=0, memory_cache=False, source_url=self.source_url)
+        def get_data():
+            calls.append(1)
+            return {"call": len(calls)}
+
+        self.assertEqual(get_data(), {"call": 1})
+        self.assertEqual(get_data(), {"call": 1})
+        self.assertEqual(self.server.if_none_match_headers, [None, '"v1"'])
+        with open(os.path.join(self.cache_dir, self._cache_files(".meta.json")[0])) as f:
+            self.assertEqual(json.load(f)["etag"], '"v1"')
+
+        self.server.etag = '"v2"'
+        self.assertEqual(get_data(), {"call": 2})
+        self.assertEqual(get_data(), {"call": 2})
+        self.assertEqual(self.server.if_none_match_headers, [None, '"v1"', '"v1"', '"v2"'])
+
+
+class StaleWhileRevalidateTests(CacheTestCase):
+
+    def _wait_for_background_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name.startswith("refresh "):
+                thread.join()
+
+    def test_stale_entries_are_returned_while_refreshing(self):
+        for memory_cache in [True, False]:
+            calls = []
+
+            @cache_json(cache_dir=os.path.join(self.cache_dir, str(memory_cache)), ttl=0.5, max_staleness=60,
+                        stale_while_revalidate=True, memory_cache=memory_cache)
+            def get_data():
+                calls.append(1)
+                time.sleep(0.2)
+                return {"call": len(calls)}
+
+            self.assertEqual(get_data(), {"call": 1})
+            time.sleep(0.6)
+
+            start_time = time.time()
+            self.assertEqual(get_data(), {"call": 1})
+            self.assertEqual(get_data(), {"call": 1})
+            self.assertLess(time.time() - start_time, 0.2)
+
+            self._wait_for_background_refresh()
+            self.assertEqual(get_data(), {"call": 2})
+            self.assertEqual(len(calls), 2)
+
+    def test_entries_past_max_staleness_are_refreshed_before_returning(self):
+        calls = []
+
+        @cache_json(cache_dir=self.cache_dir, ttl=0.2, max_staleness=0.2, stale_while_revalidate=True)
+        def get_data():
+            calls.append(1)
+            return {"call": len(calls)}
+
+        self.assertEqual(get_data(), {"call": 1})
+        time.sleep(0.5)
+        self.assertEqual(get_data(), {"call": 2})
+
+
+class FileLockTests(CacheTestCase):
+
+    def test_lock_file_deleted_while_waiting(self):
+        lock_file_path = os.path.join(self.cache_dir, "entry.0123456789.lock")
+        waiter_acquired = threading.Event()
+
+        def wait_for_lock():
+            with _file_lock(lock_file_path, timeout=10) as is_locked:
+                if is_locked:
+                    waiter_acquired.set()
+
+        with _file_lock(lock_file_path) as is_locked:
+            self.assertTrue(is_locked)
+            waiter = threading.Thread(target=wait_for_lock)
+            waiter.start()
+            time.sleep(0.2)
+
+            # delete the lock file while it's held, the way evict_cache_entries(..) does, and lock the new file that
+            # another caller creates at the same path
+            os.remove(lock_file_path)
+            new_lock = _file_lock(lock_file_path, timeout=0)
+            self.assertTrue(new_lock.__enter__())
+
+        # the waiter must not acquire the lock on the deleted file while the new lock file is held
+        self.assertFalse(waiter_acquired.wait(1.5))
+        new_lock.__exit__(None, None, None)
+        waiter.join()
+        self.assertTrue(waiter_acquired.is_set())
+
+
+class EvictionTests(CacheTestCase):
+
+    def test_evict_removes_data_metadata_and_lock_files(self):
+        @cache_json(cache_dir=self.cache_dir, memory_cache=False)
+        def get_data(x):
+            return {"x": x}
+
+        get_data(1)
+        time.sleep(0.01)
+        get_data(2)
+        self.assertTrue(any(filename.endswith(".lock") for filename in os.listdir(self.cache_dir)))
+        self.assertEqual(len(list_cache_entries(self.cache_dir)), 2)
+
+        evicted_entries = evict_cache_entries(self.cache_dir, max_versions_per_function=1)
+        self.assertEqual(len(evicted_entries), 1)
+        self.assertEqual(len(list_cache_entries(self.cache_dir)), 1)
+        evicted_files = [f for f in os.listdir(self.cache_dir) if f.startswith(evicted_entries[0]["name"] + ".")]
+        self.assertEqual(evicted_files, [])
+
+    def test_evict_least_recently_used_entries(self):
+        @cache_json(cache_dir=self.cache_dir, memory_cache=False)
+        def get_data(x):
+            return {"x": x, "padding": "a" * 1000}
+
+        for x in range(4):
+            get_data(x)
+            time.sleep(0.01)
+        get_data(0)  # the entry for 0 is now the most recently used one
+
+        entries = {entry["args"]: entry for entry in list_cache_entries(self.cache_dir)}
+        self.assertEqual(entries["x=0"]["hits"], 1)
+        max_total_bytes = entries["x=0"]["size"] + entries["x=3"]["size"]
+
+        evicted_entries = evict_cache_entries(self.cache_dir, max_total_bytes=max_total_bytes, dry_run=True)
+        self.assertEqual([entry["args"] for entry in evicted_entries], ["x=1", "x=2"])
+        self.assertEqual(len(list_cache_entries(self.cache_dir)), 4)
+
+        evict_cache_entries(self.cache_dir, max_total_bytes=max_total_bytes)
+        self.assertEqual(sorted(entry["args"] for entry in list_cache_entries(self.cache_dir)), ["x=0", "x=3"])
+
+        self.assertEqual(evict_cache_entries(self.cache_dir, max_age=60), [])
+        time.sleep(0.1)
+        self.assertEqual(len(evict_cache_entries(self.cache_dir, max_age=0.05)), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_parse_size(self):
+        self.assertEqual(_parse_size("500"), 500)
+        self.assertEqual(_parse_size("1.5K"), 1536)
+        self.assertEqual(_parse_size("10gb"), 10 * 1024**3)
+        with self.assertRaises(ValueError):
+            _parse_size("10 pages")
+
+    def test_orphaned_lock_files(self):
+        orphaned_lock_file_path = os.path.join(self.cache_dir, "old_function.0123456789.lock")
+        held_lock_file_path = os.path.join(self.cache_dir, "new_function.abcdef0123.lock")
+        open(orphaned_lock_file_path, "w").close()
+
+        self.assertEqual(list_cache_entries(self.cache_dir), [])
+        with _file_lock(held_lock_file_path):
+            evict_cache_entries(self.cache_dir)
+            self.assertFalse(os.path.exists(orphaned_lock_file_path))
+            # the lock file of an entry that another process is creating is kept
+            self.assertTrue(os.path.exists(held_lock_file_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+
+from bw2_annotation_utils.consequence_utils import SO_CONSEQUENCE_TERMS, get_consequence_code, \
+    get_consequence_codes, get_consequence_mask, get_consequence_term, get_consequence_terms, \
+    get_most_severe_consequence, has_any_consequence, to_mask_array
+
+LOF_MASK = get_consequence_mask(["stop_gained", "frameshift_variant", "splice_donor_variant"])
+
+
+class ConsequenceMaskTests(unittest.TestCase):
+
+    def test_terms_are_ordered_by_severity(self):
+        mask = get_consequence_mask(["intron_variant", "missense_variant", "stop_gained", "missense_variant"])
+        self.assertEqual(get_consequence_terms(mask), ("stop_gained", "missense_variant", "intron_variant"))
+        self.assertEqual(get_consequence_codes(mask), tuple(
+            SO_CONSEQUENCE_TERMS.index(term) for term in ["stop_gained", "missense_variant", "intron_variant"]))
+        self.assertEqual(get_most_severe_consequence(mask), "stop_gained")
+        self.assertEqual(get_consequence_mask(["missense_variant", "intron_variant", "stop_gained"]), mask)
+
+    def test_empty_mask(self):
+        self.assertEqual(get_consequence_mask([]), 0)
+        self.assertEqual(get_consequence_terms(0), ())
+        self.assertIsNone(get_most_severe_consequence(0))
+
+    def test_unknown_terms_are_less_severe_than_known_terms(self):
+        code = get_consequence_code("test_only_consequence_variant")
+        self.assertGreaterEqual(code, len(SO_CONSEQUENCE_TERMS))
+        self.assertEqual(get_consequence_code("test_only_consequence_variant"), code)
+        self.assertEqual(get_consequence_term(code), "test_only_consequence_variant")
+
+        mask = get_consequence_mask(["test_only_consequence_variant", "sequence_variant"])
+        self.assertEqual(get_consequence_terms(mask), ("sequence_variant", "test_only_consequence_variant"))
+        self.assertEqual(get_most_severe_consequence(mask), "sequence_variant")
+
+    def test_mask_arrays(self):
+        masks = [
+            get_consequence_mask(["missense_variant"]),
+            get_consequence_mask(["intron_variant", "frameshift_variant"]),
+            0,
+            get_consequence_mask(["splice_donor_variant"]),
+        ]
+        mask_array = to_mask_array(masks)
+        self.assertEqual(mask_array.dtype, np.uint64)
+        self.assertEqual(list(has_any_consequence(mask_array, LOF_MASK)), [False, True, False, True])
+
+        # masks with codes >= 64 are stored as python ints
+        large_masks = [mask | (1 << 70) for mask in masks]
+        self.assertEqual(list(has_any_consequence(np.array(large_masks, dtype=object), LOF_MASK)),
+                         [False, True, False, True])
+        self.assertEqual(list(has_any_consequence(np.array(large_masks, dtype=object), 1 << 70)), [True] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
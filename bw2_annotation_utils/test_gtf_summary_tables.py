@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bw2_annotation_utils import gtf_summary_tables
+from bw2_annotation_utils.gtf_summary_tables import _get_bundle_dir, load_gtf_summary_tables
+
+GTF_LINES = [
+    ("chr1", "gene", 100, 900, "+", 'gene_id "ENSG1.1"; gene_type "protein_coding"; gene_name "GENE1";'),
+    ("chr1", "transcript", 100, 900, "+", 'gene_id "ENSG1.1"; transcript_id "ENST1.1"; gene_type "protein_coding"; '
+        'gene_name "GENE1"; transcript_type "protein_coding"; tag "basic"; tag "Ensembl_canonical";'),
+    ("chr1", "exon", 100, 199, "+", 'gene_id "ENSG1.1"; transcript_id "ENST1.1"; exon_number 1;'),
+    ("chr1", "CDS", 150, 199, "+", 'gene_id "ENSG1.1"; transcript_id "ENST1.1"; exon_number 1;'),
+    ("chr1", "exon", 800, 900, "+", 'gene_id "ENSG1.1"; transcript_id "ENST1.1"; exon_number 2;'),
+    ("chr1", "CDS", 800, 849, "+", 'gene_id "ENSG1.1"; transcript_id "ENST1.1"; exon_number 2;'),
+    ("chr1", "transcript", 100, 500, "+", 'gene_id "ENSG1.1"; transcript_id "ENST2.1"; gene_type "protein_coding"; '
+        'gene_name "GENE1"; transcript_type "retained_intron"; tag "basic";'),
+    ("chr1", "exon", 100, 500, "+", 'gene_id "ENSG1.1"; transcript_id "ENST2.1"; exon_number 1;'),
+    ("chr2", "gene", 1000, 2000, "-", 'gene_id "ENSG2.1"; gene_type "lncRNA"; gene_name "GENE2";'),
+    ("chr2", "transcript", 1000, 2000, "-", 'gene_id "ENSG2.1"; transcript_id "ENST3.1"; gene_type "lncRNA"; '
+        'gene_name "GENE2"; transcript_type "lncRNA";'),
+    ("chr2", "exon", 1000, 2000, "-", 'gene_id "ENSG2.1"; transcript_id "ENST3.1"; exon_number 1;'),
+]
+
+
+def write_test_gtf(path):
+    with open(path, "wt") as f:
+        f.write("##description: test\n")
+        for chrom, feature, start, end, strand, info in GTF_LINES:
+            f.write("\t".join([chrom, "HAVANA", feature, str(start), str(end), ".", strand, ".", info]) + "\n")
+
+
+class GtfSummaryTablesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.gtf_path = os.path.join(self.temp_dir.name, "test.gtf")
+        self.output_dir = os.path.join(self.temp_dir.name, "bundles")
+        write_test_gtf(self.gtf_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_tables(self):
+        tables = load_gtf_summary_tables(self.gtf_path, output_dir=self.output_dir, include_MANE=False)
+        genes = tables.genes.set_index("gene_id")
+        transcripts = tables.transcripts.set_index("transcript_id")
+
+        self.assertEqual(dict(genes["num_transcripts"]), {"ENSG1.1": 2, "ENSG2.1": 1})
+        self.assertEqual(dict(transcripts["num_exons"]), {"ENST1.1": 2, "ENST2.1": 1, "ENST3.1": 1})
+        self.assertEqual(transcripts.loc["ENST1.1", "exon_length"], 201)
+        self.assertEqual(transcripts.loc["ENST1.1", "cds_length"], 100)
+        self.assertEqual(transcripts.loc["ENST1.1", "cds_start"], 150)
+        self.assertEqual(transcripts.loc["ENST2.1", "cds_length"], 0)
+        self.assertEqual(dict(transcripts["is_ensembl_canonical"]), {"ENST1.1": True, "ENST2.1": False, "ENST3.1": False})
+        self.assertEqual(len(tables.exons), 4)
+
+    def test_bundle_dir(self):
+        bundle_dir = _get_bundle_dir(self.gtf_path, self.output_dir)
+        self.assertTrue(os.path.basename(bundle_dir).startswith("test."))
+        self.assertNotEqual(bundle_dir, _get_bundle_dir(self.gtf_path, self.output_dir, include_MANE=False))
+
+        # only the .gtf and .gz extensions are removed
+        other_gtf_path = os.path.join(self.temp_dir.name, "testxgtf")
+        write_test_gtf(other_gtf_path)
+        self.assertTrue(os.path.basename(_get_bundle_dir(other_gtf_path, self.output_dir)).startswith("testxgtf."))
+
+    def test_checksum_is_only_computed_when_the_gtf_changes(self):
+        with mock.patch.object(gtf_summary_tables, "_get_file_checksum",
+                               wraps=gtf_summary_tables._get_file_checksum) as get_file_checksum:
+            bundle_dir = _get_bundle_dir(self.gtf_path, self.output_dir)
+            self.assertEqual(_get_bundle_dir(self.gtf_path, self.output_dir), bundle_dir)
+            self.assertEqual(get_file_checksum.call_count, 1)
+
+            with open(self.gtf_path, "at") as f:
+                f.write("\t".join(["chr3", "HAVANA", "gene", "1", "10", ".", "+", ".", 'gene_id "ENSG3.1";']) + "\n")
+            self.assertNotEqual(_get_bundle_dir(self.gtf_path, self.output_dir), bundle_dir)
+            self.assertEqual(get_file_checksum.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
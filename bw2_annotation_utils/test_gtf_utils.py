@@ -0,0 +1,246 @@
+import gzip
+import os
+import pickle
+import struct
+import tempfile
+import unittest
+from unittest import mock
+import zlib
+
+import pandas as pd
+
+from bw2_annotation_utils import gtf_utils
+from bw2_annotation_utils.gtf_utils import GTF_INDEX_SUFFIX, GtfIndex, GtfRecord, parse_gtf, read_gtf_table
+
+
+def make_test_gtf_lines(num_genes_per_chrom=40):
+    """Returns the lines of a small gtf file with genes on 2 chromosomes. Every 10th gene spans the next few genes."""
+    lines = ["##description: test gtf\n", "##provider: test\n"]
+    for chrom in ["chr1", "chr2"]:
+        for g in range(num_genes_per_chrom):
+            gene_id = f"ENSG{chrom[-1]}{g:04d}.1"
+            gene_start = g * 1000 + 1
+            gene_end = gene_start + (3500 if g % 10 == 0 else 800)
+            strand = "+" if g % 2 else "-"
+            gene_info = f'gene_id "{gene_id}"; gene_type "protein_coding"; gene_name "GENE{chrom[-1]}_{g}";'
+            lines.append(_gtf_line(chrom, "gene", gene_start, gene_end, strand, gene_info))
+            for t in range(2):
+                transcript_id = f"ENST{chrom[-1]}{g:04d}{t}.1"
+                transcript_info = (f'{gene_info} transcript_id "{transcript_id}"; transcript_type "protein_coding"; '
+                                   f'tag "basic";' + (' tag "Ensembl_canonical";' if t == 0 else ''))
+                lines.append(_gtf_line(chrom, "transcript", gene_start, gene_end, strand, transcript_info))
+                for e in range(3):
+                    exon_start = gene_start + e * 300
+                    exon_end = min(exon_start + 99, gene_end)
+                    exon_info = f'{transcript_info} exon_number {e + 1};'
+                    lines.append(_gtf_line(chrom, "exon", exon_start, exon_end, strand, exon_info))
+                    if t == 0:
+                        lines.append(_gtf_line(chrom, "CDS", exon_start + 10, exon_end, strand, exon_info))
+
+    return lines
+
+
+def _gtf_line(chrom, feature, start, end, strand, info):
+    return "\t".join([chrom, "HAVANA", feature, str(start), str(end), ".", strand, ".", info]) + "\n"
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    header = b"\x1f\x8b\x08\x04" + b"\x00" * 6 + struct.pack("<H", 6) + b"BC" + struct.pack(
+        "<HH", 2, len(compressed_data) + 25)
+    return header + compressed_data + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def write_bgzf(path, data, block_size=4000):
+    """Writes data bgzipped with small blocks, so that lines often span 2 blocks"""
+    with open(path, "wb") as f:
+        for i in range(0, len(data), block_size):
+            f.write(_bgzf_block(data[i:i + block_size]))
+        f.write(_bgzf_block(b""))
+
+
+class GtfTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        data = "".join(make_test_gtf_lines()).encode()
+        self.gtf_path = os.path.join(self.temp_dir.name, "test.gtf")
+        with open(self.gtf_path, "wb") as f:
+            f.write(data)
+        self.bgzipped_gtf_path = os.path.join(self.temp_dir.name, "test.gtf.bgz")
+        write_bgzf(self.bgzipped_gtf_path, data)
+        self.gzipped_gtf_path = os.path.join(self.temp_dir.name, "test.gtf.gz")
+        with gzip.open(self.gzipped_gtf_path, "wb") as f:
+            f.write(data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+
+class GtfRecordTests(GtfTestCase):
+
+    def test_lazy_records_match_dicts(self):
+        records = list(parse_gtf(self.gtf_path))
+        lazy_records = list(parse_gtf(self.gtf_path, lazy=True))
+        self.assertTrue(all(isinstance(r, GtfRecord) for r in lazy_records))
+        self.assertEqual([r.to_dict() for r in lazy_records], records)
+        self.assertEqual([dict(r) for r in parse_gtf(self.bgzipped_gtf_path, lazy=True, num_workers=2)], records)
+
+    def test_attributes_are_parsed_on_first_access(self):
+        record = next(parse_gtf(self.gtf_path, feature_type="transcript", lazy=True))
+        self.assertEqual((record["chrom"], record.start, record.end, record["feature"]), ("chr1", 1, 3501, "transcript"))
+        self.assertIsNone(record._attributes)
+        self.assertFalse(hasattr(record, "__dict__"))
+
+        self.assertEqual(record["transcript_id"], "ENST100000.1")
+        self.assertIsNotNone(record._attributes)
+        self.assertEqual(record["tag"], "basic,Ensembl_canonical")
+        self.assertEqual(record.get_all("tag"), ["basic", "Ensembl_canonical"])
+        self.assertEqual(record.get_all("ont"), [])
+        self.assertEqual(record.get_all("start"), [1])
+        self.assertIn("gene_name", record)
+        self.assertNotIn("exon_number", record)
+        self.assertIsNone(record.get("exon_number"))
+        with self.assertRaises(KeyError):
+            record["exon_number"]
+
+    def test_pickling(self):
+        record = next(parse_gtf(self.gtf_path, feature_type="exon", lazy=True))
+        unpickled_record = pickle.loads(pickle.dumps(record))
+        self.assertIsInstance(unpickled_record, GtfRecord)
+        self.assertEqual(unpickled_record.to_dict(), record.to_dict())
+
+
+class ParallelParsingTests(GtfTestCase):
+
+    def test_parse_gtf_matches_serial_parsing(self):
+        expected = list(parse_gtf(self.gtf_path))
+        expected_exons = [r for r in expected if r["feature"] == "exon"]
+        # use small chunks so that chunk boundaries fall in the middle of lines and bgzip blocks
+        with mock.patch.object(gtf_utils, "PARSE_GTF_CHUNK_SIZE", 5000):
+            for gtf_path in [self.gtf_path, self.bgzipped_gtf_path]:
+                self.assertEqual(list(parse_gtf(gtf_path, num_workers=3)), expected)
+                self.assertEqual(list(parse_gtf(gtf_path, feature_type="exon", num_workers=2)), expected_exons)
+
+    def test_gzipped_gtf_is_parsed_in_one_process(self):
+        expected = list(parse_gtf(self.gtf_path))
+        with mock.patch.object(gtf_utils, "ProcessPoolExecutor") as process_pool_executor:
+            self.assertEqual(list(parse_gtf(self.gzipped_gtf_path, num_workers=2)), expected)
+            self.assertEqual(process_pool_executor.call_count, 0)
+
+    def test_read_gtf_table_matches_serial_parsing(self):
+        expected = read_gtf_table(self.gtf_path, attributes=["gene_id", "tag"])
+        for gtf_path in [self.gtf_path, self.bgzipped_gtf_path]:
+            df = read_gtf_table(gtf_path, attributes=["gene_id", "tag"], num_workers=3)
+            pd.testing.assert_frame_equal(df.astype(str), expected.astype(str))
+
+    def test_split_covers_every_line_once(self):
+        with open(self.gtf_path, "rb") as f:
+            expected_lines = [line for line in f if not line.startswith(b"#")]
+        for gtf_path in [self.gtf_path, self.bgzipped_gtf_path]:
+            for num_workers in [2, 7]:
+                gtf_chunks = gtf_utils._split_gtf_for_parallel_parsing(gtf_path, num_workers)
+                self.assertGreater(len(gtf_chunks), 1)
+                lines = [line for gtf_chunk in gtf_chunks for line in gtf_utils._iter_gtf_chunk_lines(gtf_path, gtf_chunk)]
+                self.assertEqual(lines, expected_lines)
+
+    def test_results_in_flight_are_bounded(self):
+        class Executor:
+            def __init__(self):
+                self.futures = []
+
+            def submit(self, func, *args):
+                future = mock.Mock(result=mock.Mock(return_value=func(*args)))
+                self.futures.append(future)
+                return future
+
+        executor = Executor()
+        results = gtf_utils._iter_results_in_order(executor, lambda x: x * 2, [(i,) for i in range(10)], max_in_flight=3)
+        self.assertEqual([next(results) for _ in range(2)], [0, 2])
+        self.assertEqual(len(executor.futures), 4)
+
+        # closing the generator early cancels the tasks that were submitted but not yet yielded
+        results.close()
+        self.assertEqual([f.cancel.call_count for f in executor.futures], [0, 0, 1, 1])
+
+
+class ReadGtfTableTests(GtfTestCase):
+
+    def test_table_matches_parse_gtf(self):
+        attributes = ["gene_id", "transcript_id", "tag", "exon_number"]
+        records = list(parse_gtf(self.gtf_path, feature_type="exon"))
+        for gtf_path in [self.gtf_path, self.gzipped_gtf_path]:
+            df = read_gtf_table(gtf_path, feature_type="exon", attributes=attributes, chunk_size=100)
+            self.assertEqual(list(df.columns), ["chrom", "source", "feature", "start", "end", "strand"] + attributes)
+            self.assertEqual(str(df["start"].dtype), "int32")
+            self.assertEqual(str(df["gene_id"].dtype), "category")
+
+            self.assertEqual(len(df), len(records))
+            self.assertEqual(df.astype({c: str for c in df.columns if c not in ("start", "end")}).to_dict("records"), [
+                {k: r[k] for k in df.columns} for r in records
+            ])
+            self.assertEqual(df["tag"].iloc[0], "basic,Ensembl_canonical")
+
+    def test_missing_attributes(self):
+        df = read_gtf_table(self.gtf_path, attributes=["gene_id", "transcript_id", "not_an_attribute"])
+        self.assertEqual(len(df), len(list(parse_gtf(self.gtf_path))))
+        self.assertTrue(df.loc[df["feature"] == "gene", "transcript_id"].isna().all())
+        self.assertFalse(df.loc[df["feature"] != "gene", "transcript_id"].isna().any())
+        self.assertTrue(df["not_an_attribute"].isna().all())
+
+    def test_invalid_feature_type(self):
+        with self.assertRaises(ValueError):
+            read_gtf_table(self.gtf_path, feature_type="intron")
+
+    def test_empty_result(self):
+        df = read_gtf_table(self.gtf_path, feature_type="UTR")
+        self.assertEqual(len(df), 0)
+        self.assertIn("gene_id", df.columns)
+
+
+class GtfIndexTests(GtfTestCase):
+
+    def test_get_gene_and_transcript(self):
+        records = list(parse_gtf(self.gtf_path))
+        for gtf_path in [self.gtf_path, self.bgzipped_gtf_path]:
+            with GtfIndex(gtf_path) as gtf_index:
+                self.assertEqual(gtf_index.get_gene("ENSG10005.1"),
+                                 [r for r in records if r["gene_id"] == "ENSG10005.1"])
+                self.assertEqual(gtf_index.get_transcript("ENST200121.1", feature_type="exon"),
+                                 [r for r in records if r.get("transcript_id") == "ENST200121.1" and
+                                  r["feature"] == "exon"])
+                self.assertEqual(gtf_index.get_gene("ENSG_MISSING"), [])
+                self.assertEqual(gtf_index.get_transcript("ENST_MISSING"), [])
+
+    def test_query_region_matches_brute_force(self):
+        records = list(parse_gtf(self.gtf_path))
+        with GtfIndex(self.bgzipped_gtf_path) as gtf_index:
+            for chrom, start, end in [("chr1", 2500, 2600), ("chr2", 10950, 11100), ("chr1", 1, 100000),
+                                      ("chr2", 39900, 50000), ("chr3", 1, 1000)]:
+                expected = [r for r in records if r["chrom"] == chrom and r["start"] <= end and r["end"] >= start]
+                actual = gtf_index.query_region(chrom, start, end)
+                key = lambda r: (r["start"], r["end"], r["feature"], r.get("transcript_id", ""), r.get("exon_number", ""))
+                self.assertEqual(sorted(actual, key=key), sorted(expected, key=key))
+
+    def test_truncated_index_is_rebuilt(self):
+        with GtfIndex(self.gtf_path) as gtf_index:
+            expected = gtf_index.get_gene("ENSG10005.1")
+
+        index_path = f"{self.gtf_path}{GTF_INDEX_SUFFIX}"
+        with open(index_path, "rb") as f:
+            index_data = f.read()
+        with open(index_path, "wb") as f:
+            f.write(index_data[:len(index_data) // 2])
+
+        with GtfIndex(self.gtf_path) as gtf_index:
+            self.assertEqual(gtf_index.get_gene("ENSG10005.1"), expected)
+        self.assertFalse([filename for filename in os.listdir(self.temp_dir.name) if filename.startswith(".tmp.")])
+
+    def test_gzipped_gtf_is_rejected(self):
+        with self.assertRaises(ValueError):
+            GtfIndex(self.gzipped_gtf_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from bw2_annotation_utils import interval_index
+from bw2_annotation_utils.interval_index import IntervalIndex
+
+
+def make_random_intervals(rng, num_intervals, chroms=("chr1", "chr2")):
+    # mostly short intervals, plus a few very long ones like long genes
+    lengths = np.where(rng.random(num_intervals) < 0.05, rng.integers(1, 100_000, num_intervals),
+                       rng.integers(1, 500, num_intervals))
+    starts = rng.integers(1, 200_000, num_intervals)
+    return rng.choice(chroms, num_intervals), starts, starts + lengths - 1
+
+
+def brute_force_overlaps(chroms, starts, ends, query_chroms, query_starts, query_ends):
+    pairs = []
+    for q in range(len(query_starts)):
+        overlaps = (chroms == query_chroms[q]) & (starts <= query_ends[q]) & (ends >= query_starts[q])
+        pairs.extend((q, i) for i in np.flatnonzero(overlaps))
+    return pairs
+
+
+class IntervalIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.chroms, self.starts, self.ends = make_random_intervals(self.rng, 2000)
+        self.index = IntervalIndex(self.chroms, self.starts, self.ends)
+
+    def test_query_ranges_matches_brute_force(self):
+        query_chroms, query_starts, query_ends = make_random_intervals(self.rng, 300, chroms=("chr1", "chr2", "chr3"))
+        query_indices, interval_indices = self.index.query_ranges(query_chroms, query_starts, query_ends)
+        self.assertEqual(list(zip(query_indices, interval_indices)), brute_force_overlaps(
+            self.chroms, self.starts, self.ends, query_chroms, query_starts, query_ends))
+
+    def test_query_points_matches_brute_force(self):
+        query_chroms = self.rng.choice(["chr1", "chr2"], 500)
+        positions = self.rng.integers(1, 300_000, 500)
+        # also query the exact start and end of some intervals, since intervals are inclusive
+        query_chroms = np.concatenate([query_chroms, self.chroms[:50], self.chroms[:50]])
+        positions = np.concatenate([positions, self.starts[:50], self.ends[:50]])
+
+        query_indices, interval_indices = self.index.query_points(query_chroms, positions)
+        expected = brute_force_overlaps(self.chroms, self.starts, self.ends, query_chroms, positions, positions)
+        self.assertEqual(list(zip(query_indices, interval_indices)), expected)
+
+        counts = self.index.count_overlaps(query_chroms, positions)
+        self.assertEqual(list(counts), list(np.bincount([q for q, _ in expected], minlength=len(positions))))
+
+    def test_queries_are_split_into_batches(self):
+        query_chroms, query_starts, query_ends = make_random_intervals(self.rng, 300)
+        expected = self.index.query_ranges(query_chroms, query_starts, query_ends)
+        with mock.patch.object(interval_index, "MAX_CANDIDATES_PER_BATCH", 7):
+            actual = self.index.query_ranges(query_chroms, query_starts, query_ends)
+
+        np.testing.assert_array_equal(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+
+    def test_from_records_and_dataframe(self):
+        records = [
+            {"chrom": "chr1", "start": 100, "end": 200},
+            {"chrom": "chr1", "start": 150, "end": 150},
+            {"chrom": "chr2", "start": 100, "end": 200},
+        ]
+        df = pd.DataFrame(records, index=[10, 20, 30]).astype({"chrom": "category"})
+        for index in [IntervalIndex.from_records(records), IntervalIndex.from_records(iter(records)),
+                      IntervalIndex.from_dataframe(df)]:
+            query_indices, interval_indices = index.query_points(["chr1", "chr1", "chr2", "chrX"], [150, 201, 100, 150])
+            self.assertEqual(list(zip(query_indices, interval_indices)), [(0, 0), (0, 1), (2, 2)])
+
+    def test_empty_index_and_queries(self):
+        index = IntervalIndex([], [], [])
+        self.assertEqual(list(index.count_overlaps(["chr1"], [100])), [0])
+
+        query_indices, interval_indices = self.index.query_points([], [])
+        self.assertEqual(len(query_indices), 0)
+        self.assertEqual(len(interval_indices), 0)
+
+    def test_invalid_intervals(self):
+        with self.assertRaises(ValueError):
+            IntervalIndex(["chr1"], [200], [100])
+        with self.assertRaises(ValueError):
+            IntervalIndex(["chr1", "chr2"], [100], [200])
+
+
+if __name__ == "__main__":
+    unittest.main()
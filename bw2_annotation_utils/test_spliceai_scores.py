@@ -0,0 +1,88 @@
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import urllib.parse
+
+from bw2_annotation_utils import spliceai_scores
+from bw2_annotation_utils.spliceai_scores import get_spliceai_scores_for_variants
+
+
+class _SpliceAIHandler(http.server.BaseHTTPRequestHandler):
+	"""Mimics the SpliceAI-lookup API. The alt allele of the requested variant selects the response."""
+
+	def do_GET(self):
+		variant = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)["variant"][0]
+		self.server.requested_variants.append(variant)
+		alt = variant.split("-")[-1]
+		if alt == "ERROR":
+			self._send(200, json.dumps({"error": "invalid variant"}))
+		elif alt == "NOTFOUND":
+			self._send(404, "not found")
+		elif alt == "HTML":
+			self._send(200, "<html>rate limited</html>")
+		else:
+			self._send(200, json.dumps({"scores": [
+				{"DS_AG": "0.10", "DS_DG": "0.20", "DS_AL": "0.00", "DS_DL": "0.05"},
+				{"DS_AG": "0.30", "DS_DG": "0.00", "DS_AL": "0.40", "DS_DL": "0.00"},
+			]}))
+
+	def _send(self, status, body):
+		self.send_response(status)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body.encode())
+
+	def log_message(self, *args):
+		pass
+
+
+class SpliceAIScoresTests(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.cache_path = os.path.join(self.temp_dir.name, "spliceai_scores.sqlite")
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SpliceAIHandler)
+		self.server.requested_variants = []
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		url = f"http://127.0.0.1:{self.server.server_address[1]}/spliceai-{{genome}}/"
+		self.url_patcher = mock.patch.object(spliceai_scores, "SPLICEAI_API_URL", url)
+		self.url_patcher.start()
+
+	def tearDown(self):
+		self.url_patcher.stop()
+		self.server.shutdown()
+		self.server.server_close()
+		self.temp_dir.cleanup()
+
+	def _get_scores(self, variants, **kwargs):
+		return get_spliceai_scores_for_variants(variants, cache_path=self.cache_path, max_retries=0, **kwargs)
+
+	def test_scores_are_cached(self):
+		variants = [("chr1", 100, "A", "G"), ("1", 100, "A", "G"), ("chrX", 200, "C", "T")]
+		expected = {"1-100-A-G": (0.3, 0.4), "X-200-C-T": (0.3, 0.4)}
+		self.assertEqual(self._get_scores(variants), expected)
+		self.assertEqual(sorted(self.server.requested_variants), ["1-100-A-G", "X-200-C-T"])
+
+		self.assertEqual(self._get_scores(variants), expected)
+		self.assertEqual(len(self.server.requested_variants), 2)
+
+		# scores are cached separately for each genome, distance and mask
+		self.assertEqual(self._get_scores(variants[:1], distance=50), {"1-100-A-G": (0.3, 0.4)})
+		self.assertEqual(len(self.server.requested_variants), 3)
+
+	def test_failed_requests_are_left_out_and_not_cached(self):
+		variants = [("1", 100, "A", "ERROR"), ("1", 200, "A", "NOTFOUND"), ("1", 300, "A", "HTML"), ("1", 400, "A", "G")]
+		for _ in range(2):
+			self.assertEqual(self._get_scores(variants, max_concurrent_requests=2), {"1-400-A-G": (0.3, 0.4)})
+		self.assertEqual(sorted(self.server.requested_variants), [
+			"1-100-A-ERROR", "1-100-A-ERROR", "1-200-A-NOTFOUND", "1-200-A-NOTFOUND", "1-300-A-HTML", "1-300-A-HTML",
+			"1-400-A-G",
+		])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,7 +1,9 @@
+import gzip
 import hailtop.fs as hfs
 import logging
 import os
 import re
+import struct
 
 from step_pipeline import pipeline, Backend, Localize, Delocalize, files_exist
 
@@ -15,6 +17,281 @@ DOCKER_IMAGE = "annotation/nirvana:3.14"
 
 NIRVANA_REF_DATA_BUCKET = "gs://ttn-neb-analysis"
 
+# Resources of each Nirvana step, based on the total size of the vcf(s) or vcf shard it annotates. Each row is
+# (max vcf size in GB, cpu, memory, storage in GB), and the first row whose max size is >= the vcf size is used.
+# This can be overridden with --resources-table.
+DEFAULT_RESOURCES_TABLE = [
+    (1, 1, "standard", 20),
+    (10, 2, "standard", 50),
+    (50, 4, "standard", 150),
+    (float("inf"), 8, "highmem", 400),
+]
+
+# vcfs smaller than this are packed together into steps that run Nirvana on each of them one after the other
+DEFAULT_PACK_VCFS_SMALLER_THAN_GB = 1
+DEFAULT_MAX_VCFS_PER_STEP = 20
+
+# Concatenates the per-shard Nirvana JSONs (decompressed and in position order) into one Nirvana JSON. Nirvana writes
+# the header and the start of the positions array on the first line, one position per line, and then an optional
+# "genes" section with one gene per line. Genes that overlap more than one shard are only kept once.
+MERGE_NIRVANA_JSONS_AWK_SCRIPT = r"""
+/^\{"header":/ { if (!printed_header) { print; printed_header = 1 }; section = "positions"; next }
+/^\]/ { section = ($0 ~ /"genes":\[/) ? "genes" : ""; next }
+section == "positions" && NF { sub(/,$/, ""); printf "%s%s", (num_positions++ ? ",\n" : ""), $0 }
+section == "genes" && NF { sub(/,$/, ""); if (!($0 in seen_genes)) { seen_genes[$0] = 1; genes[num_genes++] = $0 } }
+END {
+    printf "%s]", (num_positions ? "\n" : "")
+    if (num_genes) {
+        printf ",\"genes\":[\n"
+        for (i = 0; i < num_genes; i++) printf "%s%s", (i ? ",\n" : ""), genes[i]
+        printf "\n]"
+    }
+    print "}"
+}
+"""
+
+
+def load_resources_table(path):
+    """Loads a resources table from a tsv file with columns: max_vcf_size_gb, cpu, memory, storage_gb. max_vcf_size_gb
+    can be "inf" for the last row.
+
+    Return:
+        list: (max vcf size in GB, cpu, memory, storage in GB) tuples sorted by max vcf size
+    """
+    resources_table = []
+    with open(path) as f:
+        header = f.readline().strip().split("\t")
+        if header != ["max_vcf_size_gb", "cpu", "memory", "storage_gb"]:
+            raise ValueError(f"{path} header should be: max_vcf_size_gb, cpu, memory, storage_gb. Found: {header}")
+        for line in f:
+            if not line.strip():
+                continue
+            max_vcf_size_gb, cpu, memory, storage_gb = line.strip().split("\t")
+            cpu = int(cpu) if cpu.isdigit() else float(cpu)
+            resources_table.append((float(max_vcf_size_gb), cpu, memory, int(storage_gb)))
+
+    return sorted(resources_table)
+
+
+def get_step_resources(vcf_size, resources_table=DEFAULT_RESOURCES_TABLE):
+    """Returns the (cpu, memory, storage) to use for a Nirvana step that annotates vcf(s) with the given total size in
+    bytes
+    """
+    for max_vcf_size_gb, cpu, memory, storage_gb in resources_table:
+        if vcf_size <= max_vcf_size_gb * 10**9:
+            return cpu, memory, f"{storage_gb}Gi"
+
+    raise ValueError(f"The resources table doesn't have a row for vcfs of size {vcf_size / 10**9:0.1f}GB")
+
+
+def pack_vcfs(vcf_sizes, max_vcfs_per_step=DEFAULT_MAX_VCFS_PER_STEP,
+              max_total_size=DEFAULT_PACK_VCFS_SMALLER_THAN_GB * DEFAULT_MAX_VCFS_PER_STEP * 10**9):
+    """Splits vcfs into groups of at most max_vcfs_per_step vcfs with a total size of at most max_total_size bytes
+    (unless a single vcf is larger). vcfs are grouped in order of size so that each group has vcfs of similar size.
+    vcfs with the same filename are put in different groups, since their local paths and outputs would collide.
+
+    Args:
+        vcf_sizes (dict): maps vcf path to size in bytes
+
+    Return:
+        list: lists of vcf paths
+    """
+    groups = []
+    current_group = []
+    current_group_size = 0
+    for vcf_path in sorted(vcf_sizes, key=vcf_sizes.get):
+        if current_group and (len(current_group) >= max_vcfs_per_step or
+                              current_group_size + vcf_sizes[vcf_path] > max_total_size or
+                              os.path.basename(vcf_path) in {os.path.basename(p) for p in current_group}):
+            groups.append(current_group)
+            current_group = []
+            current_group_size = 0
+        current_group.append(vcf_path)
+        current_group_size += vcf_sizes[vcf_path]
+
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+
+def get_indexed_contigs(vcf_path):
+    """Returns the contigs listed in the vcf's tabix index, in the order in which they appear in the vcf. The index
+    only lists contigs that have at least one record.
+    """
+    with hfs.open(f"{vcf_path}.tbi", "rb") as f:
+        data = gzip.GzipFile(fileobj=f).read()
+
+    if data[:4] != b"TBI\x01":
+        raise ValueError(f"{vcf_path}.tbi isn't a tabix index")
+
+    # header: magic, then n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm as int32s, then the names
+    names_length = struct.unpack("<i", data[32:36])[0]
+    return [name.decode() for name in data[36:36 + names_length].split(b"\x00") if name]
+
+
+def get_contig_lengths(vcf_path):
+    """Returns a dict that maps contig name to length, based on the ##contig lines in the vcf header"""
+    contig_lengths = {}
+    with hfs.open(vcf_path, "rb") as f:
+        for line in gzip.GzipFile(fileobj=f):
+            line = line.decode()
+            if line.startswith("#CHROM"):
+                break
+            match = re.match("##contig=<.*ID=([^,>]+).*length=([0-9]+)", line)
+            if match:
+                contig_lengths[match.group(1)] = int(match.group(2))
+
+    return contig_lengths
+
+
+def get_shard_regions(vcf_path, shard_size=None):
+    """Splits the vcf into (chrom, start, end) regions, in the order in which they appear in the vcf: one per contig,
+    or, if shard_size is specified, intervals of shard_size base pairs.
+    """
+    contigs = get_indexed_contigs(vcf_path)
+    if not shard_size:
+        return [(chrom, 1, None) for chrom in contigs]
+
+    contig_lengths = get_contig_lengths(vcf_path)
+    regions = []
+    for chrom in contigs:
+        if chrom not in contig_lengths:
+            logger.warning(f"{vcf_path} header doesn't have a ##contig line with the length of {chrom}. "
+                           f"Annotating all of {chrom} in one shard.")
+            regions.append((chrom, 1, None))
+            continue
+        for start in range(1, contig_lengths[chrom] + 1, shard_size):
+            regions.append((chrom, start, min(start + shard_size - 1, contig_lengths[chrom])))
+
+    return regions
+
+
+def add_nirvana_command(step, nirvana_bucket, local_input_vcf, output_prefix):
+    step.command(f"""dotnet /opt/nirvana/Nirvana.dll \
+        -c {nirvana_bucket}/Nirvana/Data/Cache/GRCh38/Both \
+        -r {nirvana_bucket}/Nirvana/Data/References/Homo_sapiens.GRCh38.Nirvana.dat \
+        --sd {nirvana_bucket}/Nirvana/Data/SupplementaryAnnotation/GRCh38 \
+        -i {local_input_vcf} \
+        -o {output_prefix}
+    """)
+
+
+def add_sharded_nirvana_steps(bp, vcf_path, filename_prefix, output_dir, shard_size=None, vcf_size=None,
+                              resources_table=DEFAULT_RESOURCES_TABLE):
+    """Adds one Nirvana step per genomic shard of the vcf, and a step that merges the per-shard Nirvana JSONs into
+    {filename_prefix}.nirvana.json.gz and rebuilds its .jsi index. Shards are extracted from the vcf with tabix, and
+    the merged JSON is compressed with bgzip, so both must be available in DOCKER_IMAGE. If vcf_size is specified,
+    the resources of each shard step are based on the average shard size.
+    """
+    shard_regions = get_shard_regions(vcf_path, shard_size=shard_size)
+    num_cpu, memory, storage = get_step_resources(vcf_size / max(len(shard_regions), 1), resources_table) \
+        if vcf_size is not None else (2, None, "100Gi")
+    merge_storage = get_step_resources(vcf_size, resources_table)[2] if vcf_size is not None else "100Gi"
+    shard_output_dir = os.path.join(output_dir, f"{filename_prefix}.nirvana_shards")
+    print(f"Splitting {vcf_path} into {len(shard_regions)} shards")
+
+    shard_steps = []
+    shard_output_paths = []
+    for i, (chrom, start, end) in enumerate(shard_regions):
+        region = chrom if end is None else f"{chrom}:{start}-{end}"
+        shard_prefix = f"{filename_prefix}.shard_{i:05d}.nirvana"
+        s1 = bp.new_step(
+            f"run Nirvana: {filename_prefix} {region}",
+            arg_suffix=f"dv",
+            image=DOCKER_IMAGE,
+            step_number=1,
+            cpu=num_cpu,
+            memory=memory,
+            storage=storage,
+            localize_by=Localize.COPY,
+            delocalize_by=Delocalize.COPY,
+            output_dir=shard_output_dir)
+
+        # the shard is read from the vcf using its tabix index, so the vcf doesn't need to be copied to each step
+        nirvana_bucket = s1.input(NIRVANA_REF_DATA_BUCKET, localize_by=Localize.HAIL_BATCH_CLOUDFUSE)
+        local_input_vcf = s1.input(vcf_path, localize_by=Localize.HAIL_BATCH_CLOUDFUSE)
+        s1.input(f"{vcf_path}.tbi", localize_by=Localize.HAIL_BATCH_CLOUDFUSE)
+
+        s1.command("set -ex")
+        # tabix also returns records that start before the region and overlap it. Skip those so that each record is
+        # only annotated in the shard that contains its start position.
+        s1.command(f"tabix -h {local_input_vcf} {region} | awk -F '\\t' '/^#/ || $2 >= {start}' | bgzip > shard.vcf.gz")
+        add_nirvana_command(s1, nirvana_bucket, "shard.vcf.gz", shard_prefix)
+        s1.output(f"{shard_prefix}.json.gz")
+
+        shard_steps.append(s1)
+        shard_output_paths.append(os.path.join(shard_output_dir, f"{shard_prefix}.json.gz"))
+
+    output_prefix = f"{filename_prefix}.nirvana"
+    s2 = bp.new_step(
+        f"merge Nirvana shards: {filename_prefix}",
+        arg_suffix=f"merge",
+        image=DOCKER_IMAGE,
+        step_number=2,
+        cpu=1,
+        storage=merge_storage,
+        localize_by=Localize.COPY,
+        delocalize_by=Delocalize.COPY,
+        output_dir=output_dir)
+
+    for s1 in shard_steps:
+        s2.depends_on(s1)
+    local_shard_jsons = [s2.input(path) for path in shard_output_paths]
+
+    s2.command("set -ex")
+    s2.command(f"cat <<'EOF' > merge_nirvana_jsons.awk{MERGE_NIRVANA_JSONS_AWK_SCRIPT}EOF")
+    s2.command(f"for f in {' '.join(str(p) for p in local_shard_jsons)}; do gzip -dc $f; done "
+               f"| awk -f merge_nirvana_jsons.awk | bgzip > {output_prefix}.json.gz")
+    s2.command(f"dotnet /opt/nirvana/Jasix.dll --index --in {output_prefix}.json.gz")
+    s2.output(f"{output_prefix}.json.gz")
+    s2.output(f"{output_prefix}.json.gz.jsi")
+    s2.command(f"date")
+
+
+def add_nirvana_step(bp, vcf_paths, output_dirs, vcf_size=None, resources_table=DEFAULT_RESOURCES_TABLE):
+    """Adds a step that runs Nirvana on each of the given vcfs one after the other, so that small vcfs can share one
+    step (and its reference data mount) rather than each getting their own. Each vcf's outputs are written to the
+    corresponding directory in output_dirs.
+
+    Args:
+        vcf_paths (list): gs:// paths of the vcfs to annotate
+        output_dirs (list): output directory of each vcf
+        vcf_size (int): total size of the vcfs in bytes, used to choose the step's resources from resources_table
+    """
+    filename_prefixes = [re.sub(".vcf(.gz)?$", "", os.path.basename(vcf_path)) for vcf_path in vcf_paths]
+    step_name = filename_prefixes[0] if len(vcf_paths) == 1 else \
+        f"{len(vcf_paths)} vcfs ({filename_prefixes[0]}, ..., {filename_prefixes[-1]})"
+    num_cpu, memory, storage = get_step_resources(vcf_size, resources_table) if vcf_size is not None else \
+        (2, None, "100Gi")
+
+    s1 = bp.new_step(
+        f"run Nirvana: {step_name}",
+        arg_suffix=f"dv",
+        image=DOCKER_IMAGE,
+        step_number=1,
+        cpu=num_cpu,
+        memory=memory,
+        storage=storage,
+        #localize_by=Localize.HAIL_BATCH_CLOUDFUSE,
+        localize_by=Localize.COPY,
+        delocalize_by=Delocalize.COPY,
+        output_dir=output_dirs[0])
+
+    # set job inputs & outputs
+    nirvana_bucket = s1.input(NIRVANA_REF_DATA_BUCKET, localize_by=Localize.HAIL_BATCH_CLOUDFUSE)
+    s1.command("set -ex")
+    for vcf_path, filename_prefix, output_dir in zip(vcf_paths, filename_prefixes, output_dirs):
+        local_input_vcf = s1.input(vcf_path)
+
+        output_prefix = f"{filename_prefix}.nirvana"
+        add_nirvana_command(s1, nirvana_bucket, local_input_vcf, output_prefix)
+
+        s1.output(f"{output_prefix}.json.gz", output_dir=output_dir)
+        s1.output(f"{output_prefix}.json.gz.jsi", output_dir=output_dir)
+    s1.command(f"date")
+
+
 def main():
 
     bp = pipeline("run Nirvana", backend=Backend.HAIL_BATCH_SERVICE, config_file_path="~/.step_pipeline")
@@ -23,6 +300,19 @@ def main():
     #parser.add_argument("--reference-fasta-fai", default=REFERENCE_FASTA_FAI_PATH)
     parser.add_argument("--output-dir", help="Default is the same directory as the input vcf")
     parser.add_argument("-n", type=int, help="Only process the first n inputs. Useful for testing.")
+    parser.add_argument("--shard-by-chrom", action="store_true", help="Run Nirvana on each chromosome of a vcf in "
+                        "a separate step, and then merge the outputs. Requires the vcfs to have a tabix index (.tbi)")
+    parser.add_argument("--shard-size", type=int, help="Run Nirvana on intervals of this many base pairs in "
+                        "separate steps, and then merge the outputs. Implies --shard-by-chrom")
+    parser.add_argument("--resources-table", help="tsv file with columns max_vcf_size_gb, cpu, memory, storage_gb "
+                        "that sets the resources of each step based on the size of the vcf(s) it annotates. The first "
+                        "row whose max_vcf_size_gb is >= the vcf size is used. See DEFAULT_RESOURCES_TABLE for the "
+                        "default")
+    parser.add_argument("--pack-vcfs-smaller-than", type=float, default=DEFAULT_PACK_VCFS_SMALLER_THAN_GB,
+                        help="vcfs smaller than this many GB are annotated in steps that process several vcfs one "
+                        "after the other. Set to 0 to run each vcf in its own step.")
+    parser.add_argument("--max-vcfs-per-step", type=int, default=DEFAULT_MAX_VCFS_PER_STEP,
+                        help="Max number of small vcfs to annotate in one step")
     parser.add_argument("vcf_list", action="append",
                         help="Either a list of gs:// paths, or a text file containing a list of gs:// paths")
     args = bp.parse_known_args()
@@ -36,48 +326,43 @@ def main():
     if args.n:
         args.vcf_list = args.vcf_list[:args.n]
 
+    resources_table = load_resources_table(args.resources_table) if args.resources_table else \
+        DEFAULT_RESOURCES_TABLE
+
+    vcf_sizes = {}
     for i, vcf_path in enumerate(args.vcf_list):
         if not vcf_path.startswith("gs://"):
             parser.error(f"VCF path #{i+1} doesn't start with gs://: '{vcf_path}'")
         if not hfs.exists(vcf_path):
             parser.error(f"VCF file doesn't exist: {vcf_path}")
+        if (args.shard_by_chrom or args.shard_size) and not hfs.exists(f"{vcf_path}.tbi"):
+            parser.error(f"VCF file doesn't have a tabix index, which is required for sharding: {vcf_path}.tbi")
+        vcf_sizes[vcf_path] = hfs.stat(vcf_path).size
 
-    for vcf_path in args.vcf_list:
-        print("Annotating ", vcf_path)
+    def get_output_dir(vcf_path):
+        return args.output_dir or os.path.dirname(vcf_path)
 
-        filename_prefix = re.sub(".vcf(.gz)?$", "", os.path.basename(vcf_path))
-        output_dir = args.output_dir or os.path.dirname(vcf_path)
+    if args.shard_by_chrom or args.shard_size:
+        for vcf_path in args.vcf_list:
+            print("Annotating ", vcf_path)
+            filename_prefix = re.sub(".vcf(.gz)?$", "", os.path.basename(vcf_path))
+            add_sharded_nirvana_steps(bp, vcf_path, filename_prefix, get_output_dir(vcf_path),
+                                      shard_size=args.shard_size, vcf_size=vcf_sizes[vcf_path],
+                                      resources_table=resources_table)
+    else:
+        pack_threshold = args.pack_vcfs_smaller_than * 10**9
+        small_vcf_sizes = {vcf_path: size for vcf_path, size in vcf_sizes.items() if size < pack_threshold}
+        vcf_groups = [[vcf_path] for vcf_path in args.vcf_list if vcf_path not in small_vcf_sizes]
+        vcf_groups += pack_vcfs(small_vcf_sizes, max_vcfs_per_step=args.max_vcfs_per_step,
+                                max_total_size=pack_threshold * args.max_vcfs_per_step)
+        print(f"Annotating {len(args.vcf_list)} vcfs in {len(vcf_groups)} steps")
 
-        num_cpu = 2
-        s1 = bp.new_step(
-            f"run Nirvana: {filename_prefix}",
-            arg_suffix=f"dv",
-            image=DOCKER_IMAGE,
-            step_number=1,
-            cpu=num_cpu,
-            storage="100Gi",
-            #localize_by=Localize.HAIL_BATCH_CLOUDFUSE,
-            localize_by=Localize.COPY,
-            delocalize_by=Delocalize.COPY,
-            output_dir=output_dir)
-
-        # set job inputs & outputs
-        nirvana_bucket = s1.input(NIRVANA_REF_DATA_BUCKET, localize_by=Localize.HAIL_BATCH_CLOUDFUSE)
-        local_input_vcf = s1.input(vcf_path)
-
-        output_prefix = f"{filename_prefix}.nirvana"
-        s1.command("set -ex")
-        s1.command(f"""dotnet /opt/nirvana/Nirvana.dll \
-            -c {nirvana_bucket}/Nirvana/Data/Cache/GRCh38/Both \
-            -r {nirvana_bucket}/Nirvana/Data/References/Homo_sapiens.GRCh38.Nirvana.dat \
-            --sd {nirvana_bucket}/Nirvana/Data/SupplementaryAnnotation/GRCh38 \
-            -i {local_input_vcf} \
-            -o {output_prefix}
-        """)
-
-        s1.output(f"{output_prefix}.json.gz")
-        s1.output(f"{output_prefix}.json.gz.jsi")
-        s1.command(f"date")
+        for vcf_paths in vcf_groups:
+            for vcf_path in vcf_paths:
+                print("Annotating ", vcf_path)
+            add_nirvana_step(bp, vcf_paths, [get_output_dir(vcf_path) for vcf_path in vcf_paths],
+                             vcf_size=sum(vcf_sizes[vcf_path] for vcf_path in vcf_paths),
+                             resources_table=resources_table)
 
     bp.run()
 
@@ -4,16 +4,40 @@ specs - one per repeat.
 """
 
 import argparse
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import gzip
+import itertools
+import numpy as np
+import os
 import pandas as pd
 import re
 import requests
+import shutil
 import simplejson as json
+import tempfile
 import tqdm
 
+try:
+	import ijson
+except ImportError:
+	ijson = None
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = pq = None
+
 from pprint import pprint
 
-from bw2_annotation_utils.spliceai_scores import get_spliceai_scores_from_api
+from bw2_annotation_utils.bgzf_utils import BgzfReader, is_bgzf
+from bw2_annotation_utils.consequence_utils import get_consequence_codes, get_consequence_mask, \
+	get_consequence_terms, get_most_severe_consequence, has_any_consequence, to_mask_array
+from bw2_annotation_utils.get_MANE_table import get_MANE_ensembl_transcript_table
+from bw2_annotation_utils.gtf_utils import read_gtf_table
+from bw2_annotation_utils.spliceai_scores import DEFAULT_MAX_CONCURRENT_REQUESTS, get_spliceai_scores_for_variants
 
 LOF_CONSEQUENCES = {
 	'splice_acceptor_variant',
@@ -43,30 +67,600 @@ CONSEQUENCES_TO_IGNORE = {
 	"upstream_gene_variant",
 }
 
-def parse_nirvana_json(path, call_spliceai_api=False, verbose=False):
-	print(f"Parsing {path}" +  (" and calling SpliceAI-lookup to add SpliceAI scores" if call_spliceai_api else ""))
+LOF_MASK = get_consequence_mask(LOF_CONSEQUENCES)
+MISSENSE_MASK = get_consequence_mask(MISSENSE_CONSEQUENCES)
+SYNONYMOUS_MASK = get_consequence_mask(SYNONYMOUS_CONSEQUENCES)
+
+NIRVANA_POSITIONS_START = ',"positions":['
+
+
+def _parse_nirvana_header_line(line):
+	"""Nirvana writes the header and the start of the positions array on the first line, like:
+	{"header":{...},"positions":[
+
+	Returns the header dict, or None if the line isn't in this format.
+	"""
+	line = line.rstrip()
+	if not line.startswith('{"header":') or not line.endswith(NIRVANA_POSITIONS_START):
+		return None
 
+	return json.loads(line[len('{"header":'):-len(NIRVANA_POSITIONS_START)])
+
+
+def _iter_nirvana_position_lines(f):
+	"""Yields positions from a Nirvana JSON file that's positioned at the start of the positions array. Nirvana writes
+	one position per line, separated by commas, and the array ends with a line that starts with "]".
+	"""
+	with f:
+		for line in f:
+			line = line.rstrip()
+			if line.startswith("]"):
+				break
+			if not line:
+				continue
+			yield json.loads(line[:-1] if line.endswith(",") else line)
+
+
+def _iter_nirvana_positions_using_ijson(path, open_func):
+	with open_func(path, "rb") as f:
+		yield from ijson.items(f, "positions.item", use_float=True)
+
+
+def read_nirvana_json_header(path):
+	"""Returns the header dict of a Nirvana JSON file"""
 	open_func = gzip.open if path.endswith(".gz") else open
+	with open_func(path, "rt") as f:
+		header = _parse_nirvana_header_line(f.readline())
+
+	if header is None:
+		header, _ = read_nirvana_json(path)
+
+	return header
+
+
+def read_nirvana_json(path, regions=None, chrom=None):
+	"""Reads a Nirvana JSON file without loading it all into memory.
+
+	Args:
+		path (str): Path of Nirvana JSON file
+		regions (list): Optional list of (chrom, start, end) tuples with 1-based, inclusive coordinates. If specified,
+			only positions whose reference allele overlaps one of these regions are returned. For bgzipped files
+			(which is how Nirvana writes them), this only decompresses the parts of the file near these regions.
+		chrom (str): Optional chromosome name, as it appears in the position index. If specified, all positions on
+			this chromosome are returned, in the same way as when reading the whole file. The file must be bgzipped.
+
+	Return:
+		2-tuple: (header dict, generator of position dicts)
+	"""
+	if chrom is not None:
+		return _read_nirvana_json_chromosome(path, chrom)
+
+	if regions is not None:
+		if is_bgzf(path):
+			return _read_nirvana_json_regions(path, regions)
+		print(f"WARNING: {path} isn't bgzipped, so it can't be indexed. Scanning the whole file for the given regions")
+		header, positions = read_nirvana_json(path)
+		return header, (p for p in positions if _overlaps_any_region(p, regions))
+
+	open_func = gzip.open if path.endswith(".gz") else open
+	f = open_func(path, "rt")
+	header = _parse_nirvana_header_line(f.readline())
+	if header is not None:
+		return header, _iter_nirvana_position_lines(f)
+
+	f.close()
+	if ijson is not None:
+		with open_func(path, "rb") as f:
+			header = next(ijson.items(f, "header", use_float=True), {})
+		return header, _iter_nirvana_positions_using_ijson(path, open_func)
+
+	print(f"WARNING: {path} doesn't have one position per line, and ijson isn't installed, so loading the whole "
+		  f"file into memory")
 	with open_func(path, "rt") as f:
 		json_dict = json.load(f)
 
-	header = json_dict.get("header", {})
+	return json_dict.get("header", {}), iter(json_dict["positions"])
+
+
+# Nirvana's .jsi index is a .NET binary format without a published spec, so region queries use a simpler index that
+# this script builds on first use and saves next to the JSON file. It records the chromosome, position and bgzip
+# virtual offset of the first position line in each compressed block, as well as the largest end coordinate of the
+# positions in the block, so that queries can start early enough to find structural variants that start before the
+# query region and end inside it.
+POSITION_INDEX_SUFFIX = ".positions_index.json.gz"
+POSITION_INDEX_VERSION = 2
+
+# Nirvana writes the chromosome and position first on each position line. Other fields, such as refAllele and (for
+# structural variants) svEnd, are found by searching the line, since their order varies between record types.
+POSITION_LINE_PREFIX_REGEX = re.compile(r'^\{"chromosome":"([^"]+)","position":(\d+)[,}]')
+REF_ALLELE_REGEX = re.compile(r'"refAllele":"([^"]*)"')
+SV_END_REGEX = re.compile(r'"svEnd":(\d+)')
+
+
+def _get_position_end(position):
+	"""Returns the end of the position's reference allele, or its svEnd if it's a structural variant"""
+	if "svEnd" in position:
+		return max(int(position["svEnd"]), position["position"])
+
+	return position["position"] + max(len(position.get("refAllele", "")), 1) - 1
+
+
+def _parse_position_line_coordinates(line):
+	"""Returns the (chrom, start, end) of a position line without parsing all of it, or None if it isn't a position
+	line. Lines that don't start with the chromosome and position are parsed as JSON.
+	"""
+	match = POSITION_LINE_PREFIX_REGEX.match(line)
+	if not match:
+		line = line.rstrip().rstrip(",")
+		if not line.startswith("{"):
+			return None
+		position = json.loads(line)
+		if "chromosome" not in position or "position" not in position:
+			return None
+		return position["chromosome"], position["position"], _get_position_end(position)
+
+	chrom, start = match.group(1), int(match.group(2))
+	sv_end_match = SV_END_REGEX.search(line)
+	if sv_end_match:
+		return chrom, start, max(int(sv_end_match.group(1)), start)
+
+	ref_allele_match = REF_ALLELE_REGEX.search(line)
+	return chrom, start, start + max(len(ref_allele_match.group(1)) if ref_allele_match else 0, 1) - 1
+
+
+def _overlaps_any_region(position, regions):
+	chrom, start = position["chromosome"], position["position"]
+	end = _get_position_end(position)
+	return any(_normalize_chrom(chrom) == _normalize_chrom(r_chrom) and start <= r_end and end >= r_start
+			   for r_chrom, r_start, r_end in regions)
+
+
+def _normalize_chrom(chrom):
+	return chrom.replace("chr", "").upper()
+
+
+def build_position_index(path):
+	"""Scans a bgzipped Nirvana JSON file once and writes the index used for region queries.
+
+	Return:
+		dict: the index
+	"""
+	print(f"Building position index for {path}")
+	index = {"version": POSITION_INDEX_VERSION, "json_size": os.path.getsize(path), "json_mtime": os.path.getmtime(path),
+			 "chromosomes": {}}
+	with BgzfReader(path) as f:
+		f.readline()  # skip the header line
+		previous_block_offset = previous_chrom = None
+		while True:
+			virtual_offset = f.tell()
+			line = f.readline()
+			if not line or line.startswith(b"]"):
+				break
+			coordinates = _parse_position_line_coordinates(line.decode())
+			if coordinates is None:
+				continue
+			chrom, pos, end = coordinates
+			chrom_index = index["chromosomes"].setdefault(chrom, {"positions": [], "offsets": [], "max_ends": []})
+			block_offset = virtual_offset >> 16
+			if block_offset != previous_block_offset or chrom != previous_chrom:
+				chrom_index["positions"].append(pos)
+				chrom_index["offsets"].append(virtual_offset)
+				chrom_index["max_ends"].append(end)
+				previous_block_offset, previous_chrom = block_offset, chrom
+			else:
+				chrom_index["max_ends"][-1] = max(chrom_index["max_ends"][-1], end)
+
+	# write to a temp file and then rename it, so that an interrupted build, or several processes building the index
+	# at the same time, never leave behind a truncated index
+	index_path = f"{path}{POSITION_INDEX_SUFFIX}"
+	fd, temp_index_path = tempfile.mkstemp(prefix=".tmp.", dir=os.path.dirname(os.path.abspath(index_path)))
+	os.close(fd)
+	try:
+		with gzip.open(temp_index_path, "wt") as f:
+			json.dump(index, f)
+		os.chmod(temp_index_path, 0o644)
+		os.replace(temp_index_path, index_path)
+	finally:
+		if os.path.isfile(temp_index_path):
+			os.remove(temp_index_path)
+
+	return index
+
+
+def _load_position_index(path):
+	index_path = f"{path}{POSITION_INDEX_SUFFIX}"
+	if os.path.isfile(index_path):
+		try:
+			with gzip.open(index_path, "rt") as f:
+				index = json.load(f)
+		except (OSError, EOFError, ValueError) as e:
+			print(f"WARNING: unable to read {index_path}: {e}. Rebuilding it...")
+			index = {}
+		if index.get("version") == POSITION_INDEX_VERSION and index.get("json_size") == os.path.getsize(path) and \
+				index.get("json_mtime") == os.path.getmtime(path):
+			return index
+
+	return build_position_index(path)
+
+
+def _read_nirvana_json_regions(path, regions):
+	with BgzfReader(path) as f:
+		header = _parse_nirvana_header_line(f.readline().decode())
+	if header is None:
+		raise ValueError(f"{path} doesn't have one position per line, so it can't be queried by region")
+
+	return header, _iter_nirvana_positions_in_regions(path, regions, _load_position_index(path))
+
+
+def _read_nirvana_json_chromosome(path, chrom):
+	with BgzfReader(path) as f:
+		header = _parse_nirvana_header_line(f.readline().decode())
+	if header is None:
+		raise ValueError(f"{path} doesn't have one position per line, so it can't be read by chromosome")
+
+	return header, _iter_nirvana_positions_in_chromosome(path, chrom, _load_position_index(path))
+
+
+def _iter_nirvana_positions_in_chromosome(path, chrom, index):
+	"""Yields every position on the given chromosome, starting from its first offset in the index. Lines are parsed
+	the same way as in _iter_nirvana_position_lines(..), rather than filtered by coordinates, so that reading the
+	chromosomes one at a time returns the same positions as reading the whole file.
+	"""
+	chrom_index = index["chromosomes"].get(chrom)
+	if not chrom_index:
+		return
+
+	with BgzfReader(path) as f:
+		f.seek(chrom_index["offsets"][0])
+		for line in f:
+			line = line.rstrip()
+			if line.startswith(b"]"):
+				break
+			if not line:
+				continue
+			position = json.loads(line[:-1] if line.endswith(b",") else line)
+			if position.get("chromosome") != chrom:
+				break
+			yield position
+
+
+def _iter_nirvana_positions_in_regions(path, regions, index):
+	chrom_names = {_normalize_chrom(chrom): chrom for chrom in index["chromosomes"]}
+	chrom_order = {chrom: i for i, chrom in enumerate(index["chromosomes"])}
+	regions = sorted(
+		((chrom_names[_normalize_chrom(chrom)], start, end) for chrom, start, end in regions
+		 if _normalize_chrom(chrom) in chrom_names),
+		key=lambda region: (chrom_order[region[0]], region[1], region[2]))
+
+	# the search for each region starts at the first block that has a position ending at or after the region start.
+	# Since max_ends are per block, a running max over the blocks gives a sorted list that can be searched with bisect.
+	running_max_ends = {}
+	for chrom, chrom_index in index["chromosomes"].items():
+		running_max_ends[chrom] = list(itertools.accumulate(chrom_index["max_ends"], max))
+
+	# positions are yielded in the order of the sorted regions. The last virtual offset is tracked so that a position
+	# that overlaps 2 adjacent regions is only yielded once.
+	last_yielded_offset = -1
+	with BgzfReader(path) as f:
+		for chrom, start, end in regions:
+			chrom_index = index["chromosomes"][chrom]
+			i = bisect.bisect_left(running_max_ends[chrom], start)
+			if i == len(chrom_index["offsets"]):
+				continue
+			f.seek(max(chrom_index["offsets"][i], last_yielded_offset))
+			while True:
+				virtual_offset = f.tell()
+				line = f.readline()
+				if not line or line.startswith(b"]"):
+					break
+				coordinates = _parse_position_line_coordinates(line.decode())
+				if coordinates is None:
+					continue
+				position_chrom, position_start, position_end = coordinates
+				if position_chrom != chrom or position_start > end:
+					break
+				if virtual_offset <= last_yielded_offset or position_end < start:
+					continue
+				line = line.rstrip()
+				last_yielded_offset = virtual_offset
+				yield json.loads(line[:-1] if line.endswith(b",") else line)
+
+
+def parse_regions(region_args=(), gene_args=(), bed_path=None, gtf_path=None):
+	"""Converts --region, --genes and --bed command-line args to a list of (chrom, start, end) tuples with 1-based,
+	inclusive coordinates, or returns None if none of these args were specified.
+	"""
+	if not region_args and not gene_args and not bed_path:
+		return None
+
+	regions = []
+	for region in region_args:
+		match = re.match(r"^([^:]+):([\d,]+)-([\d,]+)$", region) or re.match(r"^([^:]+)$", region)
+		if not match:
+			raise ValueError(f"Unable to parse region: {region}. Expecting chrom:start-end or chrom")
+		if len(match.groups()) == 1:
+			regions.append((match.group(1), 1, 10**10))
+		else:
+			regions.append((match.group(1), int(match.group(2).replace(",", "")), int(match.group(3).replace(",", ""))))
+
+	if bed_path:
+		open_func = gzip.open if bed_path.endswith(".gz") else open
+		with open_func(bed_path, "rt") as f:
+			for line_number, line in enumerate(f, start=1):
+				if line.startswith(("#", "track", "browser")) or not line.strip():
+					continue
+				fields = line.rstrip("\n").split("\t")
+				if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+					raise ValueError(f"Unable to parse line {line_number} of {bed_path}: {line.strip()}. Expecting "
+									 f"tab-separated chrom, start, end columns")
+				regions.append((fields[0], int(fields[1]) + 1, int(fields[2])))
+
+	if gene_args:
+		if not gtf_path:
+			raise ValueError("--genes requires --gtf to look up gene coordinates")
+		genes_df = read_gtf_table(gtf_path, feature_type="gene", attributes=["gene_id", "gene_name"])
+		gene_ids = genes_df["gene_id"].astype(str).str.replace(r"\.\d+$", "", regex=True)
+		for gene in gene_args:
+			gene_rows = genes_df[(genes_df["gene_name"] == gene) | (gene_ids == re.sub(r"\.\d+$", "", gene))]
+			if len(gene_rows) == 0:
+				print(f"WARNING: gene {gene} not found in {gtf_path}")
+			regions.extend(zip(gene_rows["chrom"].astype(str), gene_rows["start"], gene_rows["end"]))
+
+	return regions
+
+
+def get_genotype_code(genotype, alt_allele_number):
+	"""Encodes a genotype string like "0/1" or "1|2" as the number of copies of the given alt allele (numbered from 1),
+	or -1 if the genotype is missing (eg. "./.").
+	"""
+	alleles = re.split("[/|]", genotype)
+	if not genotype or "." in alleles:
+		return -1
+
+	return alleles.count(str(alt_allele_number))
+
+
+def _get_transcripts(variant):
+	"""Returns the variant's protein-coding transcripts, or all its transcripts if none are protein-coding"""
+	transcripts = variant.get('transcripts', [])
+	if any(t.get('bioType') == "protein_coding" for t in transcripts):
+		transcripts = [t for t in transcripts if t.get('bioType') == "protein_coding"]
+
+	return transcripts
+
+
+def get_consequence_mask_for_transcripts(transcripts):
+	"""Returns the bitmask (see consequence_utils) of all consequences of the given Nirvana transcripts"""
+	mask = 0
+	for transcript in transcripts:
+		mask |= get_consequence_mask(transcript['consequence'])
+
+	return mask
+
+
+# rows generated by iter_nirvana_rows(..) have the consequence mask in this key instead of the string consequence
+# columns, which OutputWriter renders for a whole batch at a time, converting each distinct mask only once
+CONSEQUENCE_MASK_KEY = 'consequence_mask'
+CONSEQUENCE_STRING_COLUMNS = (
+	'consequences', 'most_severe_consequence', 'synonymous_consequences', 'missense_consequences', 'lof_consequences',
+)
+
+# positions are processed this many at a time, so that their consequences can be classified with
+# classify_consequences(..) and their SpliceAI scores looked up using concurrent requests
+POSITION_CHUNK_SIZE = 1000
+
+
+@functools.lru_cache(maxsize=None)
+def _get_consequence_columns(mask):
+	"""Returns the consequence columns for a variant with the given consequence mask. These are cached since most
+	variants share a small number of distinct masks.
+	"""
+	consequences = sorted(get_consequence_terms(mask))
+	return {
+		'consequences': ', '.join([c for c in consequences if c not in CONSEQUENCES_TO_IGNORE]),
+		'most_severe_consequence': get_most_severe_consequence(mask) or "",
+		'synonymous_consequences': ', '.join(sorted(get_consequence_terms(mask & SYNONYMOUS_MASK))),
+		'missense_consequences': ', '.join(sorted(get_consequence_terms(mask & MISSENSE_MASK))),
+		'lof_consequences': ', '.join(sorted(get_consequence_terms(mask & LOF_MASK))),
+		'is_synonymous': bool(mask & SYNONYMOUS_MASK),
+		'is_missense': bool(mask & MISSENSE_MASK),
+		'is_lof': bool(mask & LOF_MASK),
+	}
+
+
+def classify_consequences(positions):
+	"""Classifies the consequences of every alt allele in a batch of Nirvana positions.
+
+	Args:
+		positions (list): Nirvana position dicts
+
+	Return:
+		dict: numpy arrays with one entry per alt allele, in the same order as the rows generated by
+			parse_nirvana_json: "position_index", "allele_index", "consequence_mask", "is_lof", "is_missense",
+			"is_synonymous", as well as "consequence_codes": a list with the tuple of consequence codes of each allele.
+	"""
+	position_indices, allele_indices, masks = [], [], []
+	for position_index, position in enumerate(positions):
+		for allele_index, variant in enumerate(position['variants']):
+			position_indices.append(position_index)
+			allele_indices.append(allele_index)
+			masks.append(get_consequence_mask_for_transcripts(_get_transcripts(variant)))
+
+	mask_array = to_mask_array(masks)
+	return {
+		"position_index": np.array(position_indices, dtype=np.int32),
+		"allele_index": np.array(allele_indices, dtype=np.int32),
+		"consequence_mask": mask_array,
+		"is_lof": has_any_consequence(mask_array, LOF_MASK),
+		"is_missense": has_any_consequence(mask_array, MISSENSE_MASK),
+		"is_synonymous": has_any_consequence(mask_array, SYNONYMOUS_MASK),
+		"consequence_codes": [get_consequence_codes(mask) for mask in masks],
+	}
+
+
+def _add_consequence_columns(row):
+	"""Replaces the consequence mask of a row generated by iter_nirvana_rows(..) with the string consequence columns"""
+	row.update(_get_consequence_columns(row.pop(CONSEQUENCE_MASK_KEY)))
+	return row
+
+
+def _render_consequence_columns(df, masks, columns):
+	"""Sets the given string consequence columns of df from a list with the consequence mask of each row"""
+	codes, unique_masks = pd.factorize(pd.Series(masks, dtype=object))
+	for column in columns:
+		values = np.array([_get_consequence_columns(mask)[column] for mask in unique_masks], dtype=object)
+		df[column] = values[codes]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mane_select_transcript_ids():
+	"""Returns the set of MANE Select Ensembl and RefSeq transcript ids, without version suffixes"""
+	mane_df = get_MANE_ensembl_transcript_table()
+	mane_df = mane_df[mane_df["MANE_status"] == "MANE Select"]
+	return frozenset(
+		transcript_id.split(".")[0] for transcript_id in itertools.chain(
+			mane_df["Ensembl_nuc"].dropna().astype(str), mane_df["RefSeq_nuc"].dropna().astype(str)))
+
+
+def _get_transcript_consequence_columns(transcript):
+	mask = get_consequence_mask(transcript.get('consequence', []))
+	return {
+		CONSEQUENCE_MASK_KEY: mask,
+		'is_synonymous': bool(mask & SYNONYMOUS_MASK),
+		'is_missense': bool(mask & MISSENSE_MASK),
+		'is_lof': bool(mask & LOF_MASK),
+	}
+
+
+def _get_transcript_rows(variant_columns, variant, mane_select_transcript_ids):
+	"""Returns one row dict per Nirvana transcript of the given variant, starting with the given variant columns"""
+	rows = []
+	for transcript in variant.get('transcripts', []):
+		transcript_id = transcript.get('transcript', "")
+		rows.append({
+			**variant_columns,
+			'gene': transcript.get('hgnc', ""),
+			'gene_id': transcript.get('geneId', ""),
+			'transcript_id': transcript_id,
+			'transcript_source': transcript.get('source', ""),
+			'biotype': transcript.get('bioType', ""),
+			'is_canonical': bool(transcript.get('isCanonical', False)),
+			'is_mane_select': transcript_id.split(".")[0] in mane_select_transcript_ids,
+			**_get_transcript_consequence_columns(transcript),
+			'hgvsc': transcript.get('hgvsc', ""),
+			'hgvsp': transcript.get('hgvsp', ""),
+		})
+
+	return rows
+
+
+def iter_nirvana_rows(path, views=("variants",), call_spliceai_api=False, verbose=False, regions=None,
+					  genotype_codes=False, chrom=None, spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Parses a Nirvana JSON file in a single pass and generates the rows of one or more output views, so that
+	several views can be written without decoding the JSON more than once.
+
+	Args:
+		path (str): Nirvana JSON path
+		views (tuple): one or more of the views in VIEW_OUTPUT_COLUMNS:
+			"variants": one row per alt allele, summarizing the consequences of all its protein-coding transcripts, and
+				with one genotype column per sample. These are the rows generated by parse_nirvana_json(..)
+			"transcripts": one row per alt allele and transcript (all transcripts, not only protein-coding ones)
+			"canonical_transcripts": the subset of "transcripts" rows for canonical or MANE Select transcripts
+		call_spliceai_api (bool): use the SpliceAI-lookup API to fill in SpliceAI scores in "variants" rows
+		verbose (bool): show a progress bar
+		regions (list): optional (chrom, start, end) tuples. Only variants in these regions are parsed.
+		chrom (str): optional chromosome. Only variants on this chromosome are parsed (see read_nirvana_json(..)).
+		genotype_codes (bool): encode genotypes using get_genotype_code(..) instead of keeping them as strings
+		spliceai_max_concurrent_requests (int): max number of concurrent SpliceAI-lookup API requests
+
+	Return:
+		iterator: generates one dict per Nirvana position, which maps each of the requested views to a list of rows.
+			Rows have the consequence mask in CONSEQUENCE_MASK_KEY instead of the string consequence columns, which
+			OutputWriter renders at output time (see _add_consequence_columns(..) to render them for a single row).
+	"""
+	unknown_views = set(views) - set(VIEW_OUTPUT_COLUMNS)
+	if unknown_views:
+		raise ValueError(f"Unknown views: {', '.join(sorted(unknown_views))}. Expected: "
+						 f"{', '.join(VIEW_OUTPUT_COLUMNS)}")
+
+	include_variants = "variants" in views
+	include_transcripts = "transcripts" in views
+	include_canonical_transcripts = "canonical_transcripts" in views
+	mane_select_transcript_ids = _get_mane_select_transcript_ids() if (
+		include_transcripts or include_canonical_transcripts) else frozenset()
+
+	print(f"Parsing {path}" +  (" and calling SpliceAI-lookup to add SpliceAI scores" if call_spliceai_api else ""))
+
+	header, positions = read_nirvana_json(path, regions=regions, chrom=chrom)
 	sample_ids = header["samples"]
 
-	positions = json_dict['positions']
 	if verbose:
 		positions = tqdm.tqdm(positions, unit=" variants")
 
+	for positions_chunk in _iter_chunks(positions, POSITION_CHUNK_SIZE):
+		spliceai_scores = None
+		if call_spliceai_api and include_variants:
+			# look up the scores for all variants in the chunk at once, so that API requests can run concurrently
+			spliceai_scores = get_spliceai_scores_for_variants((
+				(position['chromosome'], position['position'], position['refAllele'], alt)
+				for position in positions_chunk for alt in position['altAlleles']
+			), max_concurrent_requests=spliceai_max_concurrent_requests)
+
+		yield from _iter_nirvana_rows_in_chunk(
+			positions_chunk, sample_ids, views, mane_select_transcript_ids, genotype_codes, spliceai_scores)
+
+
+def _iter_chunks(iterable, chunk_size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, chunk_size))
+		if not chunk:
+			return
+		yield chunk
+
+
+def _iter_nirvana_rows_in_chunk(positions, sample_ids, views, mane_select_transcript_ids, genotype_codes,
+								spliceai_scores=None):
+	"""Generates the rows of each position in a list of positions (see iter_nirvana_rows(..)). The consequences of the
+	"variants" rows are classified for all positions at once using classify_consequences(..).
+	"""
+	include_variants = "variants" in views
+	include_transcripts = "transcripts" in views
+	include_canonical_transcripts = "canonical_transcripts" in views
+	if include_variants:
+		consequences = classify_consequences(positions)
+		allele_counter = itertools.count()
+
 	for position in positions:
+		rows_by_view = {view: [] for view in views}
 		for i, variant in enumerate(position['variants']):
-			transcripts = variant.get('transcripts', [])
-			if any(t.get('bioType') == "protein_coding" for t in transcripts):
-				transcripts = [t for t in transcripts if t.get('bioType') == "protein_coding"]
-
-			consequences = sorted({c for transcript in transcripts for c in transcript['consequence']})
-			lof_consequences = sorted({c for c in consequences if c in LOF_CONSEQUENCES})
-			missense_consequences = sorted({c for c in consequences if c in MISSENSE_CONSEQUENCES})
-			synonymous_consequences = sorted({c for c in consequences if c in SYNONYMOUS_CONSEQUENCES})
+			chrom = position['chromosome']
+			pos = position['position']
+			ref = position['refAllele']
+			alt = position['altAlleles'][i]
+
+			variant_columns = {
+				'chrom': position['chromosome'].replace("chr", "").upper(),
+				'pos': pos,
+				'ref': ref,
+				'alt': alt,
+				#'genotype': position['samples'][0]['genotype'],
+				'variant_type': variant['variantType'],
+			}
+
+			if include_transcripts or include_canonical_transcripts:
+				transcript_rows = _get_transcript_rows(variant_columns, variant, mane_select_transcript_ids)
+				if include_transcripts:
+					rows_by_view["transcripts"].extend(transcript_rows)
+				if include_canonical_transcripts:
+					rows_by_view["canonical_transcripts"].extend(
+						row for row in transcript_rows if row['is_canonical'] or row['is_mane_select'])
+
+			if not include_variants:
+				continue
+
+			allele_index = next(allele_counter)
+			transcripts = _get_transcripts(variant)
 			gene_names = list(sorted({t['hgnc'] for t in transcripts if 'hgnc' in t}))
 			gene_name = gene_names[0] if gene_names else ""
 
@@ -82,25 +676,12 @@ def parse_nirvana_json(path, call_spliceai_api=False, verbose=False):
 					max(t.get('acceptorLossScore', 0) for t in variant['spliceAI'])
 				)
 
-			chrom = position['chromosome']
-			pos = position['position']
-			ref = position['refAllele']
-			alt = position['altAlleles'][i]
-
 			record = {
-				'chrom': position['chromosome'].replace("chr", "").upper(),
-				'pos': pos,
-				'ref': ref,
-				'alt': alt,
-				#'genotype': position['samples'][0]['genotype'],
-				'variant_type': variant['variantType'],
-				'consequences': ', '.join([c for c in consequences if c not in CONSEQUENCES_TO_IGNORE]),
-				'synonymous_consequences': ', '.join(synonymous_consequences),
-				'missense_consequences': ', '.join(missense_consequences),
-				'lof_consequences': ', '.join(lof_consequences),
-				'is_synonymous': len(synonymous_consequences) > 0,
-				'is_missense': len(missense_consequences) > 0,
-				'is_lof': len(lof_consequences) > 0,
+				**variant_columns,
+				CONSEQUENCE_MASK_KEY: int(consequences["consequence_mask"][allele_index]),
+				'is_synonymous': bool(consequences["is_synonymous"][allele_index]),
+				'is_missense': bool(consequences["is_missense"][allele_index]),
+				'is_lof': bool(consequences["is_lof"][allele_index]),
 				'gene': gene_name,
 				'clinvar': ','.join(clinvar_significances),
 				'spliceAI_gain': spliceai_gain_score,
@@ -110,35 +691,500 @@ def parse_nirvana_json(path, call_spliceai_api=False, verbose=False):
 				'topmed_af': variant.get('topmed', {}).get('allAf', 0),
 			}
 
-			if call_spliceai_api:
-				print(f"Calling SpliceAI-lookup for {chrom}-{pos}-{ref}-{alt}")
-				record['spliceAI_gain'], record['spliceAI_loss'] = get_spliceai_scores_from_api(
-					chrom.replace("chr", "").upper(), pos, ref, alt)
+			if spliceai_scores is not None:
+				variant_key = f"{chrom.replace('chr', '').upper()}-{pos}-{ref}-{alt}"
+				if variant_key in spliceai_scores:
+					record['spliceAI_gain'], record['spliceAI_loss'] = spliceai_scores[variant_key]
 
 			for sample_id, sample in zip(sample_ids, position['samples']):
-				record[sample_id] = sample['genotype']
+				record[sample_id] = get_genotype_code(sample.get('genotype', ''), i + 1) if genotype_codes else \
+					sample['genotype']
+
+			rows_by_view["variants"].append(record)
+
+		yield rows_by_view
+
+
+def parse_nirvana_json(path, call_spliceai_api=False, verbose=False, regions=None, genotype_codes=False):
+	"""Parses a Nirvana JSON file and generates one row dict per variant, with the columns in OUTPUT_COLUMNS, one
+	genotype column per sample, and the columns in OUTPUT_COLUMNS_AFTER_GENOTYPES. If genotype_codes is True, genotypes are encoded using get_genotype_code(..)
+	instead of being kept as strings.
+	"""
+	for rows_by_view in iter_nirvana_rows(path, call_spliceai_api=call_spliceai_api, verbose=verbose,
+										  regions=regions, genotype_codes=genotype_codes):
+		for row in rows_by_view["variants"]:
+			yield _add_consequence_columns(row)
+
+
+# columns of the rows generated by parse_nirvana_json, followed by one genotype column per sample
+OUTPUT_COLUMNS = [
+	'chrom', 'pos', 'ref', 'alt', 'variant_type', 'consequences', 'synonymous_consequences', 'missense_consequences',
+	'lof_consequences', 'is_synonymous', 'is_missense', 'is_lof', 'gene', 'clinvar', 'spliceAI_gain', 'spliceAI_loss',
+	'1kg_af', 'gnomad_af', 'topmed_af',
+]
+
+# columns that were added to the rows generated by parse_nirvana_json later. These are written after the genotype
+# columns, so that existing columns, including the genotype columns, keep their positions in the output.
+OUTPUT_COLUMNS_AFTER_GENOTYPES = [
+	'most_severe_consequence',
+]
+
+# columns of the "transcripts" and "canonical_transcripts" rows generated by iter_nirvana_rows
+TRANSCRIPT_OUTPUT_COLUMNS = [
+	'chrom', 'pos', 'ref', 'alt', 'variant_type', 'gene', 'gene_id', 'transcript_id', 'transcript_source', 'biotype',
+	'is_canonical', 'is_mane_select', 'consequences', 'most_severe_consequence', 'synonymous_consequences',
+	'missense_consequences', 'lof_consequences', 'is_synonymous', 'is_missense', 'is_lof', 'hgvsc', 'hgvsp',
+]
+
+VIEW_OUTPUT_COLUMNS = {
+	"variants": OUTPUT_COLUMNS,
+	"transcripts": TRANSCRIPT_OUTPUT_COLUMNS,
+	"canonical_transcripts": TRANSCRIPT_OUTPUT_COLUMNS,
+}
+
+VIEW_OUTPUT_COLUMNS_AFTER_GENOTYPES = {
+	"variants": OUTPUT_COLUMNS_AFTER_GENOTYPES,
+}
+
+DEFAULT_BATCH_SIZE = 10_000
+
+# rows are written in batches, so these columns are converted to fixed dtypes rather than the dtypes pandas infers from
+# each batch. Otherwise the output would depend on the batch size (eg. an allele frequency of 0 would be written as 0
+# in a batch where all frequencies are 0, and as 0.0 in other batches). Allele frequencies and SpliceAI scores are
+# therefore always written as floats, including in files where every value is an integer (eg. 0.0 rather than 0).
+OUTPUT_COLUMN_DTYPES = {
+	'pos': 'Int64',
+	'spliceAI_gain': 'float64',
+	'spliceAI_loss': 'float64',
+	'1kg_af': 'float64',
+	'gnomad_af': 'float64',
+	'topmed_af': 'float64',
+}
+
+
+def _get_output_format(output_path):
+	if output_path.endswith(".parquet"):
+		return "parquet"
+	if output_path.endswith((".arrow", ".feather")):
+		return "arrow"
+	if output_path.endswith(".arrows"):
+		return "arrow_stream"
+	return "tsv"
+
+
+# Parquet and Arrow output use these column types instead of the tsv's strings. Columns with few distinct values are
+# dictionary-encoded (they become categorical columns when loaded with pandas), the consequence and clinvar columns are
+# lists of strings, and genotypes are stored in a single "genotypes" column as a matrix of get_genotype_code(..) values
+# with one int8 per sample. The sample ids are saved in the schema metadata.
+ARROW_DICTIONARY_COLUMNS = {
+	'chrom', 'variant_type', 'gene', 'gene_id', 'transcript_source', 'biotype', 'most_severe_consequence',
+}
+ARROW_LIST_COLUMNS = {
+	'consequences': ', ',
+	'synonymous_consequences': ', ',
+	'missense_consequences': ', ',
+	'lof_consequences': ', ',
+	'clinvar': ',',
+}
+
+
+def _get_arrow_schema(sample_ids, columns=OUTPUT_COLUMNS, columns_after_genotypes=OUTPUT_COLUMNS_AFTER_GENOTYPES):
+	column_types = {
+		'pos': pa.int32(),
+		'is_canonical': pa.bool_(),
+		'is_mane_select': pa.bool_(),
+		'is_synonymous': pa.bool_(),
+		'is_missense': pa.bool_(),
+		'is_lof': pa.bool_(),
+		'spliceAI_gain': pa.float32(),
+		'spliceAI_loss': pa.float32(),
+		'1kg_af': pa.float32(),
+		'gnomad_af': pa.float32(),
+		'topmed_af': pa.float32(),
+	}
+	column_types.update({c: pa.dictionary(pa.int32(), pa.string()) for c in ARROW_DICTIONARY_COLUMNS})
+	column_types.update({c: pa.list_(pa.string()) for c in ARROW_LIST_COLUMNS})
+
+	fields = [(c, column_types.get(c, pa.string())) for c in columns]
+	if sample_ids:
+		fields.append(("genotypes", pa.list_(pa.int8(), len(sample_ids))))
+	fields += [(c, column_types.get(c, pa.string())) for c in columns_after_genotypes]
+
+	return pa.schema(fields, metadata={"samples": json.dumps(list(sample_ids))})
 
-			yield record
 
+class _DictionaryEncoder:
+	"""Dictionary-encodes values using a dictionary that only grows, so that the dictionary of each batch extends the
+	dictionary of the previous batch. Arrow IPC files can only store dictionary changes of this kind.
+	"""
 
+	def __init__(self):
+		self._values = []
+		self._value_to_index = {}
+
+	def encode(self, values):
+		codes, unique_values = pd.factorize(pd.Series(values, dtype=object))
+		for value in unique_values:
+			if value not in self._value_to_index:
+				self._value_to_index[value] = len(self._values)
+				self._values.append(value)
+
+		unique_value_indices = np.array([self._value_to_index[value] for value in unique_values], dtype=np.int32)
+		indices = pa.array(unique_value_indices[codes] if len(unique_values) else np.zeros(len(codes), np.int32),
+						   mask=codes < 0, type=pa.int32())
+		return pa.DictionaryArray.from_arrays(indices, pa.array(self._values, type=pa.string()))
+
+
+class OutputWriter:
+	"""Appends batches of rows to a tsv (gzipped if the path ends with .gz), Parquet (.parquet), Arrow IPC file
+	(.arrow or .feather) or Arrow IPC stream (.arrows) as they're produced, so that memory use is proportional to
+	the batch size rather than the number of variants. Parquet and Arrow output use the typed schema described above
+	ARROW_DICTIONARY_COLUMNS, and expect rows generated with parse_nirvana_json(.., genotype_codes=True).
+
+	The columns argument sets the columns that precede the sample genotype columns (eg. the columns of one of the
+	views in VIEW_OUTPUT_COLUMNS), and columns_after_genotypes sets the columns that follow them.
+	"""
+
+	def __init__(self, output_path, sample_ids, write_header=True, columns=OUTPUT_COLUMNS,
+				 columns_after_genotypes=OUTPUT_COLUMNS_AFTER_GENOTYPES):
+		self.output_path = output_path
+		self.output_format = _get_output_format(output_path)
+		self.sample_ids = list(sample_ids)
+		self.columns = list(columns) + self.sample_ids + list(columns_after_genotypes)
+		self.dtypes = {c: dtype for c, dtype in OUTPUT_COLUMN_DTYPES.items() if c in self.columns}
+		self._consequence_string_columns = [c for c in CONSEQUENCE_STRING_COLUMNS if c in self.columns]
+		self.num_rows = 0
+
+		if self.output_format == "tsv":
+			self._f = gzip.open(output_path, "wt") if output_path.endswith("gz") else open(output_path, "wt")
+			if write_header:
+				self._f.write("\t".join(self.columns) + "\n")
+			return
+
+		if pa is None:
+			raise ValueError(f"pyarrow must be installed to write {self.output_format} output")
+
+		self.schema = _get_arrow_schema(self.sample_ids, columns, columns_after_genotypes)
+		self._dictionary_encoders = {
+			field.name: _DictionaryEncoder() for field in self.schema if field.name in ARROW_DICTIONARY_COLUMNS
+		}
+		if self.output_format == "parquet":
+			self._writer = pq.ParquetWriter(output_path, self.schema, compression="zstd")
+		else:
+			options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True, compression="zstd")
+			new_writer = pa.ipc.new_file if self.output_format == "arrow" else pa.ipc.new_stream
+			self._writer = new_writer(output_path, self.schema, options=options)
+
+	def write_rows(self, rows):
+		"""Writes a batch of row dicts. Rows generated by iter_nirvana_rows(..) have a consequence mask instead of the
+		string consequence columns, and these columns are filled in here.
+		"""
+		if not rows:
+			return
+
+		df = pd.DataFrame(rows, columns=self.columns)
+		if self._consequence_string_columns and CONSEQUENCE_MASK_KEY in rows[0]:
+			_render_consequence_columns(
+				df, [row[CONSEQUENCE_MASK_KEY] for row in rows], self._consequence_string_columns)
+		df = df.astype(self.dtypes)
+		if self.output_format == "tsv":
+			df.to_csv(self._f, sep="\t", index=False, header=False)
+		else:
+			self._write_record_batch(self._to_record_batch(df))
+		self.num_rows += len(df)
+
+	def _to_record_batch(self, df):
+		arrays = []
+		for field in self.schema:
+			if field.name == "genotypes":
+				genotypes = df[self.sample_ids].to_numpy(dtype=np.int8)
+				arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(genotypes.ravel()), len(self.sample_ids)))
+			elif field.name in ARROW_DICTIONARY_COLUMNS:
+				arrays.append(self._dictionary_encoders[field.name].encode(df[field.name]))
+			elif field.name in ARROW_LIST_COLUMNS:
+				separator = ARROW_LIST_COLUMNS[field.name]
+				arrays.append(pa.array([v.split(separator) if v else [] for v in df[field.name]], type=field.type))
+			else:
+				arrays.append(pa.array(df[field.name], type=field.type, from_pandas=True))
+
+		return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+	def write_record_batch(self, record_batch):
+		"""Writes a pyarrow RecordBatch that has this writer's schema (only for Parquet and Arrow output)"""
+		# re-encode dictionary columns, since record batches from other files have different dictionaries
+		arrays = [
+			self._dictionary_encoders[field.name].encode(column.dictionary_decode().to_pylist())
+			if field.name in ARROW_DICTIONARY_COLUMNS else column
+			for field, column in zip(self.schema, record_batch.columns)
+		]
+		self._write_record_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+		self.num_rows += record_batch.num_rows
+
+	def _write_record_batch(self, record_batch):
+		if self.output_format == "parquet":
+			self._writer.write_batch(record_batch)
+		else:
+			self._writer.write(record_batch)
+
+	def close(self):
+		if self.output_format == "tsv":
+			self._f.close()
+		else:
+			self._writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def read_genotype_matrix(path):
+	"""Reads the genotypes from Parquet or Arrow output.
+
+	Return:
+		2-tuple: (list of sample ids, numpy int8 array of get_genotype_code(..) values with one row per variant and one
+			column per sample)
+	"""
+	output_format = _get_output_format(path)
+	if output_format == "parquet":
+		table = pq.read_table(path, columns=["genotypes"])
+	else:
+		with pa.memory_map(path) as source:
+			reader = pa.ipc.open_file(source) if output_format == "arrow" else pa.ipc.open_stream(source)
+			table = reader.read_all()
+
+	sample_ids = json.loads(table.schema.metadata[b"samples"])
+	if not sample_ids:
+		return sample_ids, np.zeros((table.num_rows, 0), dtype=np.int8)
+
+	genotypes = table.column("genotypes").combine_chunks()
+	return sample_ids, genotypes.flatten().to_numpy().reshape(-1, len(sample_ids))
+
+
+def _get_output_suffix(output_path):
+	return re.search("[.](tsv([.]b?gz)?|parquet|arrow|feather|arrows)$|$", output_path).group(0)
+
+
+def get_view_output_path(output_path, view):
+	"""Returns the output path of the given view. "variants" rows are written to output_path, and other views are
+	written next to it with the view name added before the file extension (eg. out.tsv.gz => out.transcripts.tsv.gz)
+	"""
+	if view == "variants":
+		return output_path
+
+	output_suffix = _get_output_suffix(output_path)
+	return f"{output_path[:len(output_path) - len(output_suffix)]}.{view}{output_suffix}"
+
+
+def _new_view_output_writer(output_path, view, sample_ids, write_header=True):
+	"""Returns an OutputWriter for the given view. Only "variants" rows have genotype columns."""
+	return OutputWriter(output_path, sample_ids if view == "variants" else [], write_header=write_header,
+						columns=VIEW_OUTPUT_COLUMNS[view],
+						columns_after_genotypes=VIEW_OUTPUT_COLUMNS_AFTER_GENOTYPES.get(view, []))
+
+
+def write_views(rows_by_view_iter, output_paths, sample_ids, batch_size=DEFAULT_BATCH_SIZE, write_header=True):
+	"""Writes the rows of each view to its own output file, in batches of batch_size rows.
+
+	Args:
+		rows_by_view_iter (iterable): dicts that map view name to a list of rows, as generated by iter_nirvana_rows(..)
+		output_paths (dict): maps view name to output path
+		sample_ids (list): sample ids of the "variants" genotype columns
+		batch_size (int): number of rows of each view to hold in memory before appending them to its output file
+		write_header (bool): whether to write a header line to tsv output
+
+	Return:
+		dict: maps view name to the number of rows written
+	"""
+	writers = {}
+	try:
+		for view, output_path in output_paths.items():
+			writers[view] = _new_view_output_writer(output_path, view, sample_ids, write_header=write_header)
+
+		batches = {view: [] for view in output_paths}
+		for rows_by_view in rows_by_view_iter:
+			for view, rows in rows_by_view.items():
+				batch = batches[view]
+				batch.extend(rows)
+				if len(batch) >= batch_size:
+					writers[view].write_rows(batch)
+					batches[view] = []
+
+		for view, batch in batches.items():
+			writers[view].write_rows(batch)
+	finally:
+		for writer in writers.values():
+			writer.close()
+
+	return {view: writer.num_rows for view, writer in writers.items()}
+
+
+def _iter_record_batches(path, output_format):
+	"""Yields the record batches of a Parquet or Arrow file written by OutputWriter"""
+	if output_format == "parquet":
+		yield from pq.ParquetFile(path).iter_batches()
+	elif output_format == "arrow":
+		with pa.memory_map(path) as source:
+			reader = pa.ipc.open_file(source)
+			for i in range(reader.num_record_batches):
+				yield reader.get_batch(i)
+	else:
+		with pa.memory_map(path) as source:
+			yield from pa.ipc.open_stream(source)
+
+
+def _convert_part(path, output_paths, sample_ids, call_spliceai_api=False, regions=None,
+				  batch_size=DEFAULT_BATCH_SIZE, chrom=None, spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Converts the positions in the given regions, or all positions on the given chromosome, and writes each view to
+	its path in output_paths. tsv parts are written without a header line.
+
+	Return:
+		dict: maps view name to number of rows
+	"""
+	rows_by_view_iter = iter_nirvana_rows(
+		path, views=tuple(output_paths), call_spliceai_api=call_spliceai_api, regions=regions, chrom=chrom,
+		spliceai_max_concurrent_requests=spliceai_max_concurrent_requests,
+		genotype_codes=_get_output_format(output_paths.get("variants", "")) != "tsv")
+	return write_views(rows_by_view_iter, output_paths, sample_ids, batch_size=batch_size, write_header=False)
+
+
+def convert_nirvana_json(path, output_path, views=("variants",), call_spliceai_api=False, verbose=False,
+						 regions=None, batch_size=DEFAULT_BATCH_SIZE,
+						 spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Converts a Nirvana JSON file in a single pass, writing each of the given views (see iter_nirvana_rows(..)) to
+	get_view_output_path(output_path, view).
+
+	Return:
+		dict: maps view name to number of rows written
+	"""
+	sample_ids = read_nirvana_json_header(path).get("samples", [])
+	output_paths = {view: get_view_output_path(output_path, view) for view in views}
+	rows_by_view_iter = iter_nirvana_rows(
+		path, views=tuple(views), call_spliceai_api=call_spliceai_api, verbose=verbose, regions=regions,
+		spliceai_max_concurrent_requests=spliceai_max_concurrent_requests,
+		genotype_codes=_get_output_format(output_path) != "tsv")
+	return write_views(rows_by_view_iter, output_paths, sample_ids, batch_size=batch_size)
+
+
+def convert_nirvana_json_in_parallel(path, output_path, processes, views=("variants",), call_spliceai_api=False,
+									 regions=None, batch_size=DEFAULT_BATCH_SIZE,
+									 spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Converts each chromosome in a separate process, then combines the per-chromosome parts in the order in which
+	the chromosomes appear in the Nirvana JSON. Compressed tsv parts are concatenated as-is, since a sequence of gzip
+	members is a valid gzip file. Parquet and Arrow parts are copied into the output one record batch at a time.
+	Each view is written to get_view_output_path(output_path, view). spliceai_max_concurrent_requests is the limit
+	for all processes together, so each process gets an equal share of it.
+
+	Return:
+		dict: maps view name to number of rows written
+	"""
+	sample_ids = read_nirvana_json_header(path).get("samples", [])
+	chroms = list(_load_position_index(path)["chromosomes"])
+	if regions is None:
+		# each part reads all lines of its chromosome, rather than querying it as a region
+		chrom_regions = [None] * len(chroms)
+		part_chroms = chroms
+	else:
+		chrom_regions = [
+			[r for r in regions if _normalize_chrom(r[0]) == _normalize_chrom(chrom)] for chrom in chroms
+		]
+		chroms = [chrom for chrom, r in zip(chroms, chrom_regions) if r]
+		chrom_regions = [r for r in chrom_regions if r]
+		part_chroms = [None] * len(chroms)
+
+	output_format = _get_output_format(output_path)
+	output_dir = os.path.dirname(os.path.abspath(output_path))
+	output_suffix = _get_output_suffix(output_path)
+	temp_dir = tempfile.mkdtemp(prefix=".tmp.", dir=output_dir)
+	try:
+		part_paths = [
+			{view: os.path.join(temp_dir, f"part_{i:05d}.{view}{output_suffix}") for view in views}
+			for i in range(len(chroms))
+		]
+		num_processes = max(min(processes, len(chroms)), 1)
+		part_max_concurrent_requests = max(spliceai_max_concurrent_requests // num_processes, 1)
+		with ProcessPoolExecutor(max_workers=num_processes) as executor:
+			part_num_rows = list(executor.map(
+				_convert_part,
+				[path] * len(chroms), part_paths, [sample_ids] * len(chroms), [call_spliceai_api] * len(chroms),
+				chrom_regions, [batch_size] * len(chroms), part_chroms,
+				[part_max_concurrent_requests] * len(chroms)))
+
+		num_rows = {view: sum(n[view] for n in part_num_rows) for view in views}
+		for view in views:
+			view_output_path = get_view_output_path(output_path, view)
+			if output_format == "tsv":
+				header_path = os.path.join(temp_dir, f"header.{view}{output_suffix}")
+				_new_view_output_writer(header_path, view, sample_ids).close()
+				with open(view_output_path, "wb") as output_file:
+					for part_path in [header_path] + [p[view] for p in part_paths]:
+						with open(part_path, "rb") as part_file:
+							shutil.copyfileobj(part_file, output_file)
+			else:
+				with _new_view_output_writer(view_output_path, view, sample_ids) as writer:
+					for part_path in part_paths:
+						for record_batch in _iter_record_batches(part_path[view], output_format):
+							writer.write_record_batch(record_batch)
+	finally:
+		shutil.rmtree(temp_dir)
+
+	return num_rows
 
 
 def main():
 	p = argparse.ArgumentParser()
-	p.add_argument("-o", "--output-file", help="bed file output path")
+	p.add_argument("-o", "--output-file", help="Output path. The format is based on the file extension: .tsv, "
+		".tsv.gz, .parquet, .arrow/.feather (Arrow IPC file), or .arrows (Arrow IPC stream). Parquet and Arrow output "
+		"have typed columns and store genotypes as a matrix of allele counts (see read_genotype_matrix)")
 	p.add_argument("-s", "--call-spliceai-api", action="store_true", help="Use the SpliceAI-lookup API to get spliceAI scores")
+	p.add_argument("--spliceai-max-concurrent-requests", type=int, default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+		help="Max number of concurrent SpliceAI-lookup API requests, shared by all --processes")
 	p.add_argument("--verbose", action="store_true")
+	p.add_argument("--region", action="append", default=[], help="Only convert variants in this region "
+		"(chrom:start-end or chrom). Can be specified more than once.")
+	p.add_argument("--genes", nargs="+", default=[], help="Only convert variants in these genes (gene names or "
+		"Ensembl gene ids). Requires --gtf")
+	p.add_argument("--bed", help="Only convert variants in the regions in this bed file")
+	p.add_argument("--gtf", help="Gene annotations (eg. GENCODE gtf) for looking up --genes coordinates")
+	p.add_argument("-p", "--processes", type=int, default=1, help="Convert chromosomes in parallel using this many "
+		"processes. Requires the Nirvana JSON to be bgzipped, which is how Nirvana writes it.")
+	p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of rows to hold in memory "
+		"before appending them to the output file")
+	p.add_argument("--views", nargs="+", choices=list(VIEW_OUTPUT_COLUMNS), default=["variants"], help="Output views "
+		"to write in a single pass over the Nirvana JSON. 'variants' has one row per alt allele and is written to "
+		"--output-file. 'transcripts' has one row per alt allele and transcript, and 'canonical_transcripts' only has "
+		"rows for canonical or MANE Select transcripts. These are written next to --output-file with the view name "
+		"added before the file extension.")
 	p.add_argument("nirvana_json", help="Path of Nirvana JSON file")
 	args = p.parse_args()
 
+	try:
+		regions = parse_regions(args.region, args.genes, args.bed, args.gtf)
+	except ValueError as e:
+		p.error(str(e))
+
 	if not args.output_file:
 		args.output_file = re.sub(".json(.gz)?$", "", args.nirvana_json) + ".tsv.gz"
 
-	output_rows = parse_nirvana_json(args.nirvana_json, call_spliceai_api=args.call_spliceai_api, verbose=args.verbose)
-	df = pd.DataFrame(output_rows)
-	df.to_csv(args.output_file, sep="\t", index=False)
+	if args.processes > 1 and not is_bgzf(args.nirvana_json):
+		print(f"WARNING: {args.nirvana_json} isn't bgzipped, so it can't be split by chromosome. Using 1 process.")
+		args.processes = 1
+
+	views = list(dict.fromkeys(args.views))
+	if args.processes > 1:
+		num_rows = convert_nirvana_json_in_parallel(
+			args.nirvana_json, args.output_file, args.processes, views=views, call_spliceai_api=args.call_spliceai_api,
+			regions=regions, batch_size=args.batch_size,
+			spliceai_max_concurrent_requests=args.spliceai_max_concurrent_requests)
+	else:
+		num_rows = convert_nirvana_json(
+			args.nirvana_json, args.output_file, views=views, call_spliceai_api=args.call_spliceai_api,
+			verbose=args.verbose, regions=regions, batch_size=args.batch_size,
+			spliceai_max_concurrent_requests=args.spliceai_max_concurrent_requests)
 
-	print(f"Wrote {len(df)} rows to {args.output_file}")
+	for view in views:
+		print(f"Wrote {num_rows[view]} {view} rows to {get_view_output_path(args.output_file, view)}")
 
 if __name__ == "__main__":
 	main()
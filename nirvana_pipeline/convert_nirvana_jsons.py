@@ -0,0 +1,243 @@
+"""This script converts many Nirvana JSON files (eg. the outputs of annotate_vcfs.py) using a single pool of worker
+processes, so that pandas and the other dependencies are only imported once per worker rather than once per file.
+
+Files whose outputs are newer than the Nirvana JSON are skipped, and each conversion is written to temporary files that
+are renamed when it completes, so rerunning the same command after an interruption resumes where it left off. The
+status and timing of each file is appended to a tsv manifest.
+
+Example:
+	python3 convert_nirvana_jsons.py -p 8 --views variants canonical_transcripts -- nirvana_outputs/*.nirvana.json.gz
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import glob
+import os
+import re
+import time
+
+from bw2_annotation_utils.spliceai_scores import DEFAULT_MAX_CONCURRENT_REQUESTS
+from convert_nirvana_json_to_tsv import DEFAULT_BATCH_SIZE, VIEW_OUTPUT_COLUMNS, convert_nirvana_json, \
+	get_view_output_path
+
+MANIFEST_COLUMNS = [
+	"nirvana_json", "status", "seconds", "input_bytes", "num_rows", "output_paths", "finished", "error",
+]
+
+
+def get_output_path(nirvana_json_path, output_dir=None, output_suffix=".tsv.gz"):
+	"""Returns the "variants" output path for the given Nirvana JSON"""
+	output_path = re.sub(".json(.gz)?$", "", nirvana_json_path) + output_suffix
+	if output_dir:
+		output_path = os.path.join(output_dir, os.path.basename(output_path))
+
+	return output_path
+
+
+def is_up_to_date(nirvana_json_path, output_paths):
+	"""Returns True if all output paths exist and are newer than the Nirvana JSON"""
+	input_mtime = os.path.getmtime(nirvana_json_path)
+	return all(os.path.isfile(p) and os.path.getmtime(p) >= input_mtime for p in output_paths)
+
+
+def expand_input_paths(inputs):
+	"""Expands glob patterns and text files that list one Nirvana JSON path per line, and removes duplicates"""
+	paths = []
+	for i in inputs:
+		if not re.search("[.]json([.]gz)?$", i) and os.path.isfile(i):
+			with open(i) as f:
+				paths.extend(line.strip() for line in f if line.strip())
+		elif glob.has_magic(i):
+			matching_paths = sorted(glob.glob(i))
+			if not matching_paths:
+				print(f"WARNING: no files match {i}")
+			paths.extend(matching_paths)
+		else:
+			paths.append(i)
+
+	return list(dict.fromkeys(paths))
+
+
+def _convert_file(nirvana_json_path, output_path, views, call_spliceai_api=False, batch_size=DEFAULT_BATCH_SIZE,
+				  spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Worker task that converts one Nirvana JSON. Outputs are written to temporary paths in the output directory and
+	renamed once all views have been written, so that an interrupted conversion never leaves behind outputs that look
+	up-to-date.
+
+	Return:
+		2-tuple: (dict that maps view name to number of rows written, conversion time in seconds)
+	"""
+	start_time = time.time()
+	output_dir, output_filename = os.path.split(os.path.abspath(output_path))
+	temp_output_path = os.path.join(output_dir, f".tmp.{os.getpid()}.{output_filename}")
+	temp_paths = {view: get_view_output_path(temp_output_path, view) for view in views}
+	try:
+		num_rows = convert_nirvana_json(nirvana_json_path, temp_output_path, views=views,
+										call_spliceai_api=call_spliceai_api, batch_size=batch_size,
+										spliceai_max_concurrent_requests=spliceai_max_concurrent_requests)
+		for view, temp_path in temp_paths.items():
+			os.replace(temp_path, get_view_output_path(output_path, view))
+	finally:
+		for temp_path in temp_paths.values():
+			if os.path.isfile(temp_path):
+				os.remove(temp_path)
+
+	return num_rows, time.time() - start_time
+
+
+def _append_to_manifest(manifest_path, record):
+	write_header = not os.path.isfile(manifest_path) or os.path.getsize(manifest_path) == 0
+	with open(manifest_path, "at") as f:
+		if write_header:
+			f.write("\t".join(MANIFEST_COLUMNS) + "\n")
+		values = [str(record.get(c, "")).replace("\t", " ").replace("\n", " ") for c in MANIFEST_COLUMNS]
+		f.write("\t".join(values) + "\n")
+
+
+def convert_nirvana_jsons(nirvana_json_paths, processes=None, output_dir=None, output_suffix=".tsv.gz",
+						  views=("variants",), call_spliceai_api=False, batch_size=DEFAULT_BATCH_SIZE,
+						  manifest_path=None, force=False, spliceai_max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+	"""Converts many Nirvana JSON files using a pool of worker processes. Each file is converted by one worker, and
+	larger files are scheduled first so that a few large files don't end up running alone at the end.
+
+	Args:
+		nirvana_json_paths (list): Nirvana JSON paths
+		processes (int): number of worker processes. Defaults to the number of CPUs.
+		output_dir (str): output directory. Defaults to the directory of each Nirvana JSON.
+		output_suffix (str): suffix of the output files, which also sets the output format (see
+			convert_nirvana_json_to_tsv.py)
+		views (tuple): output views to write for each file (see iter_nirvana_rows(..))
+		call_spliceai_api (bool): use the SpliceAI-lookup API to get spliceAI scores
+		batch_size (int): number of rows to hold in memory before appending them to the output files
+		manifest_path (str): tsv file where a record is appended for each file that's converted, skipped or failed
+		force (bool): convert files even if their outputs are up-to-date
+		spliceai_max_concurrent_requests (int): max number of concurrent SpliceAI-lookup API requests. This limit is
+			shared by all worker processes.
+
+	Return:
+		list: the manifest records (dicts with the keys in MANIFEST_COLUMNS) of all files
+	"""
+	processes = processes or os.cpu_count() or 1
+	if output_dir:
+		os.makedirs(output_dir, exist_ok=True)
+
+	records = []
+	def add_record(record):
+		record["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+		records.append(record)
+		if manifest_path:
+			_append_to_manifest(manifest_path, record)
+
+	tasks = []
+	for nirvana_json_path in nirvana_json_paths:
+		output_path = get_output_path(nirvana_json_path, output_dir, output_suffix)
+		output_paths = [get_view_output_path(output_path, view) for view in views]
+		if not os.path.isfile(nirvana_json_path):
+			print(f"WARNING: {nirvana_json_path} not found. Skipping...")
+			add_record({"nirvana_json": nirvana_json_path, "status": "failed", "error": "file not found"})
+			continue
+
+		input_bytes = os.path.getsize(nirvana_json_path)
+		if not force and is_up_to_date(nirvana_json_path, output_paths):
+			add_record({"nirvana_json": nirvana_json_path, "status": "skipped", "input_bytes": input_bytes,
+						"output_paths": ",".join(output_paths)})
+			continue
+
+		tasks.append((input_bytes, nirvana_json_path, output_path, output_paths))
+
+	print(f"Converting {len(tasks)} Nirvana JSON files using {min(processes, len(tasks))} processes. "
+		  f"Skipped {len(nirvana_json_paths) - len(tasks)} files")
+
+	tasks.sort(key=lambda task: task[0], reverse=True)
+	start_time = time.time()
+	if tasks:
+		num_processes = min(processes, len(tasks))
+		worker_max_concurrent_requests = max(spliceai_max_concurrent_requests // num_processes, 1)
+		with ProcessPoolExecutor(max_workers=num_processes) as executor:
+			futures = {}
+			for input_bytes, nirvana_json_path, output_path, output_paths in tasks:
+				future = executor.submit(
+					_convert_file, nirvana_json_path, output_path, tuple(views), call_spliceai_api, batch_size,
+					worker_max_concurrent_requests)
+				futures[future] = (input_bytes, nirvana_json_path, output_paths)
+
+			for i, future in enumerate(as_completed(futures)):
+				input_bytes, nirvana_json_path, output_paths = futures[future]
+				record = {
+					"nirvana_json": nirvana_json_path,
+					"input_bytes": input_bytes,
+					"output_paths": ",".join(output_paths),
+				}
+				try:
+					num_rows, seconds = future.result()
+				except Exception as e:
+					print(f"WARNING: failed to convert {nirvana_json_path}: {e}")
+					record.update({"status": "failed", "error": f"{type(e).__name__}: {e}"})
+				else:
+					record.update({"status": "done", "num_rows": sum(num_rows.values()), "seconds": round(seconds, 1)})
+
+				add_record(record)
+				print(f"[{i + 1}/{len(futures)}] {record['status']}: {nirvana_json_path}" + (
+					f" in {record['seconds']}s" if "seconds" in record else ""))
+
+	print_throughput_report(records, time.time() - start_time)
+
+	return records
+
+
+def print_throughput_report(records, wall_time):
+	"""Prints the number of files that were converted, skipped and failed, and the overall throughput"""
+	converted = [r for r in records if r["status"] == "done"]
+	num_skipped = sum(1 for r in records if r["status"] == "skipped")
+	num_failed = sum(1 for r in records if r["status"] == "failed")
+	total_bytes = sum(r["input_bytes"] for r in converted)
+	total_rows = sum(r["num_rows"] for r in converted)
+
+	print(f"Converted {len(converted)} files, skipped {num_skipped} up-to-date files, {num_failed} failed")
+	if converted and wall_time > 0:
+		print(f"Converted {total_bytes / 2**20:0.1f} MB of Nirvana JSON into {total_rows:,d} rows in {wall_time:0.1f}s: "
+			  f"{total_bytes / 2**20 / wall_time:0.2f} MB/s, {total_rows / wall_time:,.0f} rows/s, "
+			  f"{len(converted) / wall_time * 3600:0.1f} files/hour")
+
+
+def main():
+	p = argparse.ArgumentParser(description="Convert many Nirvana JSON files using a pool of worker processes")
+	p.add_argument("-p", "--processes", type=int, default=os.cpu_count(), help="Number of worker processes. Each "
+		"converts one file at a time. Defaults to the number of CPUs.")
+	p.add_argument("--output-dir", help="Output directory. Default is the same directory as each Nirvana JSON")
+	p.add_argument("--output-suffix", default=".tsv.gz", help="Suffix of the output files. This also sets the output "
+		"format: .tsv, .tsv.gz, .parquet, .arrow/.feather or .arrows")
+	p.add_argument("--views", nargs="+", choices=list(VIEW_OUTPUT_COLUMNS), default=["variants"], help="Output views "
+		"to write for each file (see convert_nirvana_json_to_tsv.py)")
+	p.add_argument("-s", "--call-spliceai-api", action="store_true", help="Use the SpliceAI-lookup API to get spliceAI scores")
+	p.add_argument("--spliceai-max-concurrent-requests", type=int, default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+		help="Max number of concurrent SpliceAI-lookup API requests, shared by all worker processes")
+	p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of rows to hold in memory "
+		"before appending them to the output files")
+	p.add_argument("--manifest", help="Path of the tsv manifest where the status and timing of each file is "
+		"recorded. Default is convert_nirvana_jsons.manifest.tsv in the output directory, or the current directory.")
+	p.add_argument("-f", "--force", action="store_true", help="Convert all files, even ones whose outputs are "
+		"newer than the Nirvana JSON")
+	p.add_argument("nirvana_json", nargs="+", help="Nirvana JSON paths or glob patterns, or a text file that "
+		"contains one Nirvana JSON path per line")
+	args = p.parse_args()
+
+	nirvana_json_paths = expand_input_paths(args.nirvana_json)
+	if not nirvana_json_paths:
+		p.error("No Nirvana JSON files specified")
+
+	manifest_path = args.manifest or os.path.join(args.output_dir or ".", "convert_nirvana_jsons.manifest.tsv")
+	records = convert_nirvana_jsons(
+		nirvana_json_paths, processes=args.processes, output_dir=args.output_dir, output_suffix=args.output_suffix,
+		views=list(dict.fromkeys(args.views)), call_spliceai_api=args.call_spliceai_api, batch_size=args.batch_size,
+		manifest_path=manifest_path, force=args.force,
+		spliceai_max_concurrent_requests=args.spliceai_max_concurrent_requests)
+
+	print(f"Wrote manifest to {manifest_path}")
+	if any(r["status"] == "failed" for r in records):
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	main()
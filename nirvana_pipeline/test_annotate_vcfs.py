@@ -0,0 +1,177 @@
+import gzip
+import json
+import os
+import struct
+import subprocess
+import tempfile
+import unittest
+
+try:
+    import annotate_vcfs
+except ImportError:
+    annotate_vcfs = None  # hailtop and step_pipeline aren't installed
+
+
+def write_tabix_index(path, contigs):
+    """Writes the header of a tabix index that lists the given contigs. get_indexed_contigs(..) only reads the
+    header, so the bins and linear index are left out.
+    """
+    names = b"".join(contig.encode() + b"\x00" for contig in contigs)
+    header = b"TBI\x01" + struct.pack("<8i", len(contigs), 2, 1, 2, 0, ord("#"), 0, len(names))
+    with gzip.open(path, "wb") as f:
+        f.write(header + names)
+
+
+def write_vcf_header(path, contig_lengths):
+    with gzip.open(path, "wt") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        for contig, length in contig_lengths.items():
+            f.write(f"##contig=<ID={contig},length={length},assembly=GRCh38>\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+
+def nirvana_json_lines(positions, genes=()):
+    """Returns the lines of a Nirvana JSON with the given positions and genes, in the format Nirvana writes"""
+    lines = ['{"header":{"annotator":"Nirvana 3.14","samples":["S1"]},"positions":[']
+    lines += [json.dumps(p) + ("," if i < len(positions) - 1 else "") for i, p in enumerate(positions)]
+    if genes:
+        lines += ['],"genes":[']
+        lines += [json.dumps(g) + ("," if i < len(genes) - 1 else "") for i, g in enumerate(genes)]
+    lines += ["]}"]
+    return lines
+
+
+@unittest.skipIf(annotate_vcfs is None, "hailtop and step_pipeline aren't installed")
+class ShardRegionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.vcf_path = os.path.join(self.temp_dir.name, "test.vcf.gz")
+        write_vcf_header(self.vcf_path, {"chr1": 2500, "chr2": 1000, "chrM": 16569})
+        # chr2 has no records, so it isn't in the index. chrUn has records but no ##contig line.
+        write_tabix_index(f"{self.vcf_path}.tbi", ["chr1", "chrM", "chrUn"])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_shard_by_chrom(self):
+        self.assertEqual(annotate_vcfs.get_indexed_contigs(self.vcf_path), ["chr1", "chrM", "chrUn"])
+        self.assertEqual(annotate_vcfs.get_shard_regions(self.vcf_path), [
+            ("chr1", 1, None), ("chrM", 1, None), ("chrUn", 1, None),
+        ])
+
+    def test_shard_by_size(self):
+        self.assertEqual(annotate_vcfs.get_contig_lengths(self.vcf_path), {"chr1": 2500, "chr2": 1000, "chrM": 16569})
+        self.assertEqual(annotate_vcfs.get_shard_regions(self.vcf_path, shard_size=1000), [
+            ("chr1", 1, 1000), ("chr1", 1001, 2000), ("chr1", 2001, 2500),
+        ] + [
+            ("chrM", start, min(start + 999, 16569)) for start in range(1, 16570, 1000)
+        ] + [
+            ("chrUn", 1, None),
+        ])
+
+    def test_invalid_index(self):
+        with gzip.open(f"{self.vcf_path}.tbi", "wb") as f:
+            f.write(b"not an index")
+        with self.assertRaises(ValueError):
+            annotate_vcfs.get_indexed_contigs(self.vcf_path)
+
+
+@unittest.skipIf(annotate_vcfs is None, "hailtop and step_pipeline aren't installed")
+class PackVcfsTests(unittest.TestCase):
+
+    def test_pack_vcfs(self):
+        vcf_sizes = {f"gs://bucket/sample{i}.vcf.gz": size for i, size in enumerate([5, 1, 4, 2, 3, 100])}
+        self.assertEqual(annotate_vcfs.pack_vcfs(vcf_sizes, max_vcfs_per_step=2, max_total_size=1000), [
+            ["gs://bucket/sample1.vcf.gz", "gs://bucket/sample3.vcf.gz"],
+            ["gs://bucket/sample4.vcf.gz", "gs://bucket/sample2.vcf.gz"],
+            ["gs://bucket/sample0.vcf.gz", "gs://bucket/sample5.vcf.gz"],
+        ])
+        self.assertEqual(annotate_vcfs.pack_vcfs(vcf_sizes, max_vcfs_per_step=10, max_total_size=10), [
+            ["gs://bucket/sample1.vcf.gz", "gs://bucket/sample3.vcf.gz", "gs://bucket/sample4.vcf.gz",
+             "gs://bucket/sample2.vcf.gz"],
+            ["gs://bucket/sample0.vcf.gz"],
+            ["gs://bucket/sample5.vcf.gz"],
+        ])
+        self.assertEqual(annotate_vcfs.pack_vcfs({}), [])
+
+    def test_vcfs_with_the_same_filename_are_in_different_steps(self):
+        vcf_sizes = {"gs://bucket1/sample.vcf.gz": 1, "gs://bucket2/sample.vcf.gz": 2, "gs://bucket2/other.vcf.gz": 3}
+        self.assertEqual(annotate_vcfs.pack_vcfs(vcf_sizes), [
+            ["gs://bucket1/sample.vcf.gz"],
+            ["gs://bucket2/sample.vcf.gz", "gs://bucket2/other.vcf.gz"],
+        ])
+
+    def test_step_resources(self):
+        self.assertEqual(annotate_vcfs.get_step_resources(0), (1, "standard", "20Gi"))
+        self.assertEqual(annotate_vcfs.get_step_resources(10**9), (1, "standard", "20Gi"))
+        self.assertEqual(annotate_vcfs.get_step_resources(10**9 + 1), (2, "standard", "50Gi"))
+        self.assertEqual(annotate_vcfs.get_step_resources(10**12), (8, "highmem", "400Gi"))
+        with self.assertRaises(ValueError):
+            annotate_vcfs.get_step_resources(10**10, resources_table=[(1, 1, "standard", 20)])
+
+    def test_load_resources_table(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "resources.tsv")
+            with open(path, "wt") as f:
+                f.write("max_vcf_size_gb\tcpu\tmemory\tstorage_gb\ninf\t16\thighmem\t500\n\n0.5\t0.5\tlowmem\t10\n")
+            resources_table = annotate_vcfs.load_resources_table(path)
+            self.assertEqual(resources_table, [(0.5, 0.5, "lowmem", 10), (float("inf"), 16, "highmem", 500)])
+            self.assertEqual(annotate_vcfs.get_step_resources(10**9, resources_table), (16, "highmem", "500Gi"))
+
+            with open(path, "wt") as f:
+                f.write("max_size\tcpu\tmemory\tstorage\n")
+            with self.assertRaises(ValueError):
+                annotate_vcfs.load_resources_table(path)
+
+
+class MergeNirvanaJsonsTests(unittest.TestCase):
+    """Tests the awk script that the merge step runs. This only requires awk, and reads the script from
+    annotate_vcfs.py so that it also runs where annotate_vcfs can't be imported.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "annotate_vcfs.py")) as f:
+            source = f.read()
+        start = source.index('MERGE_NIRVANA_JSONS_AWK_SCRIPT = r"""') + len('MERGE_NIRVANA_JSONS_AWK_SCRIPT = r"""')
+        cls.awk_script = source[start:source.index('"""', start)]
+
+    def _merge(self, shards):
+        with tempfile.NamedTemporaryFile("wt", suffix=".awk") as f:
+            f.write(self.awk_script)
+            f.flush()
+            output = subprocess.run(["awk", "-f", f.name], input="".join(
+                "\n".join(lines) + "\n" for lines in shards), capture_output=True, text=True, check=True).stdout
+        return output
+
+    def test_merge_positions_and_genes(self):
+        positions = [{"chromosome": "chr1", "position": pos} for pos in range(100, 110)]
+        genes = [{"name": f"GENE{i}"} for i in range(4)]
+        output = self._merge([
+            nirvana_json_lines(positions[:3], genes[:2]),
+            nirvana_json_lines([], []),
+            nirvana_json_lines(positions[3:], genes[1:]),
+        ])
+
+        merged = json.loads(output)
+        self.assertEqual(merged["header"]["samples"], ["S1"])
+        self.assertEqual(merged["positions"], positions)
+        self.assertEqual(merged["genes"], genes)
+
+        # the merged JSON keeps one position per line, so it can be read line by line and indexed
+        lines = output.splitlines()
+        self.assertEqual(lines[1:len(positions) + 1],
+                         [json.dumps(p) + "," for p in positions[:-1]] + [json.dumps(positions[-1])])
+
+    def test_merge_without_genes(self):
+        positions = [{"chromosome": "chr2", "position": pos} for pos in range(5)]
+        merged = json.loads(self._merge([nirvana_json_lines(positions[:2]), nirvana_json_lines(positions[2:])]))
+        self.assertEqual(merged["positions"], positions)
+        self.assertNotIn("genes", merged)
+
+        self.assertEqual(json.loads(self._merge([nirvana_json_lines([])]))["positions"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+import csv
+import gzip
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+import zlib
+
+import simplejson as json
+
+from convert_nirvana_json_to_tsv import classify_consequences, convert_nirvana_json, \
+	convert_nirvana_json_in_parallel, parse_nirvana_json, parse_regions, read_nirvana_json
+
+HEADER = {"annotator": "Nirvana 3.18.1", "genomeAssembly": "GRCh38", "schemaVersion": 6, "samples": ["S1", "S2"]}
+
+
+def _make_position(chrom, pos, ref="A", alt="G", variant_type="SNV", sv_end=None, repeat_unit=None):
+	position = {"chromosome": chrom, "position": pos}
+	if sv_end is not None:
+		# structural variant and repeat records have svEnd before refAllele
+		position["svEnd"] = sv_end
+	if repeat_unit is not None:
+		position["repeatUnit"] = repeat_unit
+		position["refRepeatCount"] = 10
+	position.update({
+		"refAllele": ref,
+		"altAlleles": [alt],
+		"samples": [{"genotype": "0/1"}, {"genotype": "0/0"}],
+		"variants": [{
+			"variantType": variant_type,
+			"gnomad": {"allAf": 0.001 if pos % 2 else 0},
+			"transcripts": [{
+				"transcript": f"ENST{pos}.1", "bioType": "protein_coding", "hgnc": "GENE1",
+				"consequence": ["missense_variant"] if pos % 3 else ["intron_variant"],
+			}],
+		}],
+	})
+	return position
+
+
+def _bgzf_block(data):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+	compressed_data = compressor.compress(data) + compressor.flush()
+	header = b"\x1f\x8b\x08\x04" + b"\x00" * 6 + struct.pack("<H", 6) + b"BC" + struct.pack(
+		"<HH", 2, len(compressed_data) + 25)
+	return header + compressed_data + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def write_nirvana_json(path, positions, block_size=1000):
+	"""Writes positions in Nirvana's one-position-per-line format, bgzipped with small blocks so that the position
+	index has many blocks
+	"""
+	lines = ['{"header":' + json.dumps(HEADER, separators=(",", ":")) + ',"positions":[']
+	lines += [json.dumps(p, separators=(",", ":")) + ("," if i < len(positions) - 1 else "")
+			  for i, p in enumerate(positions)]
+	lines += ["]}"]
+	data = ("\n".join(lines) + "\n").encode()
+	with open(path, "wb") as f:
+		for i in range(0, len(data), block_size):
+			f.write(_bgzf_block(data[i:i + block_size]))
+		f.write(_bgzf_block(b""))
+
+
+def make_test_positions():
+	positions = []
+	for chrom in ["chr1", "chr2", "chrX"]:
+		for pos in range(100, 20000, 97):
+			positions.append(_make_position(chrom, pos))
+		positions.append(_make_position(chrom, 20100, ref="N", alt="<DEL>", variant_type="deletion", sv_end=45000))
+		positions.append(_make_position(chrom, 20200, ref="C", alt="<STR12>", variant_type="short_tandem_repeat_variation",
+										sv_end=20260, repeat_unit="CAG"))
+		for pos in range(20300, 30000, 89):
+			positions.append(_make_position(chrom, pos))
+	return positions
+
+
+class NirvanaJsonTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.positions = make_test_positions()
+		self.nirvana_json_path = os.path.join(self.temp_dir.name, "test.json.gz")
+		write_nirvana_json(self.nirvana_json_path, self.positions)
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+
+class RegionQueryTests(NirvanaJsonTestCase):
+
+	def _query(self, regions):
+		_, positions = read_nirvana_json(self.nirvana_json_path, regions=regions)
+		return [(p["chromosome"], p["position"]) for p in positions]
+
+	def test_whole_chromosome_includes_structural_variants(self):
+		expected = [(p["chromosome"], p["position"]) for p in self.positions if p["chromosome"] == "chr2"]
+		self.assertEqual(self._query([("2", 1, 10**10)]), expected)
+
+	def test_structural_variant_spanning_region(self):
+		# only the deletion at 20100 (svEnd 45000) overlaps this region
+		self.assertEqual(self._query([("chr1", 40000, 41000)]), [("chr1", 20100)])
+
+	def test_region_matches_brute_force(self):
+		regions = [("chr1", 20150, 20250), ("chrX", 5000, 6000), ("chr2", 29000, 50000)]
+		expected = []
+		for p in self.positions:
+			p_end = p.get("svEnd", p["position"] + len(p["refAllele"]) - 1)
+			if any(p["chromosome"] == chrom and p["position"] <= end and p_end >= start
+				   for chrom, start, end in regions):
+				expected.append((p["chromosome"], p["position"]))
+		self.assertEqual(self._query(regions), expected)
+
+	def test_truncated_index_is_rebuilt(self):
+		expected = self._query([("chrX", 5000, 6000)])
+		index_path = f"{self.nirvana_json_path}.positions_index.json.gz"
+		with open(index_path, "rb") as f:
+			index_data = f.read()
+		with open(index_path, "wb") as f:
+			f.write(index_data[:len(index_data) // 2])
+
+		self.assertEqual(self._query([("chrX", 5000, 6000)]), expected)
+		self.assertEqual(os.listdir(self.temp_dir.name), ["test.json.gz", "test.json.gz.positions_index.json.gz"])
+		with gzip.open(index_path, "rb") as f:
+			self.assertEqual(f.read(), gzip.decompress(index_data))
+
+
+class ParallelConversionTests(NirvanaJsonTestCase):
+
+	def test_parallel_output_matches_serial_output(self):
+		serial_output_path = os.path.join(self.temp_dir.name, "serial.tsv")
+		parallel_output_path = os.path.join(self.temp_dir.name, "parallel.tsv")
+		serial_num_rows = convert_nirvana_json(self.nirvana_json_path, serial_output_path)
+		parallel_num_rows = convert_nirvana_json_in_parallel(self.nirvana_json_path, parallel_output_path, processes=2)
+
+		self.assertEqual(serial_num_rows, {"variants": len(self.positions)})
+		self.assertEqual(parallel_num_rows, serial_num_rows)
+		with open(serial_output_path, "rb") as serial_file, open(parallel_output_path, "rb") as parallel_file:
+			self.assertEqual(parallel_file.read(), serial_file.read())
+
+
+class BatchSizeTests(NirvanaJsonTestCase):
+
+	def test_output_does_not_depend_on_batch_size(self):
+		outputs = []
+		for batch_size in [1, 1000]:
+			output_path = os.path.join(self.temp_dir.name, f"batch_size_{batch_size}.tsv")
+			convert_nirvana_json(self.nirvana_json_path, output_path, batch_size=batch_size)
+			with open(output_path) as f:
+				outputs.append(f.read())
+
+		self.assertEqual(outputs[0], outputs[1])
+		self.assertNotIn("\t0\t", outputs[0])
+
+	def test_integer_allele_frequencies_are_written_as_floats(self):
+		positions = [_make_position("chr1", pos) for pos in range(100, 1000, 2)]
+		nirvana_json_path = os.path.join(self.temp_dir.name, "all_zero_af.json.gz")
+		write_nirvana_json(nirvana_json_path, positions)
+		output_path = os.path.join(self.temp_dir.name, "all_zero_af.tsv")
+		convert_nirvana_json(nirvana_json_path, output_path)
+		with open(output_path) as f:
+			rows = list(csv.DictReader(f, delimiter="\t"))
+
+		self.assertEqual(len(rows), len(positions))
+		self.assertEqual({row["gnomad_af"] for row in rows}, {"0.0"})
+		self.assertEqual({row["1kg_af"] for row in rows}, {"0.0"})
+
+
+class ConsequenceTests(NirvanaJsonTestCase):
+
+	def test_classify_consequences(self):
+		consequences = classify_consequences(self.positions)
+		self.assertEqual(len(consequences["consequence_mask"]), len(self.positions))
+		self.assertEqual(list(consequences["is_missense"]), [bool(p["position"] % 3) for p in self.positions])
+		self.assertFalse(consequences["is_lof"].any())
+		self.assertFalse(consequences["is_synonymous"].any())
+
+	def test_consequence_columns(self):
+		for position, row in zip(self.positions, parse_nirvana_json(self.nirvana_json_path)):
+			expected_consequence = "missense_variant" if position["position"] % 3 else "intron_variant"
+			self.assertEqual(row["consequences"], expected_consequence)
+			self.assertEqual(row["most_severe_consequence"], expected_consequence)
+			self.assertEqual(row["missense_consequences"], "missense_variant" if row["is_missense"] else "")
+			self.assertNotIn("consequence_mask", row)
+
+	@mock.patch("convert_nirvana_json_to_tsv._get_mane_select_transcript_ids", return_value=frozenset(["ENST100"]))
+	def test_transcripts_view(self, _):
+		output_path = os.path.join(self.temp_dir.name, "output.tsv")
+		convert_nirvana_json(self.nirvana_json_path, output_path, views=("variants", "canonical_transcripts"))
+		with open(os.path.join(self.temp_dir.name, "output.canonical_transcripts.tsv")) as f:
+			rows = list(csv.DictReader(f, delimiter="\t"))
+
+		self.assertEqual(len(rows), 3)
+		self.assertEqual({row["transcript_id"] for row in rows}, {"ENST100.1"})
+		self.assertEqual({row["most_severe_consequence"] for row in rows}, {"missense_variant"})
+		self.assertEqual({row["is_missense"] for row in rows}, {"True"})
+
+
+class SpliceAITests(NirvanaJsonTestCase):
+
+	def test_scores_are_looked_up_one_chunk_at_a_time(self):
+		calls = []
+		def get_spliceai_scores_for_variants(variants, max_concurrent_requests):
+			variants = list(variants)
+			calls.append((len(variants), max_concurrent_requests))
+			return {f"{chrom.replace('chr', '')}-{pos}-{ref}-{alt}": (0.5, 0.25) for chrom, pos, ref, alt in variants}
+
+		with mock.patch("convert_nirvana_json_to_tsv.get_spliceai_scores_for_variants",
+						side_effect=get_spliceai_scores_for_variants), \
+				mock.patch("convert_nirvana_json_to_tsv.POSITION_CHUNK_SIZE", 100):
+			rows = list(parse_nirvana_json(self.nirvana_json_path, call_spliceai_api=True))
+
+		self.assertEqual([num_variants for num_variants, _ in calls], [100] * 9 + [len(self.positions) - 900])
+		self.assertEqual({max_concurrent_requests for _, max_concurrent_requests in calls}, {8})
+		self.assertEqual({(row["spliceAI_gain"], row["spliceAI_loss"]) for row in rows}, {(0.5, 0.25)})
+
+
+class OutputColumnsTests(NirvanaJsonTestCase):
+
+	def test_new_columns_come_after_the_genotype_columns(self):
+		output_path = os.path.join(self.temp_dir.name, "output.tsv")
+		convert_nirvana_json(self.nirvana_json_path, output_path)
+		with open(output_path) as f:
+			header = f.readline().rstrip("\n").split("\t")
+
+		self.assertEqual(header[:21], [
+			"chrom", "pos", "ref", "alt", "variant_type", "consequences", "synonymous_consequences",
+			"missense_consequences", "lof_consequences", "is_synonymous", "is_missense", "is_lof", "gene", "clinvar",
+			"spliceAI_gain", "spliceAI_loss", "1kg_af", "gnomad_af", "topmed_af", "S1", "S2",
+		])
+		self.assertEqual(header[21:], ["most_severe_consequence"])
+
+
+class ParseRegionsTests(unittest.TestCase):
+
+	def test_invalid_region(self):
+		with self.assertRaises(ValueError):
+			parse_regions(["chr1:100"])
+
+	def test_invalid_bed_line(self):
+		with tempfile.NamedTemporaryFile("wt", suffix=".bed") as f:
+			f.write("chr1\t100\n")
+			f.flush()
+			with self.assertRaises(ValueError):
+				parse_regions(bed_path=f.name)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,84 @@
+import csv
+import os
+import tempfile
+import unittest
+
+from convert_nirvana_json_to_tsv import convert_nirvana_json
+from convert_nirvana_jsons import convert_nirvana_jsons, expand_input_paths, get_output_path
+from test_convert_nirvana_json_to_tsv import _make_position, write_nirvana_json
+
+
+class ConvertNirvanaJsonsTests(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.input_dir = os.path.join(self.temp_dir.name, "inputs")
+		self.output_dir = os.path.join(self.temp_dir.name, "outputs")
+		os.makedirs(self.input_dir)
+		self.nirvana_json_paths = []
+		for i, num_positions in enumerate([50, 200]):
+			path = os.path.join(self.input_dir, f"sample{i}.json.gz")
+			write_nirvana_json(path, [_make_position("chr1", pos) for pos in range(100, 100 + 10 * num_positions, 10)])
+			self.nirvana_json_paths.append(path)
+		self.manifest_path = os.path.join(self.output_dir, "manifest.tsv")
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def _convert(self, nirvana_json_paths, **kwargs):
+		return convert_nirvana_jsons(nirvana_json_paths, processes=2, output_dir=self.output_dir, output_suffix=".tsv",
+									 manifest_path=self.manifest_path, **kwargs)
+
+	def test_convert_and_skip_up_to_date_files(self):
+		records = self._convert(self.nirvana_json_paths)
+		self.assertEqual({r["nirvana_json"]: (r["status"], r["num_rows"]) for r in records}, {
+			self.nirvana_json_paths[0]: ("done", 50),
+			self.nirvana_json_paths[1]: ("done", 200),
+		})
+		self.assertEqual(sorted(os.listdir(self.output_dir)), ["manifest.tsv", "sample0.tsv", "sample1.tsv"])
+
+		# outputs are the same as converting each file on its own
+		expected_output_path = os.path.join(self.temp_dir.name, "expected.tsv")
+		convert_nirvana_json(self.nirvana_json_paths[1], expected_output_path)
+		with open(expected_output_path) as expected_file, open(os.path.join(self.output_dir, "sample1.tsv")) as f:
+			self.assertEqual(f.read(), expected_file.read())
+
+		records = self._convert(self.nirvana_json_paths)
+		self.assertEqual([r["status"] for r in records], ["skipped", "skipped"])
+
+		records = self._convert(self.nirvana_json_paths[:1], force=True)
+		self.assertEqual([r["status"] for r in records], ["done"])
+
+		with open(self.manifest_path) as f:
+			manifest = list(csv.DictReader(f, delimiter="\t"))
+		self.assertEqual([r["status"] for r in manifest], ["done", "done", "skipped", "skipped", "done"])
+
+	def test_failed_files(self):
+		missing_path = os.path.join(self.input_dir, "missing.json.gz")
+		invalid_path = os.path.join(self.input_dir, "invalid.json.gz")
+		with open(invalid_path, "wb") as f:
+			f.write(b"not a Nirvana JSON")
+
+		records = self._convert([missing_path, invalid_path, self.nirvana_json_paths[0]])
+		self.assertEqual({r["nirvana_json"]: r["status"] for r in records}, {
+			missing_path: "failed", invalid_path: "failed", self.nirvana_json_paths[0]: "done",
+		})
+		self.assertEqual(sorted(os.listdir(self.output_dir)), ["manifest.tsv", "sample0.tsv"])
+
+	def test_expand_input_paths(self):
+		list_path = os.path.join(self.temp_dir.name, "nirvana_jsons.txt")
+		with open(list_path, "wt") as f:
+			f.write(f"{self.nirvana_json_paths[1]}\n\n{self.nirvana_json_paths[0]}\n")
+
+		self.assertEqual(expand_input_paths([list_path, os.path.join(self.input_dir, "*.json.gz")]),
+						 [self.nirvana_json_paths[1], self.nirvana_json_paths[0]])
+		self.assertEqual(expand_input_paths([os.path.join(self.input_dir, "*.tsv")]), [])
+		self.assertEqual(expand_input_paths(["other.json"]), ["other.json"])
+
+	def test_get_output_path(self):
+		self.assertEqual(get_output_path("/data/sample.json.gz"), "/data/sample.tsv.gz")
+		self.assertEqual(get_output_path("/data/sample.json", "/outputs", ".parquet"), "/outputs/sample.parquet")
+
+
+if __name__ == "__main__":
+	unittest.main()
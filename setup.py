@@ -31,12 +31,16 @@ setup(
     version="0.1.4",
     description="Misc. utilities for downloading and working with various gene annotations, the HPO ontology, etc",
     install_requires=requirements,
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
     cmdclass={
         'publish': PublishCommand,
     },
     entry_points = {
         'console_scripts': [
             'hpo_lookup = bw2_annotation_utils.hpo_lookup:main',
+            'annotations_cache = bw2_annotation_utils.cache_utils:main',
         ],
     },
     long_description_content_type="text/markdown",